@@ -1,16 +1,35 @@
 
 import os
+import collections
+import contextlib
+import json
+import sys
+import threading
 import time
 import logging
-from functools import wraps
+from functools import partial, wraps
 
 import pandas as pd
 
+from common import manifest
+
 try:
     import settings
 except ImportError:
     settings = object()
 
+try:  # optional, required for binary cache formats
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import fcntl
+except ImportError:  # Windows; only threads of the same process wait then
+    fcntl = None
+
 
 def mkdir(*args):
     path = ''
@@ -31,93 +50,675 @@ def _argstring(*args):
     return "_".join([str(arg).replace("/", ".") for arg in args])
 
 
+class CSVBackend(object):
+    """ Cache storage format; text, slow to parse and loses dtypes,
+    but readable by anything. Used if pyarrow is not installed """
+    extension = 'csv'
+
+    def load(self, fpath, idx):
+        return pd.read_csv(fpath, index_col=list(range(idx)),
+                           encoding="utf8", squeeze=True)
+
+    def save(self, fpath, res):
+        pd.DataFrame(res).to_csv(fpath, float_format="%g", encoding="utf-8")
+
+
+class ParquetBackend(object):
+    """ Columnar binary format, keeping dtypes and index levels.
+    Requires pyarrow """
+    extension = 'parquet'
+    # schema metadata key to tell series from single column dataframes
+    METADATA_KEY = b'fs_cache'
+
+    def load(self, fpath, idx):
+        table = self.read_table(fpath)
+        res = table.to_pandas()
+        meta = json.loads(
+            (table.schema.metadata or {}).get(self.METADATA_KEY, b'{}'))
+        if meta.get('series'):
+            res = res.iloc[:, 0].rename(meta['name'])
+        return res
+
+    def save(self, fpath, res):
+        meta = {'series': isinstance(res, pd.Series)}
+        if meta['series']:
+            meta['name'] = res.name if isinstance(
+                res.name, (int, float, type(None))) else str(res.name)
+            res = res.to_frame()
+        # might raise pyarrow.ArrowException on mixed type columns
+        table = pyarrow.Table.from_pandas(res)
+        metadata = dict(table.schema.metadata or {})
+        metadata[self.METADATA_KEY] = json.dumps(meta).encode('utf8')
+        self.write_table(table.replace_schema_metadata(metadata), fpath)
+
+    def read_table(self, fpath):
+        return pyarrow.parquet.read_table(fpath)
+
+    def write_table(self, table, fpath):
+        pyarrow.parquet.write_table(table, fpath)
+
+
+class FeatherBackend(ParquetBackend):
+    """ Arrow IPC format: larger files than Parquet, but faster to read """
+    extension = 'feather'
+
+    def read_table(self, fpath):
+        return pyarrow.feather.read_table(fpath)
+
+    def write_table(self, table, fpath):
+        pyarrow.feather.write_feather(table, fpath)
+
+
+# cache formats by file extension, in order of preference for reading
+BACKENDS = collections.OrderedDict(
+    (backend.extension, backend()) for backend in
+    (ParquetBackend, FeatherBackend, CSVBackend))
+
+
+def get_backend(name=None):
+    """ Cache format by name (parquet|feather|csv). By default, it is set by
+    DATASET_CACHE_FORMAT in settings.py; Parquet if not set """
+    name = name or getattr(settings, 'DATASET_CACHE_FORMAT', 'parquet')
+    if name not in BACKENDS:
+        raise ValueError("Unknown cache format: %s" % name)
+    if pyarrow is None and name != 'csv':
+        return BACKENDS['csv']
+    return BACKENDS[name]
+
+
+# os.rename() does not replace existing files on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _write(backend, fpath, res):
+    """ Write to a temporary file first and rename it, so that readers in
+    other threads and processes never see a partially written file """
+    tmp_fpath = "%s.%d.%d.tmp" % (
+        fpath, os.getpid(), threading.current_thread().ident)
+    try:
+        backend.save(tmp_fpath, res)
+        _replace(tmp_fpath, fpath)
+    except Exception:
+        if os.path.isfile(tmp_fpath):
+            os.remove(tmp_fpath)
+        raise
+
+
+class _FileLock(object):
+    """ Exclusive lock shared by processes, held on a file created for this
+    purpose and removed on release """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl is None:
+            return self
+        while True:
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # the previous holder might have removed the file while we were
+            # waiting, so the lock would be held on a stale file
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    self.fd = fd
+                    return self
+            except OSError:  # removed
+                pass
+            os.close(fd)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.fd is not None:
+            os.remove(self.path)
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+# key: [threading.Lock, number of threads using it]
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _thread_lock(key):
+    """ Per key lock between threads; locks are dropped once unused """
+    with _thread_locks_lock:
+        lock = _thread_locks.setdefault(key, [threading.Lock(), 0])
+        lock[1] += 1
+    try:
+        with lock[0]:
+            yield
+    finally:
+        with _thread_locks_lock:
+            lock[1] -= 1
+            if not lock[1]:
+                del _thread_locks[key]
+
+
+def sizeof(obj):
+    # type: (object) -> int
+    """ Memory used by an object; for pandas objects, including index and
+    contents of object (e.g. str) columns """
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True, deep=True))
+    return sys.getsizeof(obj)
+
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', 'hits misses evictions items size maxsize max_bytes')
+
+
+class LRUCache(object):
+    """ Thread safe mapping of limited number of items (maxsize) and/or
+    total size (max_bytes, see sizeof()). When either is exceeded, the least
+    recently used items are evicted. Items older than ttl seconds and items
+    of another version (e.g. mtime of the file they were read from) are
+    considered missing. Size is only measured if max_bytes is set.
+
+    >>> cache = LRUCache(8, sizeof=len)
+    >>> cache.put('a', 'abcd')
+    >>> cache.put('b', 'efgh')
+    >>> cache.get('a')
+    'abcd'
+    >>> cache.put('c', 'ijkl')  # evicts 'b', used before 'a'
+    >>> cache.get('b') is None
+    True
+    >>> cache.info()[:5]  # hits, misses, evictions, items, size
+    (1, 1, 1, 2, 8)
+    """
+
+    def __init__(self, max_bytes=None, sizeof=sizeof, maxsize=None, ttl=None):
+        # type: (int, callable, int, float) -> None
+        # None means unlimited
+        self.max_bytes = max_bytes
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._lock = threading.Lock()
+        # key: (value, version, size, time added), least recently used first
+        self._data = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def _valid(self, item, version):
+        return item[1] == version and (
+            self.ttl is None or time.time() - item[3] < self.ttl)
+
+    def get(self, key, default=None, version=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or not self._valid(item, version):
+                if item is not None:  # outdated
+                    self.size -= item[2]
+                self.misses += 1
+                return default
+            self._data[key] = item  # move to the end
+            self.hits += 1
+            return item[0]
+
+    def peek(self, key, default=None, version=None):
+        """ Same as get(), but does not affect statistics and eviction order
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or not self._valid(item, version):
+                return default
+            return item[0]
+
+    def put(self, key, value, version=None):
+        size = 0 if self.max_bytes is None else self.sizeof(value)
+        with self._lock:
+            self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return  # not worth evicting everything else
+            self._data[key] = (value, version, size, time.time())
+            self.size += size
+            while self._data and (
+                    (self.max_bytes is not None
+                     and self.size > self.max_bytes)
+                    or (self.maxsize is not None
+                        and len(self._data) > self.maxsize)):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size -= item[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def info(self):
+        # type: () -> CacheInfo
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             len(self._data), self.size, self.maxsize,
+                             self.max_bytes)
+
+    def __len__(self):
+        return len(self._data)
+
+
+# memory tier shared by all fs_cache instances, bytes; disabled by default
+MEMORY_BUDGET = getattr(settings, 'DATASET_CACHE_MEMORY', 0)
+memory_cache = LRUCache(MEMORY_BUDGET)
+
+
 class fs_cache(object):
+    """ Cache function results (pd.DataFrame or pd.Series) in files.
+    Files are stored in Parquet format if pyarrow is installed, see
+    get_backend(); existing files in other formats are still used, and
+    replaced on the next update (see also `./manage.py convert_cache`).
+    Results that can't be stored in Parquet (e.g. columns of mixed types)
+    are stored in CSV.
+
+    :param app_name: str, cache folder will be <ds_path>/<app_name>.cache
+    :param idx: int, number of index columns
+    :param cache_type: str, subfolder inside the app cache folder
+    :param expires: int, number of seconds cache stays valid
+    :param incremental: bool, if cache is expired but the file exists,
+        previous result is passed to the function as a keyword argument
+        `cached`, so it only needs to fetch what changed since then.
+        If nothing changed, the function should return `cached` object itself
+        so that caches depending on it are not recomputed.
+    :param depends_on: tuple of @fs_cache'd functions taking the same
+        arguments this function is computed from. If set, cache does not
+        expire by time but only if any of dependencies was updated since.
+    :param ds_path: str, root folder for all caches
+    :param backend: str, file format (parquet|feather|csv), see get_backend()
+    :param memory: keep results read from files in memory, so that repeated
+        calls in the same process don't read them again. By default, the
+        shared `memory_cache` is used if DATASET_CACHE_MEMORY (bytes) is set
+        in settings.py; False disables it, a number sets a separate budget.
+        Results are copied on every call, so they can be modified safely.
+
+    Calls with the same arguments are computed once at a time: if other
+    threads or processes (see _FileLock) are computing the same result,
+    the call waits for them and reads the result from cache.
+    Files are written under a temporary name and renamed, so they are never
+    read partially written.
+    """
+    # (cache folder, function name): fs_cache instance,
+    # to find out how to read a cache file, e.g. by convert_cache
+    registry = {}
 
     def __init__(self, app_name, idx=1, cache_type='',
-                 expires=DEFAULT_EXPIRY, ds_path=DATASET_PATH):
+                 expires=DEFAULT_EXPIRY, ds_path=DATASET_PATH,
+                 incremental=False, depends_on=(), backend=None,
+                 memory=None):
         self.expires = expires
         self.idx = idx
+        self.incremental = incremental
+        self.depends_on = depends_on
+        self.backend = get_backend(backend)
+        if memory is None or memory is True:
+            self.memory = memory_cache if MEMORY_BUDGET else None
+        else:
+            self.memory = LRUCache(memory) if memory else None
         if not app_name:
             self.cache_path = ds_path
         else:
             self.cache_path = mkdir(ds_path, app_name + ".cache", cache_type)
 
+    @property
+    def manifest(self):
+        # opened on first use, not to index all caches on import
+        return manifest.get_manifest(self.cache_path)
+
+    @staticmethod
+    def key(func_name, *args):
+        # type: (str, *object) -> str
+        """ Cache key, also the file name without extension
+
+        >>> fs_cache.key("commits", "github.com/a/b")
+        'commits.github.com.a.b'
+        """
+        return ".".join([func_name, _argstring(*args)] if args
+                        else [func_name])
+
     def get_cache_fname(self, func_name, *args, **kwargs):
-        chunks = [func_name]
-        if args:
-            chunks.append(_argstring(*args))
-        chunks.append(kwargs.get("extension", "csv"))
-        return os.path.join(self.cache_path, ".".join(chunks))
+        """ Path to store the result in the current format """
+        key = self.key(func_name, *args)
+        path = self._shard_path(key)
+        return os.path.join(path, ".".join(
+            [key, kwargs.get("extension", self.backend.extension)]))
+
+    def _shard_path(self, key):
+        # type: (str) -> str
+        path = os.path.join(self.cache_path, manifest.shard(key))
+        if not os.path.isdir(path):
+            try:
+                os.mkdir(path)
+            except OSError:  # created by another thread meanwhile
+                pass
+        return path
 
-    def expired(self, cache_fpath):
-        return not os.path.isfile(cache_fpath) \
-               or time.time() - os.path.getmtime(cache_fpath) > self.expires
+    def find_cache_fname(self, func_name, *args):
+        """ Path to the existing cache file, which might be in a format other
+        than the current one. If there is none, path to create it """
+        entry = self.manifest.get(self.key(func_name, *args))
+        if entry is not None:
+            return entry.path
+        return self.get_cache_fname(func_name, *args)
+
+    def _expired(self, mtime, args):
+        # type: (float, tuple) -> bool
+        if mtime is None:
+            return True
+        if not self.depends_on:
+            return time.time() - mtime > self.expires
+        for dep in self.depends_on:
+            dep_mtime = dep.mtime(*args)
+            if dep_mtime is None or dep_mtime > mtime:
+                return True
+        return False
+
+    def expired(self, cache_fpath, *args):
+        """ Check a file which is not in the manifest, e.g. a manual cache """
+        return self._expired(os.path.getmtime(cache_fpath)
+                             if os.path.isfile(cache_fpath) else None, args)
+
+    def load(self, cache_fpath):
+        # format is defined by the file extension
+        extension = os.path.splitext(cache_fpath)[1][1:]
+        return BACKENDS[extension].load(cache_fpath, self.idx)
+
+    def _load(self, key, entry):
+        # type: (str, manifest.Entry) -> object
+        """ Load a manifest entry, from the memory tier if possible """
+        if self.memory is None:
+            return self.load(entry.path)
+        memory_key = (self.cache_path, key)
+        res = self.memory.get(memory_key, version=entry.mtime)
+        if res is None:
+            res = self.load(entry.path)
+            self.memory.put(memory_key, res, version=entry.mtime)
+        return res.copy()
+
+    def _lookup(self, key, args, load_expired=False):
+        # type: (str, tuple, bool) -> (manifest.Entry, bool, object)
+        """ :return: (manifest entry, expired, result) The result is None if
+        there is no cache, or it is expired and load_expired is not set """
+        while True:
+            entry = self.manifest.get(key)
+            expired = self._expired(entry and entry.mtime, args)
+            if entry is None or (expired and not load_expired):
+                return entry, expired, None
+            try:
+                return entry, expired, self._load(key, entry)
+            except (IOError, OSError):
+                if self.manifest.get(key) == entry:
+                    # removed bypassing the manifest
+                    self.manifest.remove(key)
+                    return None, True, None
+                # otherwise, replaced by another thread or process; retry
+
+    @contextlib.contextmanager
+    def _single_flight(self, key):
+        """ Only one thread of one process computes a result at a time;
+        others wait for it to finish and then read the result from cache """
+        with _thread_lock((self.cache_path, key)):
+            with _FileLock(os.path.join(self._shard_path(key),
+                                        key + ".lock")):
+                yield
+
+    def save(self, cache_fpath, res, func_name=''):
+        """ Store result in the current format, in the shard folder.
+        If it is stored elsewhere or in another format already (i.e. as
+        cache_fpath), the old file is replaced. :return: path to the new file
+        """
+        if isinstance(res, pd.DataFrame):
+            if len(res.columns) == 1 and self.idx == 1:
+                logging.warning(
+                    "Single column dataframe is returned by %s.\nSince it "
+                    "will cause inconsistent behavior with @fs_cache "
+                    "decorator, please consider changing result type "
+                    "to pd.Series", func_name)
+        elif not isinstance(res, pd.Series):
+            raise ValueError("Unsupported result type (pd.DataFrame or "
+                             "pd.Series expected, got %s)" % type(res))
+
+        key = os.path.splitext(os.path.basename(cache_fpath))[0]
+        base = os.path.join(self._shard_path(key), key)
+        fpath = base + "." + self.backend.extension
+        try:
+            _write(self.backend, fpath, res)
+        # pyarrow errors are subclasses of these, e.g. ArrowInvalid
+        except (ValueError, TypeError, NotImplementedError):
+            if self.backend is BACKENDS['csv']:
+                raise
+            logging.warning("Failed to store result of %s in %s format, "
+                            "falling back to csv", func_name,
+                            self.backend.extension)
+            fpath = base + ".csv"
+            _write(BACKENDS['csv'], fpath, res)
+
+        old = self.manifest.get(key)
+        self.manifest.put(key, fpath, manifest.schema(res))
+        if self.memory is not None:  # outdated, just to free memory
+            self.memory.remove((self.cache_path, key))
+        # remove the old file, not to load it instead
+        for old_fpath in (cache_fpath, old and old.path):
+            if old_fpath and old_fpath != fpath and os.path.isfile(old_fpath):
+                try:
+                    os.remove(old_fpath)
+                except OSError:  # removed by a concurrent store()
+                    pass
+        return fpath
 
     def __call__(self, func):
         @wraps(func)
         def wrapper(*args):
-            cache_fpath = self.get_cache_fname(func.__name__, *args)
-
-            if not self.expired(cache_fpath):
-                return pd.read_csv(cache_fpath, index_col=range(self.idx),
-                                   encoding="utf8", squeeze=True)
-
-            res = func(*args)
-            if isinstance(res, pd.DataFrame):
-                df = res
-                if len(df.columns) == 1 and self.idx == 1:
-                    logging.warning(
-                        "Single column dataframe is returned by %s.\nSince it "
-                        "will cause inconsistent behavior with @fs_cache "
-                        "decorator, please consider changing result type "
-                        "to pd.Series", func.__name__)
-            elif isinstance(res, pd.Series):
-                df = pd.DataFrame(res)
-            else:
-                raise ValueError("Unsupported result type (pd.DataFrame or "
-                                 "pd.Series expected, got %s)" % type(res))
-            df.to_csv(cache_fpath, float_format="%g", encoding="utf-8")
+            key = self.key(func.__name__, *args)
+
+            # refresh dependencies first. If they didn't change,
+            # this cache is touched and so will not be recomputed
+            for dep in self.depends_on:
+                if dep.expired(*args):
+                    dep(*args)
+
+            entry, expired, cached = self._lookup(key, args)
+            if not expired:
+                return cached
+
+            with self._single_flight(key):
+                # might be computed by another thread or process meanwhile
+                entry, expired, cached = self._lookup(
+                    key, args, self.incremental)
+                if not expired:
+                    return cached
+
+                if cached is not None:  # i.e. incremental
+                    res = func(*args, cached=cached)
+                    if res is cached:  # nothing changed
+                        _touch(wrapper, args)
+                        return res
+                else:
+                    res = func(*args)
+                self.save(entry.path if entry else
+                          self.get_cache_fname(func.__name__, *args),
+                          res, func.__name__)
             return res
+
+        def cache_fname(*args):
+            return self.find_cache_fname(func.__name__, *args)
+
+        # these allow to fill the cache bypassing the function itself,
+        # e.g. from scraper.github_aio where results are collected elsewhere
+        def expired(*args):
+            return self._expired(mtime(*args), args)
+
+        def store(res, *args):
+            self.save(cache_fname(*args), res, func.__name__)
+
+        def previous(*args):
+            """ Cached result even if it is expired, None if not cached """
+            return self._lookup(self.key(func.__name__, *args), args,
+                                load_expired=True)[2]
+
+        def unchanged(*args):
+            """ Same as returning `cached` from an incremental function:
+            mark cache and caches depending on it as fresh """
+            _touch(wrapper, args)
+
+        def mtime(*args):
+            """ Time of the last update, None if not cached """
+            entry = self.manifest.get(self.key(func.__name__, *args))
+            return entry and entry.mtime
+
+        def touch(*args):
+            """ Mark cache as fresh """
+            key = self.key(func.__name__, *args)
+            entry = self.manifest.get(key)
+            now = time.time()
+            os.utime(entry.path, (now, now))
+            self.manifest.touch(key, now)
+
+        self.registry[(self.cache_path, func.__name__)] = self
+        wrapper.cache_fname = cache_fname
+        wrapper.expired = expired
+        wrapper.store = store
+        wrapper.previous = previous
+        wrapper.unchanged = unchanged
+        wrapper.mtime = mtime
+        wrapper.touch = touch
+        wrapper.depends_on = self.depends_on
+        wrapper.dependents = []
+        for dep in self.depends_on:
+            dep.dependents.append(wrapper)
         return wrapper
 
     def invalidate(self, func):
         """ Remove all files caching this function """
-        for fname in os.listdir(self.cache_path):
-            if fname.startswith(func.__name__):
-                os.remove(os.path.join(self.cache_path, fname))
+        for key, fpath in self.manifest.keys(func.__name__).items():
+            if os.path.isfile(fpath):
+                os.remove(fpath)
+            self.manifest.remove(key)
+            if self.memory is not None:
+                self.memory.remove((self.cache_path, key))
+
+
+def _touch(cached_func, args, mtime=None):
+    """ Mark cache of an @fs_cache'd function as fresh without recomputing.
+    Dependent caches that were computed from the same data and are not
+    outdated by their other dependencies are marked fresh as well """
+    if mtime is None:
+        mtime = cached_func.mtime(*args)
+    cached_func.touch(*args)
+
+    for dependent in cached_func.dependents:
+        dep_mtime = dependent.mtime(*args)
+        if dep_mtime is None or dep_mtime < mtime:  # missing or outdated
+            continue
+        if any((other.mtime(*args) or 0) > dep_mtime
+               for other in dependent.depends_on
+               if other is not cached_func):
+            continue
+        _touch(dependent, args, dep_mtime)
 
 
 def typed_fs_cache(app_name, expires=DEFAULT_EXPIRY):
     # type: (str, int) -> callable
-    def _cache(cache_type, idx=1):
-        return fs_cache(app_name, idx, cache_type=cache_type, expires=expires)
+    def _cache(cache_type, idx=1, incremental=False, depends_on=()):
+        return fs_cache(app_name, idx, cache_type=cache_type, expires=expires,
+                        incremental=incremental, depends_on=depends_on)
 
     return _cache
 
 
-def memoize(func):
-    """ Classical memoize for non-class methods """
-    cache = {}
+_MISSING = object()
+
+
+def _make_key(args, kwargs):
+    # type: (tuple, dict) -> tuple
+    """ Memoization key; arguments of different types are different keys
+
+    >>> _make_key((1,), {}) == _make_key(('1',), {})
+    False
+    """
+    key = tuple((type(arg), arg) for arg in args)
+    if kwargs:
+        key += tuple((name, type(value), value)
+                     for name, value in sorted(kwargs.items()))
+    return key
+
+
+def _cached_call(cache, func, args, kwargs):
+    key = _make_key(args, kwargs)
+    try:
+        res = cache.get(key, _MISSING)
+    except TypeError:  # unhashable arguments, e.g. lists
+        return func(*args, **kwargs)
+    if res is _MISSING:
+        # other threads calling with the same arguments wait for the result
+        with _thread_lock((id(cache), key)):
+            res = cache.peek(key, _MISSING)
+            if res is _MISSING:
+                res = func(*args, **kwargs)
+                cache.put(key, res)
+    return res
+
+
+def memoize(func=None, maxsize=None, ttl=None, max_bytes=None):
+    """ Thread safe memoize for non-class methods, unbounded by default.
+    Use with parameters to limit memory used by cached results, e.g.
+    @memoize(maxsize=2), see LRUCache. Results of concurrent calls with the
+    same arguments are computed once.
+    `func.cache_info()` returns statistics, `func.cache_clear()` releases
+    all cached results.
+    """
+    if func is None:
+        return lambda f: memoize(f, maxsize, ttl, max_bytes)
+    cache = LRUCache(max_bytes, maxsize=maxsize, ttl=ttl)
 
     @wraps(func)
-    def wrapper(*args):
-        key = "__".join(str(arg) for arg in args)
-        if key not in cache:
-            cache[key] = func(*args)
-        return cache[key]
+    def wrapper(*args, **kwargs):
+        return _cached_call(cache, func, args, kwargs)
+
+    wrapper.cache_info = cache.info
+    wrapper.cache_clear = cache.clear
     return wrapper
 
 
-def cached_method(func):
-    """ Classical memoize for non-class methods """
+_cached_method_lock = threading.Lock()
+
+
+def cached_method(func=None, maxsize=None, ttl=None, max_bytes=None):
+    """ Same as memoize, but for class methods. Every instance has its own
+    cache, released with the instance. Statistics are available per instance,
+    e.g. `Package.download.cache_info(package)`
+    """
+    if func is None:
+        return lambda f: cached_method(f, maxsize, ttl, max_bytes)
+
+    def get_cache(self):
+        with _cached_method_lock:
+            caches = getattr(self, "_caches", None)
+            if caches is None:
+                caches = self._caches = {}
+            if func.__name__ not in caches:
+                caches[func.__name__] = LRUCache(
+                    max_bytes, maxsize=maxsize, ttl=ttl)
+            return caches[func.__name__]
+
     @wraps(func)
-    def wrapper(self, *args):
-        if not hasattr(self, "_cache"):
-            self._cache = {}
-        key = "__".join((func.__name__,) + args)
-        if key not in self._cache:
-            self._cache[key] = func(self, *args)
-        return self._cache[key]
+    def wrapper(self, *args, **kwargs):
+        return _cached_call(get_cache(self), partial(func, self), args,
+                            kwargs)
+
+    wrapper.cache_info = lambda self: get_cache(self).info()
+    wrapper.cache_clear = lambda self: get_cache(self).clear()
     return wrapper
 
 
@@ -0,0 +1,112 @@
+from __future__ import print_function, unicode_literals
+
+import logging
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+import pandas as pd
+
+from common import mapreduce
+from scraper import fake_github
+from scraper import github
+import scraper
+
+
+class Command(BaseCommand):
+    requires_system_checks = False
+    help = "Measure scraper throughput against a local fake of GitHub API. " \
+           "No real tokens are used."
+
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--repos', default=100, type=int,
+                            help='Number of repositories to scrape')
+        parser.add_argument('-t', '--tokens', default=4, type=int,
+                            help='Number of (fake) API tokens')
+        parser.add_argument('-w', '--workers', default=None, type=int,
+                            help='Number of workers. By default, it is '
+                                 'adjusted on the fly, same as in build_cache')
+        parser.add_argument('-l', '--latency', default=50, type=int,
+                            help='Server response latency, ms')
+        parser.add_argument('--limit', default=5000, type=int,
+                            help='Requests per token per hour')
+        parser.add_argument('--errors', default=0, type=float,
+                            help='Share of requests failing with 502 or '
+                                 'secondary rate limit')
+        parser.add_argument('--retry-after', default=5, type=int,
+                            help='Retry-After of secondary rate limit, s')
+        parser.add_argument('--seed', default=0, type=int,
+                            help='Random seed for synthetic data')
+
+    def handle(self, *args, **options):
+        loglevel = 40 - 10 * options['verbosity']
+        logging.basicConfig(level=loglevel)
+
+        server = fake_github.FakeGitHub(
+            repos=options['repos'], seed=options['seed'],
+            latency=options['latency'] / 1000.0, limit=options['limit'],
+            errors=options['errors'], retry_after=options['retry_after'])
+        server.start()
+
+        github.GitHubAPIToken.api_url = server.api_url
+        github.GitHubAPI.web_url = server.web_url
+        api = github.GitHubAPI(
+            tokens=["fake%d" % i for i in range(options['tokens'])])
+        for token in api.tokens:
+            # neither responses nor limits of fake tokens should be stored
+            token.http_cache = None
+            token.ledger = None
+
+        controller = None
+        num_workers = options['workers']
+        if not num_workers:
+            controller = scraper.adaptive_controller(
+                1 + options['tokens'] // 2, 128)
+        api.controller = controller
+
+        lock = threading.Lock()
+        finished = []
+
+        def scrape(repo_name, _):
+            start = time.time()
+            records = len(list(api.repo_commits(repo_name))) + \
+                len(list(api.repo_issues(repo_name)))
+            with lock:
+                finished.append(time.time())
+            return {'duration': time.time() - start, 'records': records}
+
+        repos = server.repo_names()
+        start = time.time()
+        try:
+            # ThreadPool shutdown takes a while, so the time is measured
+            # up to the last finished repository
+            stats = mapreduce.map(pd.DataFrame(index=repos), scrape,
+                                  num_workers=num_workers,
+                                  controller=controller)
+        finally:
+            server.stop()
+        elapsed = (max(finished) if finished else time.time()) - start
+
+        counters = server.stats()
+        self.stdout.write(
+            "Scraped %d of %d repositories (%d records) in %.1fs\n"
+            % (len(finished), len(repos), stats['records'].sum(), elapsed))
+        self.stdout.write(
+            "%d requests, %.1f requests/sec, %.1f MB received\n"
+            % (counters['requests'], counters['requests'] / elapsed,
+               counters['bytes'] / 1e6))
+        self.stdout.write("Status codes: %s\n" % ", ".join(
+            "%s: %d" % item for item in sorted(counters['status'].items())))
+        self.stdout.write(
+            "Time to scrape a repository, s: mean %.2f, median %.2f, "
+            "max %.2f\n" % (stats['duration'].mean(),
+                            stats['duration'].median(),
+                            stats['duration'].max()))
+        pool = api.pool_stats()
+        self.stdout.write(
+            "%d connections for %d requests (%.1f%% reused), %d open\n"
+            % (pool['connections'], pool['requests'], pool['reuse'] * 100,
+               pool['open']))
+        if controller is not None:
+            self.stdout.write("Final concurrency: %d\n"
+                              % controller.concurrency)
@@ -8,6 +8,7 @@ from django.core.management.base import BaseCommand
 
 from common import mapreduce
 from common import utils as common
+from scraper import http_cache
 import scraper
 
 
@@ -19,9 +20,24 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('ecosystem', type=str,
                             help='Ecosystem to process, {pypi|npm}')
-        num_tokens = len(getattr(settings, 'SCRAPER_GITHUB_API_TOKENS', []))
-        parser.add_argument('-w', '--workers', default=1+num_tokens//2,
-                            type=int, help='Number of workers to use')
+        parser.add_argument('-w', '--workers', default=None, type=int,
+                            help='Number of workers to use. By default, it '
+                                 'is adjusted on the fly starting from '
+                                 '1+<number of tokens>/2')
+        parser.add_argument('--async', action='store_true', dest='use_async',
+                            help='Use asyncio scraper (Python 3.6+, aiohttp) '
+                                 'instead of threads. In this mode, number of '
+                                 'workers is number of repositories processed '
+                                 'at once, 256 by default')
+        parser.add_argument('--contributor-stats', action='store_true',
+                            help='Only get GitHub contributor statistics, '
+                                 'for approximate (*_approx) commit '
+                                 'features. Takes one request per repository')
+        parser.add_argument('--batch-issues', action='store_true',
+                            help='Get issues of repositories never scraped '
+                                 'before in batched GraphQL queries first. '
+                                 'Most repositories need a fraction of a '
+                                 'request this way')
 
     def handle(self, *args, **options):
         # -v 3: DEBUG, 2: INFO, 1: WARNING (default), 0: ERROR
@@ -29,10 +45,37 @@ class Command(BaseCommand):
         logging.basicConfig(level=loglevel)
         logger = logging.getLogger('ghd')
 
-        num_workers = min(max(options['workers'], 1), 128)
-
         urls = common.package_urls(options['ecosystem'])
 
+        if options['batch_issues']:
+            count = scraper.prefetch_issues(urls)
+            logger.info("Issues of %d repositories were prefetched", count)
+
+        if options['use_async']:
+            from scraper import github_aio
+            github_aio.scrape(urls, concurrency=options['workers'] or 256)
+            self.report()
+            return
+
+        controller = None
+        num_workers = options['workers']
+        if num_workers:
+            num_workers = min(max(num_workers, 1), 128)
+        else:
+            num_tokens = len(
+                getattr(settings, 'SCRAPER_GITHUB_API_TOKENS', []))
+            controller = scraper.adaptive_controller(1 + num_tokens // 2, 128)
+
+        if options['contributor_stats']:
+            not_ready = scraper.prefetch_contributor_stats(
+                urls, num_workers=num_workers, controller=controller)
+            if not_ready:
+                logger.warning("Contributor stats of %d repositories are "
+                               "still being computed by GitHub, please run "
+                               "again later", len(not_ready))
+            self.report()
+            return
+
         def collect_scraper(package, url):
             logger.info(package)
             try:
@@ -42,4 +85,11 @@ class Command(BaseCommand):
                 return
             scraper.issues(url)
 
-        mapreduce.map(urls, collect_scraper, num_workers=num_workers)
+        mapreduce.map(urls, collect_scraper, num_workers=num_workers,
+                      controller=controller)
+        self.report()
+
+    def report(self):
+        cache = http_cache.get_cache()
+        if cache is not None:
+            self.stdout.write(cache.report())
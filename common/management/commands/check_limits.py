@@ -2,10 +2,13 @@
 from __future__ import print_function, unicode_literals
 
 import datetime
+import os
+import time
 
 from django.core.management.base import BaseCommand
 import pandas as pd
 
+from scraper import metrics
 import scraper
 
 
@@ -13,6 +16,11 @@ class Command(BaseCommand):
     requires_system_checks = False
     help = "Check limits on registered GitHub API keys"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--metrics', action='store_true',
+                            help='Also show request metrics of running '
+                                 'and recently finished scrapers')
+
     def handle(self, *args, **options):
         api = scraper.GitHubAPI()
         now = datetime.datetime.now()
@@ -20,7 +28,8 @@ class Command(BaseCommand):
         df = pd.DataFrame(
             columns=("core_limit", "core_remaining",
                      "core_renews_in", "search_limit", "search_remaining",
-                     "search_renews_in", "key"))
+                     "search_renews_in", "graphql_limit", "graphql_remaining",
+                     "graphql_renews_in", "key"))
         for token in api.tokens:
             # if limit is exhausted there is no way to get username
             user = token.user or "<unknown%d>" % len(df)
@@ -41,3 +50,40 @@ class Command(BaseCommand):
             df.loc[user] = values
 
         print(df)
+
+        if options['metrics']:
+            self.show_metrics()
+
+    def show_metrics(self):
+        snapshots = [s for s in metrics.load_snapshots()
+                     if s['pid'] != os.getpid()]
+        if not snapshots:
+            print("\nNo metrics found in %s" % metrics.default_path())
+        now = time.time()
+        for s in snapshots:
+            print("\nProcess %d, running for %dm, updated %ds ago" % (
+                s['pid'], (s['updated'] - s['started']) / 60,
+                now - s['updated']))
+            for api_class, endpoints in sorted(s['requests'].items()):
+                for endpoint, r in sorted(endpoints.items()):
+                    print("    %s/%s: %d requests, %.1f MB, latency mean "
+                          "%.2fs, median <%gs, 95%% <%gs" % (
+                              api_class, endpoint, r['count'],
+                              r['bytes'] / 1e6, r['sum'] / r['count'],
+                              metrics.quantile(r['buckets'], 0.5),
+                              metrics.quantile(r['buckets'], 0.95)))
+            for title, values, fmt in (
+                    ('status codes', s['status'], "%s: %d"),
+                    ('retries', s['retries'], "%s: %d"),
+                    ('waiting for quota', s['sleep'], "%s: %ds")):
+                if values:
+                    print("    %s: %s" % (title, ", ".join(
+                        fmt % item for item in sorted(values.items()))))
+            if s['timers']:
+                print("    processing time: %s" % ", ".join(
+                    "%s: %.1fs" % (stage, t['seconds'])
+                    for stage, t in sorted(s['timers'].items())))
+            for token, classes in sorted(s['quota'].items()):
+                print("    token %s used %s" % (token, ", ".join(
+                    "%d %s" % (q['used'], api_class)
+                    for api_class, q in sorted(classes.items()))))
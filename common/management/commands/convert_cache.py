@@ -0,0 +1,127 @@
+from __future__ import print_function, unicode_literals
+
+import logging
+import multiprocessing
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from common import decorators
+from common import manifest
+# cached functions are registered on import
+from common import utils as common  # noqa: F401
+import scraper  # noqa: F401
+try:
+    import so.utils  # noqa: F401
+except ImportError:  # requires libarchive
+    pass
+
+
+def find_cache(fpath):
+    # type: (str) -> decorators.fs_cache
+    """ Get fs_cache instance which created the file, None if unknown """
+    path, fname = os.path.split(os.path.abspath(fpath))
+    if manifest.SHARD_PATTERN.match(os.path.basename(path)):
+        path = os.path.dirname(path)
+    name = os.path.splitext(fname)[0]
+    matches = [(func_name, cache) for (cache_path, func_name), cache
+               in decorators.fs_cache.registry.items()
+               if os.path.abspath(cache_path) == path
+               and (name == func_name or name.startswith(func_name + "."))]
+    if not matches:
+        return None
+    # the longest name, e.g. commits_frame rather than commits
+    return max(matches, key=lambda match: len(match[0]))[1]
+
+
+def convert(args):
+    # type: ((str, object, bool)) -> (str, str, int)
+    """ Convert a cache file, preserving its mtime so that it does not
+    become fresh or outdated relative to its dependencies
+    :return: (fpath, status, saved bytes), status is one of
+        converted, unknown (not an fs_cache file) or failed
+    """
+    fpath, backend, keep = args
+    cache = find_cache(fpath)
+    if cache is None:
+        return fpath, 'unknown', 0
+    stat = os.stat(fpath)
+    key = os.path.splitext(os.path.basename(fpath))[0]
+    new_fpath = os.path.splitext(fpath)[0] + "." + backend.extension
+    try:
+        res = cache.load(fpath)
+        backend.save(new_fpath, res)
+    # e.g. columns of mixed types, see fs_cache.save()
+    except (ValueError, TypeError, NotImplementedError):
+        if os.path.isfile(new_fpath):
+            os.remove(new_fpath)
+        return fpath, 'failed', 0
+    os.utime(new_fpath, (stat.st_atime, stat.st_mtime))
+    # files not in the manifest are stale copies, e.g. left by --keep
+    entry = cache.manifest.get(key)
+    if entry is None or entry.path == os.path.abspath(fpath):
+        cache.manifest.put(key, new_fpath, manifest.schema(res))
+    if not keep:
+        os.remove(fpath)
+    return fpath, 'converted', stat.st_size - os.path.getsize(new_fpath)
+
+
+class Command(BaseCommand):
+    requires_system_checks = False
+    help = "Convert existing fs_cache files into another format, Parquet by " \
+           "default. Files not produced by @fs_cache are left as is."
+
+    def add_arguments(self, parser):
+        parser.add_argument('-f', '--format', default=None, type=str,
+                            help='Target format, {parquet|feather|csv}. By '
+                                 'default, the one used by fs_cache')
+        parser.add_argument('-p', '--processes', default=None, type=int,
+                            help='Number of processes, number of CPUs by '
+                                 'default')
+        parser.add_argument('--keep', action='store_true',
+                            help="Don't remove the original files. Note that "
+                                 "files in the preferred format are used "
+                                 "first")
+        parser.add_argument('--path', default=decorators.DATASET_PATH,
+                            help='Root of the cache folders')
+
+    def handle(self, *args, **options):
+        loglevel = 40 - 10 * options['verbosity']
+        logging.basicConfig(level=loglevel)
+        logger = logging.getLogger('ghd')
+
+        backend = decorators.get_backend(options['format'])
+        if options['format'] not in (None, backend.extension):
+            raise CommandError("pyarrow is required to use %s format"
+                               % options['format'])
+
+        files = []
+        for root, _, fnames in os.walk(options['path']):
+            for fname in fnames:
+                extension = os.path.splitext(fname)[1][1:]
+                if extension in decorators.BACKENDS \
+                        and extension != backend.extension:
+                    files.append((os.path.join(root, fname), backend,
+                                  options['keep']))
+
+        counts = {'converted': 0, 'unknown': 0, 'failed': 0}
+        saved = 0
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            for i, (fpath, status, size) in enumerate(
+                    pool.imap_unordered(convert, files, 16)):
+                counts[status] += 1
+                saved += size
+                if status != 'converted':
+                    logger.debug("%s: %s, skipped", fpath, status)
+                if (i + 1) % 1000 == 0:
+                    logger.info("%d of %d files processed", i + 1, len(files))
+        finally:
+            pool.close()
+            pool.join()
+
+        self.stdout.write(
+            "%d files converted to %s, %.1f MB saved; %d files are not "
+            "fs_cache ones, %d can't be stored as %s and were left as is\n"
+            % (counts['converted'], backend.extension, saved / 1e6,
+               counts['unknown'], counts['failed'], backend.extension))
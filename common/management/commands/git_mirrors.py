@@ -0,0 +1,53 @@
+from __future__ import print_function, unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+import pandas as pd
+
+from common import utils as common
+from scraper import gitlog
+
+
+class Command(BaseCommand):
+    requires_system_checks = False
+    help = "Report disk usage of git mirrors used by git commits backend " \
+           "and remove the ones not used by any of the given ecosystems."
+
+    def add_arguments(self, parser):
+        parser.add_argument('ecosystems', nargs='*', type=str,
+                            help='Ecosystems to keep repositories of, '
+                                 '{pypi|npm}')
+        parser.add_argument('--evict', action='store_true',
+                            help='Remove mirrors of repositories not used by '
+                                 'the given ecosystems')
+        parser.add_argument('-n', '--top', default=10, type=int,
+                            help='Number of the largest mirrors to show')
+
+    def handle(self, *args, **options):
+        if options['evict'] and not options['ecosystems']:
+            raise CommandError("At least one ecosystem is required to evict "
+                               "mirrors, otherwise all of them will be gone")
+
+        sizes = pd.Series({url: gitlog.disk_usage(path)
+                           for url, path in gitlog.mirrors().items()})
+        self.stdout.write("%d mirrors, %.1f MB total\n"
+                          % (len(sizes), sizes.sum() / 1e6))
+        if sizes.empty:
+            return
+
+        self.stdout.write("Largest mirrors, MB:\n")
+        for url, size in sizes.nlargest(options['top']).items():
+            self.stdout.write("    %s: %.1f\n" % (url, size / 1e6))
+
+        if not options['ecosystems']:
+            return
+        keep = set()
+        for ecosystem in options['ecosystems']:
+            keep.update(common.package_urls(ecosystem))
+        unused = sizes[~sizes.index.isin(keep)]
+        self.stdout.write("%d mirrors (%.1f MB) are not used by %s\n" % (
+            len(unused), unused.sum() / 1e6, ", ".join(options['ecosystems'])))
+
+        if options['evict']:
+            removed = gitlog.evict(keep)
+            self.stdout.write("Removed %d mirrors, %.1f MB freed\n"
+                              % (len(removed), sum(removed.values()) / 1e6))
@@ -0,0 +1,68 @@
+from __future__ import print_function, unicode_literals
+
+import glob
+import logging
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from common import utils as common
+from scraper import gharchive
+import scraper
+
+
+class Command(BaseCommand):
+    requires_system_checks = False
+    help = "Extract issues and pushed commits of the ecosystem repositories " \
+           "from locally stored GH Archive files (gharchive.org). " \
+           "No network access is required."
+
+    def add_arguments(self, parser):
+        parser.add_argument('ecosystem', type=str,
+                            help='Ecosystem to process, {pypi|npm}')
+        parser.add_argument('paths', nargs='+', type=str,
+                            help='GH Archive .json.gz files, or folders '
+                                 'containing them')
+        parser.add_argument('-p', '--processes', default=None, type=int,
+                            help='Number of processes, number of CPUs by '
+                                 'default')
+        parser.add_argument('--store-issues', action='store_true',
+                            help='Also put issues into the issues cache '
+                                 'of repositories that were never scraped, '
+                                 'so that they are not requested from API. '
+                                 'Only makes sense if archive files cover '
+                                 'the whole lifetime of the repositories')
+
+    def handle(self, *args, **options):
+        loglevel = 40 - 10 * options['verbosity']
+        logging.basicConfig(level=loglevel)
+
+        paths = []
+        for path in options['paths']:
+            if os.path.isdir(path):
+                paths.extend(glob.glob(os.path.join(path, '*.json.gz')))
+            else:
+                paths.append(path)
+        if not paths:
+            raise CommandError("No GH Archive files found")
+
+        ecosystem = options['ecosystem']
+        urls = common.package_urls(ecosystem)
+        issues, pushes = gharchive.ingest(paths, urls.values,
+                                          options['processes'])
+        issues.to_csv(gharchive.cache_path(ecosystem, 'issues'),
+                      encoding='utf8', header=True)
+        pushes.to_csv(gharchive.cache_path(ecosystem, 'pushes'),
+                      encoding='utf8', header=True)
+        self.stdout.write(
+            "%d files processed: %d issues, %d pushed commits\n" % (
+                len(paths), len(issues), pushes.sum()))
+
+        if options['store_issues']:
+            count = 0
+            for url, df in issues.groupby(level=0):
+                if scraper.issues.mtime(url) is None:
+                    scraper.issues.store(df.loc[url], url)
+                    count += 1
+            self.stdout.write("Issues of %d repositories were cached\n"
+                              % count)
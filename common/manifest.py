@@ -0,0 +1,192 @@
+""" Index of fs_cache files
+
+With hundreds of thousands of cached results in a folder, checking a cache
+(isfile + getmtime) and listing the folder dominate the run time.
+Manifest is an SQLite table keyed by cache key (<function>.<arguments>)
+holding the file path (relative to the cache folder), size, mtime and schema
+(type, index and column dtypes) of every cached result, so that these checks
+are single index lookups.
+
+Every cache folder (e.g. scraper.cache/raw) has its own manifest,
+manifest.sqlite. Files are spread over 256 subfolders named by the first
+two hex digits of the key hash (see shard()).
+When a manifest is created, existing files in the folder are indexed,
+including ones in the flat (unsharded) layout; they are left where they are.
+Files removed manually are dropped from the manifest when they fail to load;
+to reindex a folder from scratch, just remove its manifest.sqlite.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+
+FNAME = 'manifest.sqlite'
+SHARD_PATTERN = re.compile(r'^[0-9a-f]{2}$')
+
+Entry = collections.namedtuple('Entry', 'path size mtime schema')
+
+
+def shard(key):
+    # type: (str) -> str
+    """ Subfolder for a cache key
+
+    >>> shard("commits.github.com.pandas-dev.pandas")
+    '54'
+    """
+    return hashlib.sha1(key.encode('utf8')).hexdigest()[:2]
+
+
+def schema(res):
+    # type: (object) -> str
+    """ Short description of a pd.Series or pd.DataFrame, as stored in the
+    manifest. Column dtypes are only listed for dataframes
+
+    >>> import pandas as pd
+    >>> schema(pd.Series([1], name='count'))
+    '{"type": "series", "index": [null], "dtype": "int64"}'
+    """
+    desc = collections.OrderedDict()
+    if hasattr(res, 'columns'):
+        desc['type'] = 'frame'
+        desc['index'] = list(res.index.names)
+        desc['columns'] = collections.OrderedDict(
+            (str(column), str(dtype)) for column, dtype in res.dtypes.items())
+    else:
+        desc['type'] = 'series'
+        desc['index'] = list(res.index.names)
+        desc['dtype'] = str(res.dtype)
+    return json.dumps(desc, default=str)
+
+
+class Manifest(object):
+    """ Thread and process safe (SQLite) index of a cache folder """
+    path = None  # cache folder
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._transaction() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, path TEXT, size INTEGER, mtime REAL,
+                schema TEXT)""")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY)")
+        self._index_existing()
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads,
+        # nor inherited by forked processes
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.db = sqlite3.connect(
+                os.path.join(self.path, FNAME), timeout=60,
+                isolation_level=None)  # transactions are managed explicitly
+            self._local.db.execute("PRAGMA journal_mode=WAL")
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def _transaction(self):
+        return Transaction(self._connection())
+
+    def _index_existing(self):
+        """ Add files created before the manifest, done once per folder """
+        from common import decorators  # circular import
+        with self._transaction() as db:
+            if db.execute("SELECT 1 FROM meta WHERE key = 'indexed'"
+                          ).fetchone():
+                return
+            records = []
+            for dirname in [''] + sorted(os.listdir(self.path)):
+                if dirname and not SHARD_PATTERN.match(dirname):
+                    continue
+                dirpath = os.path.join(self.path, dirname)
+                if not os.path.isdir(dirpath):
+                    continue
+                for fname in os.listdir(dirpath):
+                    key, ext = os.path.splitext(fname)
+                    if ext[1:] not in decorators.BACKENDS:
+                        continue
+                    stat = os.stat(os.path.join(dirpath, fname))
+                    records.append((key, os.path.join(dirname, fname),
+                                    stat.st_size, stat.st_mtime))
+            # if there are several formats of the same key, the preferred
+            # one is kept; sort so that it is inserted last
+            order = list(decorators.BACKENDS)
+            records.sort(key=lambda r: -order.index(
+                os.path.splitext(r[1])[1][1:]))
+            db.executemany("INSERT OR REPLACE INTO entries (key, path, size, "
+                           "mtime) VALUES (?, ?, ?, ?)", records)
+            db.execute("INSERT INTO meta VALUES ('indexed')")
+
+    def get(self, key):
+        # type: (str) -> Entry
+        """ Get entry with absolute path, None if there is no such key """
+        row = self._connection().execute(
+            "SELECT path, size, mtime, schema FROM entries WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+        return Entry(os.path.join(self.path, row[0]), *row[1:])
+
+    def put(self, key, fpath, schema=None):
+        # type: (str, str, str) -> None
+        """ Record a file just written """
+        stat = os.stat(fpath)
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                       (key, os.path.relpath(fpath, self.path), stat.st_size,
+                        stat.st_mtime, schema))
+
+    def touch(self, key, mtime):
+        # type: (str, float) -> None
+        with self._transaction() as db:
+            db.execute("UPDATE entries SET mtime = ? WHERE key = ?",
+                       (mtime, key))
+
+    def remove(self, key):
+        # type: (str) -> None
+        with self._transaction() as db:
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def keys(self, func_name):
+        # type: (str) -> dict
+        """ All cached results of a function, {key: absolute path} """
+        # keys are <func_name> or <func_name>.<args>; '/' follows '.'
+        rows = self._connection().execute(
+            "SELECT key, path FROM entries WHERE key = ? OR "
+            "(key > ? AND key < ?)",
+            (func_name, func_name + ".", func_name + "/")).fetchall()
+        return {key: os.path.join(self.path, path) for key, path in rows}
+
+
+class Transaction(object):
+    """ BEGIN IMMEDIATE ... COMMIT, so that concurrent writers wait for
+    each other instead of failing on lock upgrade. Unlike the default
+    sqlite3 connection context manager, it prevents concurrent
+    read-modify-write. Also used by scraper.ledger """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.db.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(path):
+    # type: (str) -> Manifest
+    """ Shared Manifest instance of a cache folder """
+    path = os.path.abspath(path)
+    with _manifests_lock:
+        if path not in _manifests:
+            _manifests[path] = Manifest(path)
+        return _manifests[path]
@@ -6,8 +6,16 @@ import collections
 from common import threadpool
 
 
-def map(data, func, num_workers=None):
-    backend = threadpool.ThreadPool(n_workers=num_workers)
+def map(data, func, num_workers=None, controller=None):
+    """
+    :param data: an iterable, pd.Series or pd.DataFrame
+    :param func: callable accepting key and value (e.g. index and row)
+    :param num_workers: fixed number of threads
+    :param controller: threadpool.AIMDController to adjust number of threads
+        on the fly. If specified, num_workers is ignored
+    """
+    backend = threadpool.ThreadPool(n_workers=num_workers,
+                                    controller=controller)
     iterable = None
     # pd.Series didn't have .items() until pandas 0.21,
     # so iteritems for older versions
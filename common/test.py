@@ -1,15 +1,25 @@
 
 from __future__ import unicode_literals, print_function
 
-import unittest
+import os
 import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
 
 import pandas as pd
 import numpy as np
+import requests
 
 from common import decorators as d
+from common import manifest
+from common import threadpool
 from common import utils as common
 from common import email
+from scraper import fake_github
+from scraper import github
 
 
 def series(length, *args):
@@ -36,9 +46,52 @@ class TestDecorators(unittest.TestCase):
         self.assertEquals(mtest('one', 'two'), mtest('one', 'two'))
         self.assertNotEquals(mtest('one', 'two'), mtest('two', 'one'))
 
+    def test_memoize_bounded(self):
+        calls = []
+
+        @d.memoize(maxsize=2)
+        def test(arg):
+            calls.append(arg)
+            return random.random()
+
+        self.assertNotEqual(test(1), test('1'))  # typed keys
+        self.assertEqual(test(1), test(1))
+        test(2)  # evicts '1'
+        test('1')
+        self.assertEqual(calls, [1, '1', 2, '1'])
+        self.assertEqual(test.cache_info()[:4], (2, 4, 2, 2))
+        test.cache_clear()
+        self.assertEqual(test.cache_info().items, 0)
+
+        @d.memoize(ttl=0)
+        def expiring():
+            calls.append(None)
+
+        expiring()
+        expiring()
+        self.assertEqual(calls[-2:], [None, None])
+
+    def test_memoize_threads(self):
+        calls = []
+
+        @d.memoize
+        def slow(arg):
+            calls.append(arg)
+            time.sleep(0.1)
+            return arg
+
+        threads = [threading.Thread(target=slow, args=(1,))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+
     def test_cached_method(self):
         self.assertEquals(self.rand('one', 'two'), self.rand('one', 'two'))
         self.assertNotEquals(self.rand('one', 'two'), self.rand('two', 'one'))
+        self.assertEqual(TestDecorators.rand.cache_info(self).items, 2)
 
     def test_fs_cache(self):
         decorator = d.fs_cache('common')
@@ -58,6 +111,337 @@ class TestDecorators(unittest.TestCase):
 
         decorator.invalidate(cdataframe)
 
+    def test_fs_cache_dependencies(self):
+        calls = {'raw': 0, 'derived': 0}
+
+        # always expired, but never changes
+        @d.fs_cache('common', expires=-1, incremental=True)
+        def _raw(length, cached=None):
+            calls['raw'] += 1
+            if cached is not None:
+                return cached
+            return series(length)
+
+        @d.fs_cache('common', depends_on=(_raw,))
+        def _derived(length):
+            calls['derived'] += 1
+            return _raw(length).cumsum()
+
+        first = _derived(10)
+        second = _derived(10)
+        self.assertEqual(0, (first != second).values.sum())
+        self.assertEqual(calls['derived'], 1)
+        self.assertGreater(calls['raw'], 1)
+
+        d.fs_cache('common').invalidate(_raw)
+        d.fs_cache('common').invalidate(_derived)
+
+    @unittest.skipIf(d.pyarrow is None, "pyarrow is not installed")
+    def test_fs_cache_formats(self):
+        calls = []
+        df = pd.DataFrame(
+            {'count': [1, 2], 'share': [0.5, None], 'name': ['x', None]},
+            index=pd.MultiIndex.from_tuples([('a', '2018-01'), ('b', '01')],
+                                            names=['project', 'month']))
+
+        def _frame(name):
+            calls.append(name)
+            return df if name == 'frame' else df['count'].rename(None)
+
+        cache = d.fs_cache('common', 2, backend='parquet')
+        cframe = cache(_frame)
+        pd.testing.assert_frame_equal(cframe('frame'), df)
+        pd.testing.assert_frame_equal(cframe('frame'), df)
+        self.assertEqual(calls, ['frame'])
+        self.assertTrue(cframe.cache_fname('frame').endswith('.parquet'))
+        pd.testing.assert_series_equal(cframe('series'),
+                                       df['count'].rename(None))
+        pd.testing.assert_series_equal(cframe('series'),
+                                       df['count'].rename(None))
+
+        # mixed types can't be stored in Parquet
+        cframe.store(pd.Series(['a', 1]), 'mixed')
+        self.assertTrue(cframe.cache_fname('mixed').endswith('.csv'))
+        self.assertEqual(calls, ['frame', 'series'])
+        cache.invalidate(cframe)
+        self.assertIsNone(cframe.mtime('frame'))
+
+    def test_fs_cache_memory(self):
+        # the same dtypes in all formats, so that the size does not change
+        df = pd.DataFrame({'x': range(10), 'y': range(10)},
+                          index=list('abcdefghij'))
+        cache = d.fs_cache('common', memory=d.sizeof(df) * 2)
+
+        @cache
+        def _frame(name):
+            return df
+
+        for name in ('a', 'b', 'c'):
+            _frame(name)
+        self.assertEqual(len(cache.memory), 0)  # computed, not read
+
+        for name in ('a', 'b', 'a', 'c', 'a'):
+            res = _frame(name)
+            res['x'] = -1  # results in memory are not affected
+        # 'b' is evicted by 'c', since 'a' was used more recently
+        self.assertEqual(cache.memory.info()[:4], (2, 3, 1, 2))
+        self.assertGreaterEqual(_frame('a')['x'].min(), 0)
+
+        # updates are not shadowed by the old version
+        _frame.store(df * 2, 'a')
+        pd.testing.assert_frame_equal(
+            _frame('a'), cache.load(_frame.cache_fname('a')))
+        cache.invalidate(_frame)
+        self.assertEqual(len(cache.memory), 0)
+
+    def test_fs_cache_single_flight(self):
+        calls = []
+        cache = d.fs_cache('common')
+
+        @cache
+        def _slow(length):
+            calls.append(length)
+            time.sleep(0.2)
+            return series(length)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(_slow(10)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [10])
+        for res in results[1:]:
+            self.assertEqual(list(res), list(results[0]))
+        # no lock files or temporary files left
+        shard = os.path.dirname(_slow.cache_fname(10))
+        self.assertEqual(
+            [fname for fname in os.listdir(shard) if '_slow' in fname],
+            [os.path.basename(_slow.cache_fname(10))])
+        self.assertEqual(d._thread_locks, {})
+        cache.invalidate(_slow)
+
+    def test_fs_cache_legacy(self):
+        # caches created before the manifest, i.e. flat folder of csv files,
+        # are used and moved into shards on update
+        path = tempfile.mkdtemp()
+        try:
+            cache = d.fs_cache('common', ds_path=path)
+            cseries = cache(series)
+            csv_fname = os.path.join(cache.cache_path, 'series.10.csv')
+            d.BACKENDS['csv'].save(csv_fname, pd.Series(range(10)))
+            self.assertEqual(cseries.cache_fname(10), csv_fname)
+            self.assertEqual(list(cseries(10)), list(range(10)))
+
+            cseries.store(pd.Series(range(5)), 10)
+            self.assertFalse(os.path.isfile(csv_fname))
+            self.assertEqual(list(cseries(10)), list(range(5)))
+            self.assertEqual(os.path.dirname(cseries.cache_fname(10)),
+                             os.path.join(cache.cache_path,
+                                          manifest.shard('series.10')))
+        finally:
+            shutil.rmtree(path)
+
+
+class TestAIMDController(unittest.TestCase):
+    def test_increase(self):
+        c = threadpool.AIMDController(initial=2, maximum=4)
+        # roughly +1 per round of `limit` successful calls
+        for _ in range(3):
+            c.success()
+        self.assertEqual(c.concurrency, 3)
+        for _ in range(3):
+            c.success()
+        self.assertEqual(c.concurrency, 4)
+        for _ in range(20):
+            c.success()
+        self.assertEqual(c.concurrency, 4)
+
+    def test_backoff(self):
+        c = threadpool.AIMDController(initial=8, minimum=3, cooldown=0)
+        c.backoff()
+        self.assertEqual(c.concurrency, 4)
+        c.backoff()
+        self.assertEqual(c.concurrency, 3)
+        # other failures within cooldown are from requests in flight
+        c = threadpool.AIMDController(initial=8, cooldown=60)
+        c.backoff()
+        c.backoff()
+        self.assertEqual(c.concurrency, 4)
+
+    def test_latency(self):
+        c = threadpool.AIMDController(initial=4, latency_factor=2)
+        for _ in range(5):
+            c.success(0.1)
+        self.assertEqual(c.concurrency, 5)
+        # the service is saturated, the limit is held
+        for _ in range(20):
+            c.success(1)
+        limit = c.concurrency
+        for _ in range(10):
+            c.success(1)
+        self.assertEqual(c.concurrency, limit)
+        self.assertLess(limit, 10)
+
+    def test_acquire(self):
+        c = threadpool.AIMDController(initial=2)
+        c.acquire()
+        c.acquire()
+        acquired = threading.Event()
+
+        def worker():
+            c.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        # the limit is reached, so the third worker waits
+        self.assertFalse(acquired.wait(0.2))
+        c.release()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEqual(c.active, 2)
+        # an increased limit lets waiting workers in
+        c = threadpool.AIMDController(initial=1)
+        c.acquire()
+        acquired.clear()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        self.assertFalse(acquired.wait(0.2))
+        c.success()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+
+class TestUtils(unittest.TestCase):
+    def test_map_batches(self):
+        calls = []
+
+        def resolve(batch):
+            calls.append(batch)
+            if batch == ['a', 'b', 'c'] and calls.count(batch) == 1:
+                raise IOError("transient error")
+            if 'broken' in batch and len(batch) > 1:
+                raise ValueError("query failed")
+            return [item.upper() for item in batch if item != 'missing']
+
+        items = ['a', 'b', 'c', 'broken', 'missing', 'd']
+        self.assertEqual(common.map_batches(resolve, items, 3),
+                         ['A', 'B', 'C', 'BROKEN', 'D'])
+        # retried once, then all attempts and one by one
+        self.assertEqual(calls.count(['a', 'b', 'c']), 2)
+        self.assertEqual(calls.count(['broken', 'missing', 'd']),
+                         common.BATCH_ATTEMPTS)
+        self.assertIn(['missing'], calls)
+
+        def broken(batch):
+            if 'broken' in batch:
+                raise ValueError("query failed")
+            return batch
+        # partial results are not returned, so they can't be cached
+        with self.assertRaises(ValueError):
+            common.map_batches(broken, items, 3)
+
+    def test_package_urls(self):
+        server = fake_github.FakeGitHub(repos=3).start()
+        api_url = github.GitHubAPIToken.api_url
+        github.GitHubAPIToken.api_url = server.api_url
+        repos_info = github.GitHubAPIv4.repos_info
+        path = tempfile.mkdtemp()
+        cache_path = common.fs_cache.cache_path
+        common.fs_cache.cache_path = path
+
+        class Ecosystem(object):
+            @staticmethod
+            def packages_info():
+                return pd.DataFrame({'url': [
+                    "https://github.com/org0/repo0", "github.com/org1/repo1",
+                    "github.com/missing/repo"]}, index=['a', 'b', 'c'])
+
+        def failing(api, repo_names):
+            if 'org1/repo1' in repo_names:
+                raise requests.HTTPError("GraphQL query failed")
+            return repos_info(api, repo_names)
+
+        common.ECOSYSTEMS['test'] = Ecosystem
+        try:
+            tokens = common.scraper.utils._graphql_provider().tokens
+            # missing repositories are dropped
+            self.assertEqual(common.package_urls('test').to_dict(),
+                             {'a': 'github.com/org0/repo0',
+                              'b': 'github.com/org1/repo1'})
+            # the shared GraphQL client is reused, not reinitialized
+            self.assertIs(github.GitHubAPIv4._instance.tokens, tokens)
+            # concurrency of other scrapers is not affected
+            self.assertIsNone(github.GitHubAPIv4._instance.controller)
+            self.assertIsNone(
+                common.scraper.PROVIDERS['github.com'].controller)
+            common.fs_cache.cache_path = tempfile.mkdtemp(dir=path)
+            # a transient error of one repository fails its batch,
+            # which is retried
+            server.graphql_errors['org1/repo1'] = 1
+            self.assertEqual(common.package_urls('test').to_dict(),
+                             {'a': 'github.com/org0/repo0',
+                              'b': 'github.com/org1/repo1'})
+            common.fs_cache.cache_path = tempfile.mkdtemp(dir=path)
+            # errors are not mistaken for missing repositories
+            github.GitHubAPIv4.repos_info = failing
+            with self.assertRaises(requests.HTTPError):
+                common.package_urls('test')
+            self.assertIsNone(common.package_urls.mtime('test'))
+        finally:
+            del common.ECOSYSTEMS['test']
+            github.GitHubAPIv4.repos_info = repos_info
+            github.GitHubAPIToken.api_url = api_url
+            common.fs_cache.cache_path = cache_path
+            server.stop()
+            shutil.rmtree(path)
+
+    def test_user_info(self):
+        server = fake_github.FakeGitHub(repos=3).start()
+        api_url = github.GitHubAPIToken.api_url
+        github.GitHubAPIToken.api_url = server.api_url
+        path = tempfile.mkdtemp()
+        cache_path = common.fs_cache.cache_path
+        common.fs_cache.cache_path = path
+
+        class Ecosystem(object):
+            @staticmethod
+            def packages_info():
+                return pd.DataFrame({'url': [
+                    "github.com/org0/repo0", "github.com/org1/repo1",
+                    "github.com/org2/repo2"]}, index=['a', 'b', 'c'])
+
+        common.ECOSYSTEMS['test'] = Ecosystem
+        try:
+            # a transient error of one account fails its batch,
+            # which is retried
+            server.graphql_errors['org1'] = 1
+            tokens = common.scraper.utils._graphql_provider().tokens
+            ui = common.user_info('test')
+            # the shared GraphQL client is reused, not reinitialized
+            self.assertIs(github.GitHubAPIv4._instance.tokens, tokens)
+            self.assertEqual(sorted(ui.index), ['a', 'b', 'c'])
+            self.assertTrue(ui['org'].all())
+            for package, login in (('a', 'org0'), ('b', 'org1')):
+                self.assertEqual(ui.loc[package, 'public_repos'],
+                                 server.user(login)['public_repos'])
+            self.assertIsNone(github.GitHubAPIv4._instance.controller)
+
+            # accounts that could not be resolved are not cached as missing
+            common.fs_cache.invalidate(common.user_info)
+            server.graphql_errors['org2'] = 100
+            with self.assertRaises(requests.HTTPError):
+                common.user_info('test')
+            self.assertIsNone(common.user_info.mtime('test'))
+        finally:
+            del common.ECOSYSTEMS['test']
+            github.GitHubAPIToken.api_url = api_url
+            common.fs_cache.cache_path = cache_path
+            server.stop()
+            shutil.rmtree(path)
+
 
 if __name__ == "__main__":
     unittest.main()
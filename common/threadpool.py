@@ -3,19 +3,100 @@ import logging
 import multiprocessing
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor  # futures on Python 2
 
 CPU_COUNT = multiprocessing.cpu_count()
 
 
+class AIMDController(object):
+    """ Adaptive concurrency limit: additive increase, multiplicative decrease
+
+    Instead of guessing a safe number of workers, let workers report how
+    their requests go:
+        - success(latency): every `limit` successful calls increase the limit
+            by one, i.e. +1 per "round" of requests. While average latency
+            is over `latency_factor` times its lowest observed value, the
+            service is saturated and the limit is held instead.
+        - backoff(): throttling, Retry-After, timeouts etc. The limit is
+            multiplied by `decrease`, at most once per `cooldown` seconds,
+            since requests in flight will likely fail as well.
+    ThreadPool uses acquire()/release() to run at most `limit` tasks at once.
+
+    >>> c = AIMDController(initial=4, maximum=8)
+    >>> for _ in range(5): c.success()
+    >>> c.concurrency
+    5
+    >>> c.backoff()
+    >>> c.concurrency
+    2
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, decrease=0.5,
+                 latency_factor=3.0, cooldown=5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.latency = None  # exponentially weighted average
+        self.base_latency = None  # the lowest average latency observed
+        self.last_backoff = 0
+        self.active = 0
+        self.condition = threading.Condition()
+
+    @property
+    def concurrency(self):
+        return int(self.limit)
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.concurrency:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def success(self, latency=None):
+        with self.condition:
+            if latency is not None:
+                self.latency = latency if self.latency is None \
+                    else 0.9 * self.latency + 0.1 * latency
+                self.base_latency = min(self.base_latency or self.latency,
+                                        self.latency)
+                if self.latency > self.base_latency * self.latency_factor:
+                    return
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+    def backoff(self):
+        with self.condition:
+            now = time.time()
+            if now - self.last_backoff < self.cooldown:
+                return
+            self.last_backoff = now
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            logging.getLogger('ghd').info(
+                "Backing off, concurrency is set to %d", self.concurrency)
+
+
 class ThreadPool(object):
     _threads = []
 
-    def __init__(self, n_workers=None):
+    def __init__(self, n_workers=None, controller=None):
         # the only reason to use threadpool in Python is IO (because of GIL)
         # so, we're not really limited with CPU and twice as many threads
         # is usually fine
-        self.n = n_workers or CPU_COUNT * 2
-        self.exec_semaphore = threading.BoundedSemaphore(self.n)
+        self.controller = controller
+        if controller is not None:
+            self.n = controller.maximum
+            self.exec_semaphore = controller
+        else:
+            self.n = n_workers or CPU_COUNT * 2
+            self.exec_semaphore = threading.BoundedSemaphore(self.n)
         self.callback_semaphore = threading.Lock()
 
     def submit(self, func, *args, **kwargs):
@@ -70,3 +151,19 @@ class ThreadPool(object):
 
         # TODO: check exec semaphore instead
         time.sleep(10)
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def shared_executor(name, n_workers):
+    # type: (str, int) -> ThreadPoolExecutor
+    """ Process-wide pool of `n_workers` threads, created on first use.
+    Unlike ThreadPool, threads are reused and results (or exceptions) are
+    returned to the caller via futures. Tasks should not wait for other
+    tasks of the same pool, or the pool might deadlock """
+    with _executors_lock:
+        if name not in _executors:
+            _executors[name] = ThreadPoolExecutor(n_workers)
+        return _executors[name]
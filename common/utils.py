@@ -7,11 +7,14 @@ import pandas as pd
 from collections import defaultdict
 import datetime
 import logging
+import time
 
 from common import decorators as d
 from common import mapreduce
+from common import threadpool
 from common import versions
 import scraper
+from scraper import gharchive
 
 # ecosystems
 import npm
@@ -78,6 +81,73 @@ def get_ecosystem(ecosystem):
     return ECOSYSTEMS[ecosystem]
 
 
+# a failed GraphQL batch is tried this many times, then it is split into
+# single item requests, tried as many times each
+BATCH_ATTEMPTS = 3
+
+
+def map_batches(func, items, batch_size, controller=None):
+    # type: (callable, list, int, object) -> list
+    """ Apply a batched request to items, batch_size items per request,
+    concurrently. GraphQL queries fail as a whole, e.g. on timeouts of large
+    queries or a single broken record, so failed batches are retried and
+    then requested item by item.
+    If some items still could not be resolved, the last error is raised,
+    so that partial results are not cached.
+
+    :param func: callable taking a list of items and returning a list of
+        results, e.g. GitHubAPIv4.repos_info
+    :param controller: threadpool.AIMDController, see mapreduce.map.
+        Every batch attempt is reported to it: latency of successful ones,
+        backoff on failures
+    :return: list, concatenated results of all batches
+    """
+    def attempt(batch):
+        for i in range(BATCH_ATTEMPTS):
+            start = time.time()
+            try:
+                res = list(func(batch))
+            except Exception as e:
+                if controller is not None:
+                    controller.backoff()
+                logger.warning("Batch of %d starting with %s failed (%d/%d):"
+                               " %s", len(batch), batch[0], i + 1,
+                               BATCH_ATTEMPTS, e)
+                error = e
+            else:
+                if controller is not None:
+                    controller.success(time.time() - start)
+                return res
+        raise error
+
+    def process(_, batch):
+        try:
+            return attempt(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                return e  # mapreduce.map would swallow it
+        results = []
+        for item in batch:
+            try:
+                results.extend(attempt([item]))
+            except Exception as e:
+                return e
+        return results
+
+    batches = pd.Series([items[i:i + batch_size]
+                         for i in range(0, len(items), batch_size)])
+    results = []
+    for res in mapreduce.map(batches, process, controller=controller):
+        if isinstance(res, Exception):
+            raise res
+        results.extend(res)
+    return results
+
+
+# number of repositories checked by package_urls() in one GraphQL request
+REPOS_BATCH_SIZE = 100
+
+
 @fs_cache
 def package_urls(ecosystem):
     # type: (str) -> pd.Series
@@ -125,17 +195,32 @@ def package_urls(ecosystem):
     # PyPI: 91728 -> 86892
     urls = urls[urls.map(urls.value_counts()) == 1]
 
-    def exists(project_name, url):
-        logger.info(project_name)
-        provider, project_url = scraper.get_provider(url)
-        return provider.project_exists(project_url)
-
-    # - more than 16 threads make GitHub to choke even on public urls
-    # - some malformed URLs will result in NaN (e.g. NPM abwa-gulp and
-    #       barco-jobs), so need to fillna()
-    se = mapreduce.map(urls, exists, num_workers=16).fillna(False)
-
-    return urls[se]
+    api = scraper.utils._graphql_provider()
+
+    def resolve(packages):
+        # resolved in one GraphQL request
+        logger.info("Resolving %s and %d more",
+                    packages[0], len(packages) - 1)
+        # so far all supported URLs are GitHub URLs
+        repo_names = [scraper.parse_url(urls[package])[1]
+                      for package in packages]
+        return [(package, api.canonical_url(repo['name']))
+                for package, repo in zip(packages, api.repos_info(repo_names))
+                if repo['exists']]
+
+    # check existence and get the actual name of renamed/transferred repos,
+    # REPOS_BATCH_SIZE repositories per request.
+    # Missing repositories are dropped; if some could not be checked,
+    # it raises and nothing is cached.
+    # The API object is shared, so the controller is fed by map_batches
+    controller = threadpool.AIMDController(initial=2, maximum=16)
+    resolved = dict(map_batches(resolve, urls.index.tolist(),
+                                REPOS_BATCH_SIZE, controller))
+
+    # renamed repositories may now point to the same project;
+    # same as above, such projects are dropped
+    urls = pd.Series(resolved).reindex(urls.index).dropna()
+    return urls[urls.map(urls.value_counts()) == 1]
 
 
 def get_repo_usernames(urls):
@@ -178,11 +263,16 @@ def get_repo_usernames(urls):
     return pd.DataFrame(gen(), index=urls.index.rename("name"))
 
 
+# number of users resolved by user_info() in one GraphQL request
+USERS_BATCH_SIZE = 100
+
+
 @fs_cache
 def user_info(ecosystem):
     # type: (str) -> pd.DataFrame
     """ Return user profile fields
     Originally this method was created to differentiate org from user accounts
+    Accounts are resolved in batches of USERS_BATCH_SIZE per GraphQL request
 
     :param ecosystem: {npm|pypi}
     :return: pd.DataFrame:
@@ -207,36 +297,35 @@ def user_info(ecosystem):
     False
     """
 
-    def get_user_info(_, row):
-        # single column dataframe is used instead of series to simplify
-        # result type conversion
-        username = row["login"]
-        logger.info("Processing %s", username)
-        fields = ['created_at', 'login', 'type', 'public_repos',
-                  'followers', 'following']
-        provider_name, _ = scraper.parse_url(row["url"])
-        provider, _ = scraper.get_provider(row["url"])
-        try:
-            data = provider.user_info(username)
-        except scraper.RepoDoesNotExist:
-            return {}
-        res = {field: data.get(field) for field in fields}
-        res["provider_name"] = provider_name
-        return res
+    api = scraper.utils._graphql_provider()
+
+    def get_users_info(logins):
+        # logins is a batch of GitHub usernames, resolved in one request
+        logger.info("Processing %s and %d more", logins[0], len(logins) - 1)
+        users = []
+        for data in api.users_info(logins):
+            if data is None:  # account does not exist
+                continue
+            data["provider_name"] = "github.com"
+            users.append(data)
+        return users
 
-    # Since we're going to get many fields out of one, to simplify type
-    # conversion it makes sense to convert to pd.DataFrame.
-    # by the same reason, user_info() above gets row and not url value
     urls = package_urls(ecosystem)
-    urls.index = urls  # will need it in get_user_info
     # it's going to be a pd.DataFrame(provider_name, login, url)
     usernames = get_repo_usernames(urls).reset_index()
 
     # ensure uniqueness of (provider, login) pairs to avoid extra requests
-    # GitHub seems to ban IP (will get HTTP 403) if use 8 workers
-    ui = mapreduce.map(
-        usernames.groupby(["provider_name", "login"]).first().reset_index(),
-        get_user_info, num_workers=6)
+    # so far GitHub is the only supported provider
+    logins = usernames.loc[usernames["provider_name"] == "github.com",
+                           "login"].drop_duplicates().tolist()
+    # missing accounts are skipped; if some could not be resolved,
+    # it raises and nothing is cached.
+    # The API object is shared, so the controller is fed by map_batches
+    controller = threadpool.AIMDController(initial=2, maximum=16)
+    ui = pd.DataFrame(
+        map_batches(get_users_info, logins, USERS_BATCH_SIZE, controller),
+        columns=['provider_name', 'login', 'created_at', 'type',
+                 'public_repos', 'followers', 'following'])
 
     # TODO: move to provider
     ui["org"] = ui["type"].map({"Organization": True, "User": False})
@@ -328,7 +417,8 @@ def count_values(df):
         return df.apply(count)
 
 
-@d.memoize
+# multi-GB; pipelines process one ecosystem at a time
+@d.memoize(maxsize=1)
 def upstreams(ecosystem):
     # type: (str) -> pd.DataFrame
     """ Get a dataframe with upstream dependencies sliced per month
@@ -389,7 +479,7 @@ def upstreams(ecosystem):
     return dependencies.unstack(level=0).reindex(idx).fillna(method='ffill').T
 
 
-@d.memoize
+@d.memoize(maxsize=1)
 def downstreams(ecosystem):
     # type: (str) -> pd.DataFrame
     """ Basically, reversed upstreams
@@ -586,7 +676,7 @@ def dependencies_centrality(ecosystem, centrality_type):
     return uss.apply(gen, axis=0).fillna(0)
 
 
-@d.memoize
+@d.memoize(maxsize=1)
 def contributors(ecosystem, months=1):
     # type: (str) -> pd.DataFrame
     """ Get a historical list of developers contributing to ecosystem projects
@@ -711,6 +801,20 @@ def dead_projects(ecosystem, window, threshold):
     return dead
 
 
+def pushed_commits(ecosystem):
+    # type: (str) -> pd.DataFrame
+    """ Number of commits pushed to project repositories by month,
+    according to GH Archive. Requires `./manage.py ingest_gharchive` first
+
+    :return: pd.DataFrame, df.loc[project, month] = <number of commits>
+    """
+    urls = package_urls(ecosystem)
+    df = gharchive.load_pushes(ecosystem).unstack(fill_value=0).reindex(
+        urls.values, fill_value=0)
+    df.index = urls.index
+    return df
+
+
 @fs_cache
 def monthly_data(ecosystem, feature):
     # type: (str, str) -> pd.DataFrame
@@ -733,6 +837,7 @@ def monthly_data(ecosystem, feature):
         'dc_katz': lambda es: dependencies_centrality(es, 'katz'),
         'dc_closeness': lambda es: dependencies_centrality(es, "closeness"),
         'cc_degree': lambda es: contributors_centrality(es, "degree"),
+        'pushed_commits': pushed_commits,
     }
 
     project_handlers = {
@@ -743,6 +848,17 @@ def monthly_data(ecosystem, feature):
         'q70': lambda url: scraper.contributions_quantile(url, 0.7),
         'q90': lambda url: scraper.contributions_quantile(url, 0.9),
         'gini': lambda url: scraper.commit_gini(url),
+        # same, approximated from GitHub contributor statistics. Use
+        # scraper.prefetch_contributor_stats(package_urls(ecosystem)) first
+        'commits_approx': lambda url: scraper.commit_stats(url, True),
+        'contributors_approx': lambda url: scraper.commit_users(url, True),
+        'q50_approx': lambda url: scraper.contributions_quantile(
+            url, 0.5, True),
+        'q70_approx': lambda url: scraper.contributions_quantile(
+            url, 0.7, True),
+        'q90_approx': lambda url: scraper.contributions_quantile(
+            url, 0.9, True),
+        'gini_approx': lambda url: scraper.commit_gini(url, True),
         # ISSUES METRICS
         'issues': scraper.new_issues,
         'non_dev_issues': scraper.non_dev_issue_stats,
@@ -763,7 +879,8 @@ def monthly_data(ecosystem, feature):
                 log.info(project_name)
                 try:
                     yield project_handlers[feature](url).rename(project_name)
-                except scraper.RepoDoesNotExist:
+                except (scraper.RepoDoesNotExist,
+                        scraper.github.StatsNotReady):
                     continue
 
         return pd.DataFrame(gen(), columns=idx).fillna(0)
@@ -900,4 +1017,6 @@ def survival_data(ecosystem, start_date="2005", end_date="2017-12", smoothing=1)
     # resample to have only n-th observation (n=smoothing) and the last one
     df = df[((df["age"] % smoothing) == 0) | df["last_observation"]]
 
+    if d.MEMORY_BUDGET:
+        log.info("fs_cache memory tier: %s", d.memory_cache.info())
     return df
@@ -13,10 +13,16 @@ fab.env.hosts = settings.DEPLOY_HOSTS
 def test():
     with fab.settings(warn_only=True):
         fab.local("python -m unittest common.test")
+        fab.local("python -m doctest common/decorators.py")
         fab.local("python -m doctest common/email.py")
+        fab.local("python -m doctest common/manifest.py")
+        fab.local("python -m doctest common/threadpool.py")
         fab.local("python -m doctest common/utils.py")
         fab.local("python -m doctest common/versions.py")
         fab.local("python -m doctest pypi/utils.py")
+        fab.local("python -m unittest scraper.test")
+        fab.local("python -m doctest scraper/gitlog.py")
+        fab.local("python -m doctest scraper/metrics.py")
         fab.local("python -m doctest scraper/utils.py")
 
 
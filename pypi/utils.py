@@ -632,7 +632,7 @@ def dependencies():
         - raw_build_dependencies
     """
     deps = {}
-    fname = fs_cache.get_cache_fname(".deps_and_size.cache")
+    fname = os.path.join(fs_cache.cache_path, ".deps_and_size.cache.csv")
 
     if os.path.isfile(fname):
         logger.info("deps_and_size() cache file already exists. "
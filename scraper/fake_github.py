@@ -0,0 +1,685 @@
+""" Local stand-in for GitHub API, to benchmark scrapers without real tokens
+
+The server implements the subset of GitHub API used by scraper.github:
+    - GET repos/<owner>/<repo>/commits, repos/<owner>/<repo>/issues
+      (paginated with Link headers, supporting `since`)
+    - GET repos/<owner>/<repo>/stats/contributors; the first request for a
+      repository gets 202 (statistics is being computed), same as on GitHub
+    - GET users/<login>, users/<login>/orgs, orgs/<org>/members
+    - GET rate_limit, user
+    - POST graphql, only aliased repositoryOwner/repository queries
+      as produced by GitHubAPIv4.v4_batch() (profiles, repository info,
+      issues and commit counts), and default branch history as requested
+      by GitHubAPIv4.repo_commits_pages()
+    - HEAD <owner>/<repo> (web pages, see GitHubAPI.project_exists)
+All responses are generated from seeded synthetic data, so they are the same
+across runs. Every token has its own X-RateLimit-* quota; exhausted tokens get
+403 until reset, same as on GitHub. ETags are supported, 304s are free.
+Optionally, a share of requests fails with 502 or a secondary rate limit
+(403 with Retry-After); a token requesting again before Retry-After has
+passed gets 403 again.
+
+Repositories are named org<i>/repo<i>, plus several special ones:
+    - missing/<anything>: 404
+    - blocked/<anything>: 451 (unavailable for legal reasons)
+    - empty/<anything>: exists, but commits return 409 (empty repository)
+GraphQL queries can be made to fail for some logins or repositories, with
+partial data for the rest, see FakeGitHub.graphql_errors.
+
+Example:
+    server = FakeGitHub(repos=100, latency=0.05).start()
+    GitHubAPIToken.api_url = server.api_url
+    GitHubAPI.web_url = server.web_url
+    ...
+    server.stop()
+
+See also: `./manage.py benchmark_scraper`
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, urlencode
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import urlencode
+
+# dates of synthetic commits and issues are spread over this interval
+EPOCH = datetime(2010, 1, 1)
+SPAN_DAYS = 8 * 365
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# unauthenticated requests quota, same as GitHub
+ANONYMOUS_LIMIT = 60
+
+GRAPHQL_OWNER = re.compile(r'(\w+):\s*repositoryOwner\(login:\s*\$(\w+)\)')
+GRAPHQL_REPO = re.compile(
+    r'(\w+):\s*repository\(owner:\s*\$(\w+),\s*name:\s*\$(\w+)\)')
+GRAPHQL_AFTER = re.compile(r'after:\s*\$(\w+)')
+
+
+def _date(days):
+    # type: (float) -> str
+    return (EPOCH + timedelta(days=days)).strftime(DATE_FORMAT)
+
+
+class FakeGitHub(object):
+    """ Synthetic GitHub data and the HTTP server exposing it.
+
+    Data is generated on demand; a repository with the same name and seed
+    always has the same commits and issues.
+    """
+    server = None
+    thread = None
+
+    def __init__(self, repos=100, seed=0, commits=(0, 1000), issues=(0, 300),
+                 latency=0, limit=5000, reset_interval=3600, errors=0,
+                 retry_after=60, host='127.0.0.1', port=0):
+        """
+        :param repos: number of regular repositories, org<i>/repo<i>
+        :param seed: random seed for synthetic data
+        :param commits: (min, max) number of commits per repository
+        :param issues: (min, max) number of issues and PRs per repository
+        :param latency: seconds to wait before every response
+        :param limit: requests per token per reset_interval,
+            for each of core, search and graphql quotas
+        :param reset_interval: seconds until the quota is restored
+        :param errors: share of requests failing with 502 or secondary
+            rate limit, half and half
+        :param retry_after: Retry-After of secondary rate limit, seconds
+        :param port: 0 to pick any free port
+        """
+        self.repos = repos
+        self.seed = seed
+        self.commits_range = commits
+        self.issues_range = issues
+        self.latency = latency
+        self.limit = limit
+        self.reset_interval = reset_interval
+        self.errors = errors
+        self.retry_after = retry_after
+        self.host = host
+        self.port = port
+
+        self.lock = threading.Lock()
+        # (token, api_class): [remaining, reset_time]
+        self.quota = {}
+        self.cooldown = {}  # token: timestamp, see throttle()
+        self._errors_random = random.Random(seed)
+        self.counters = {'requests': 0, 'bytes': 0, 'status': {}}
+        self._data = {}
+        self._stats_computed = set()
+        # login or <owner>/<repo>: number of GraphQL queries to fail;
+        # such aliases get null with an INTERNAL error, like on timeouts
+        self.graphql_errors = {}
+
+    @property
+    def api_url(self):
+        return "http://%s:%d/api/" % (self.host, self.port)
+
+    @property
+    def web_url(self):
+        return "http://%s:%d/" % (self.host, self.port)
+
+    def repo_names(self):
+        # type: () -> list
+        return ["org%d/repo%d" % (i, i) for i in range(self.repos)]
+
+    def exists(self, repo_name):
+        # type: (str) -> bool
+        owner, _, name = repo_name.partition("/")
+        if owner == 'empty':
+            return True
+        match = re.match(r"org(\d+)/repo(\d+)$", repo_name)
+        return bool(match) and match.group(1) == match.group(2) \
+            and int(match.group(1)) < self.repos
+
+    # Synthetic data
+
+    def _random(self, *key):
+        return random.Random("%s:%s" % (self.seed, ":".join(
+            str(k) for k in key)))
+
+    def repo_data(self, repo_name):
+        # type: (str) -> dict
+        """ Commits (newest first) and issues (newest first) of a repo """
+        with self.lock:
+            if repo_name in self._data:
+                return self._data[repo_name]
+
+        rnd = self._random(repo_name)
+        if repo_name.startswith('empty/'):
+            n_commits, n_issues = 0, 0
+        else:
+            n_commits = rnd.randint(*self.commits_range)
+            n_issues = rnd.randint(*self.issues_range)
+        owner = repo_name.split("/")[0]
+        devs = ["%s-dev%d" % (owner, i)
+                for i in range(rnd.randint(1, 20))]
+
+        commits = []
+        dates = sorted(rnd.uniform(0, SPAN_DAYS) for _ in range(n_commits))
+        parent = None
+        for i, days in enumerate(dates):
+            sha = hashlib.sha1(
+                ("%s:%d" % (repo_name, i)).encode('utf8')).hexdigest()
+            dev = rnd.choice(devs)
+            # ~10% of commits are authored outside of GitHub
+            author = {'login': dev} if rnd.random() > 0.1 else None
+            commits.append({
+                'sha': sha,
+                'commit': {
+                    'author': {
+                        'name': dev, 'email': dev + "@example.com",
+                        'date': _date(days - rnd.uniform(0, 3))},
+                    'committer': {
+                        'name': dev, 'email': dev + "@example.com",
+                        'date': _date(days)},
+                    'message': "Commit #%d" % i,
+                },
+                'author': author,
+                'committer': author,
+                'parents': [{'sha': parent}] if parent else [],
+                'verification': {'verified': False},
+            })
+            parent = sha
+        commits.reverse()
+
+        issues = []
+        for number in range(1, n_issues + 1):
+            created = rnd.uniform(0, SPAN_DAYS)
+            closed = created + rnd.expovariate(1.0 / 30) \
+                if rnd.random() < 0.6 else None
+            updated = max(closed or created, created + rnd.uniform(0, 60))
+            issue = {
+                'number': number,
+                'title': "Issue #%d" % number,
+                'user': {'login': rnd.choice(devs + ["user%d" % number])},
+                'state': 'closed' if closed else 'open',
+                'created_at': _date(created),
+                'updated_at': _date(updated),
+                'closed_at': closed and _date(closed),
+            }
+            if rnd.random() < 0.2:
+                issue['pull_request'] = {'url': ''}
+            issues.append(issue)
+        issues.sort(key=lambda i: i['created_at'], reverse=True)
+
+        data = {'commits': commits, 'issues': issues, 'devs': devs}
+        with self.lock:
+            self._data[repo_name] = data
+        return data
+
+    def contributor_stats(self, repo_name):
+        # type: (str) -> list
+        """ stats/contributors response, or None if it is not computed yet
+        """
+        with self.lock:
+            if repo_name not in self._stats_computed:
+                self._stats_computed.add(repo_name)
+                return None
+        weeks = {}  # {login: {week timestamp: commits}}
+        for commit in self.repo_data(repo_name)['commits']:
+            login = (commit['author'] or {}).get('login')
+            if login is None:  # GitHub only counts known users
+                continue
+            date = datetime.strptime(
+                commit['commit']['author']['date'], DATE_FORMAT)
+            # weeks start on Sunday
+            start = date - timedelta(days=(date.weekday() + 1) % 7)
+            ts = int((datetime(start.year, start.month, start.day)
+                      - datetime(1970, 1, 1)).total_seconds())
+            counts = weeks.setdefault(login, {})
+            counts[ts] = counts.get(ts, 0) + 1
+        return [{
+            'author': {'login': login},
+            'total': sum(counts.values()),
+            'weeks': [{'w': w, 'a': 0, 'd': 0, 'c': c}
+                      for w, c in sorted(counts.items())]
+        } for login, counts in sorted(weeks.items())][:100]
+
+    def user(self, login):
+        # type: (str) -> dict
+        rnd = self._random('user', login)
+        is_org = re.match(r"org\d+$", login) is not None
+        user = {
+            'login': login,
+            'type': 'Organization' if is_org else 'User',
+            'created_at': _date(rnd.uniform(-SPAN_DAYS, SPAN_DAYS)),
+            'public_repos': rnd.randint(0, 100),
+            'followers': 0 if is_org else rnd.randint(0, 1000),
+            'following': 0 if is_org else rnd.randint(0, 100),
+        }
+        return user
+
+    # Rate limits
+
+    def consume(self, token, api_class, cost=1):
+        # type: (str, str, int) -> (int, int, int)
+        """ Count a request against the token quota
+        :return: (limit, remaining, reset_time); remaining is -1 if the
+            request should be rejected
+        """
+        limit = self.limit if token else ANONYMOUS_LIMIT
+        now = time.time()
+        with self.lock:
+            remaining, reset_time = self.quota.get(
+                (token, api_class), (limit, None))
+            if reset_time is None or reset_time <= now:
+                remaining, reset_time = limit, int(now + self.reset_interval)
+            if remaining >= cost:
+                remaining -= cost
+                self.quota[(token, api_class)] = (remaining, reset_time)
+            else:
+                remaining = -1
+        return limit, remaining, reset_time
+
+    def throttle(self, token):
+        # type: (str) -> int
+        """ Decide if the request should fail because of `errors`
+        :return: 403 for secondary rate limit, 502, or None to proceed
+        """
+        now = time.time()
+        with self.lock:
+            if self.cooldown.get(token, 0) > now:
+                return 403
+            if self._errors_random.random() >= self.errors:
+                return None
+            if self._errors_random.random() < 0.5:
+                return 502
+            self.cooldown[token] = now + self.retry_after
+            return 403
+
+    def rate_limit(self, token):
+        # type: (str) -> dict
+        limit = self.limit if token else ANONYMOUS_LIMIT
+        now = time.time()
+        resources = {}
+        with self.lock:
+            for api_class in ('core', 'search', 'graphql'):
+                remaining, reset_time = self.quota.get(
+                    (token, api_class), (limit, None))
+                if reset_time is None or reset_time <= now:
+                    remaining = limit
+                    reset_time = int(now + self.reset_interval)
+                resources[api_class] = {
+                    'limit': limit, 'remaining': remaining,
+                    'reset': reset_time}
+        return {'resources': resources, 'rate': resources['core']}
+
+    def count(self, status, size):
+        with self.lock:
+            self.counters['requests'] += 1
+            self.counters['bytes'] += size
+            self.counters['status'][status] = \
+                self.counters['status'].get(status, 0) + 1
+
+    def stats(self):
+        # type: () -> dict
+        with self.lock:
+            return dict(self.counters, status=dict(self.counters['status']))
+
+    # Server management
+
+    def start(self):
+        # type: () -> FakeGitHub
+        """ Start serving in a background thread """
+        self.server = _Server((self.host, self.port), _Handler)
+        self.server.fake = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # default (5) is too small for a concurrent scraper
+    request_queue_size = 1024
+    fake = None  # FakeGitHub instance
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, so that scraper connection pools are effective
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # too noisy for benchmarks
+
+    @property
+    def fake(self):
+        # type: () -> FakeGitHub
+        return self.server.fake
+
+    def _send(self, status, body=None, headers=None):
+        if body is None or status == 304:
+            content = b""
+        elif isinstance(body, bytes):
+            content = body
+        else:
+            content = json.dumps(body).encode('utf8')
+        headers = headers or {}
+        # count before the client gets the response, so that tests can
+        # check the counters right after a request returns
+        self.fake.count(status, len(content))
+        self.send_response(status)
+        headers.setdefault('Content-Type', 'application/json; charset=utf-8')
+        headers['Content-Length'] = str(len(content))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def _token(self):
+        auth = self.headers.get('Authorization') or ""
+        return auth.split(" ", 1)[-1] if auth else None
+
+    def _paginate(self, path, query, items):
+        page = int(query.get('page', 1))
+        per_page = min(int(query.get('per_page', 30)), 100)
+        last_page = max((len(items) - 1) // per_page + 1, 1)
+        links = []
+        for rel, p in (('next', page + 1), ('last', last_page),
+                       ('first', 1), ('prev', page - 1)):
+            if 1 <= p <= last_page and p != page:
+                links.append('<%s%s?%s>; rel="%s"' % (
+                    self.fake.api_url, path,
+                    urlencode(sorted(dict(query, page=p).items())), rel))
+        headers = {'Link': ", ".join(links)} if links else {}
+        return items[(page - 1) * per_page:page * per_page], headers
+
+    def do_HEAD(self):
+        # web pages, i.e. https://github.com/<owner>/<repo>
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        repo_name = urlparse(self.path).path.strip("/")
+        self._send(200 if self.fake.exists(repo_name) else 404,
+                   headers={'Content-Type': 'text/html; charset=utf-8'})
+
+    def do_GET(self):
+        self._api('get')
+
+    def do_POST(self):
+        self._api('post')
+
+    def _api(self, method):
+        url = urlparse(self.path)
+        if not url.path.startswith("/api/"):
+            return self._send(404, {'message': 'Not Found'})
+        path = url.path[len("/api/"):].strip("/")
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b""
+
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+
+        token = self._token()
+        if path == 'rate_limit':  # free, same as on GitHub
+            return self._send(200, self.fake.rate_limit(token))
+
+        error = self.fake.throttle(token)
+        if error == 403:
+            return self._send(403, {
+                'message': 'You have exceeded a secondary rate limit. '
+                           'Please wait a few minutes before you try again.'},
+                {'Retry-After': str(self.fake.retry_after)})
+        elif error:
+            return self._send(error, {'message': 'Server Error'})
+
+        headers = {}
+        try:
+            status, res = self._route(method, path, query, body, headers)
+        except (ValueError, KeyError) as e:
+            status, res = 400, {'message': 'Problems parsing request: %s' % e}
+        content = b"" if res is None else json.dumps(res).encode('utf8')
+
+        cost = 1
+        if status == 200 and method == 'get':
+            headers['ETag'] = '"%s"' % hashlib.md5(content).hexdigest()
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                status, cost = 304, 0  # conditional requests are free
+
+        api_class = 'graphql' if path == 'graphql' else \
+            'search' if path.startswith('search') else 'core'
+        limit, remaining, reset_time = \
+            self.fake.consume(token, api_class, cost)
+        headers.update({
+            'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Remaining': str(max(remaining, 0)),
+            'X-RateLimit-Reset': str(reset_time),
+        })
+        if remaining < 0:
+            headers.pop('Link', None)
+            headers.pop('ETag', None)
+            return self._send(403, {
+                'message': 'API rate limit exceeded'}, headers)
+        self._send(status, content, headers)
+
+    def _route(self, method, path, query, body, headers):
+        # type: (str, str, dict, bytes, dict) -> (int, object)
+        """ Dispatch API request; might update response headers """
+        chunks = path.split("/")
+        if method == 'post':
+            if path == 'graphql':
+                return 200, self._graphql(json.loads(body.decode('utf8')))
+            return 404, {'message': 'Not Found'}
+
+        if chunks[0] == 'repos' and len(chunks) == 5 \
+                and chunks[3:] == ['stats', 'contributors']:
+            repo_name = "/".join(chunks[1:3])
+            if not self.fake.exists(repo_name):
+                return 404, {'message': 'Not Found'}
+            if not self.fake.repo_data(repo_name)['commits']:
+                return 204, None
+            stats = self.fake.contributor_stats(repo_name)
+            return (202, {}) if stats is None else (200, stats)
+
+        if chunks[0] == 'repos' and len(chunks) == 4:
+            repo_name = "/".join(chunks[1:3])
+            if repo_name.startswith('blocked/'):
+                return 451, {'message': 'Repository access blocked'}
+            if not self.fake.exists(repo_name):
+                return 404, {'message': 'Not Found'}
+            data = self.fake.repo_data(repo_name)
+            since = query.get('since')
+            if chunks[3] == 'commits':
+                if not data['commits']:
+                    return 409, {'message': 'Git Repository is empty.'}
+                items = [c for c in data['commits'] if not since
+                         or c['commit']['committer']['date'] >= since]
+            elif chunks[3] == 'issues':
+                items = [i for i in data['issues'] if not since
+                         or i['updated_at'] >= since]
+            else:
+                return 404, {'message': 'Not Found'}
+            items, link = self._paginate(path, query, items)
+            headers.update(link)
+            return 200, items
+
+        if path == 'user':
+            return 200, self.fake.user(self._token() or 'anonymous')
+        if chunks[0] == 'users' and len(chunks) in (2, 3):
+            login = chunks[1]
+            if login.startswith('missing'):
+                return 404, {'message': 'Not Found'}
+            if len(chunks) == 2:
+                return 200, self.fake.user(login)
+            if chunks[2] == 'orgs':
+                # devs of org<i> are members of it
+                org = login.split("-", 1)[0]
+                return 200, ([{'login': org}]
+                             if re.match(r"org\d+$", org) else [])
+        if chunks[0] == 'orgs' and len(chunks) == 3 \
+                and chunks[2] == 'members':
+            org = chunks[1]
+            repo_name = "%s/repo%s" % (org, org[3:])
+            if not self.fake.exists(repo_name):
+                return 404, {'message': 'Not Found'}
+            return 200, [{'login': dev}
+                         for dev in self.fake.repo_data(repo_name)['devs']]
+        return 404, {'message': 'Not Found'}
+
+    def _graphql(self, payload):
+        # type: (dict) -> dict
+        query = payload['query']
+        variables = payload.get('variables') or {}
+        if 'history (first' in query:
+            return self._graphql_history(query, variables)
+        data = {}
+        errors = []
+        connections = 0
+
+        def failed(alias, name):
+            with self.fake.lock:
+                if not self.fake.graphql_errors.get(name):
+                    return False
+                self.fake.graphql_errors[name] -= 1
+            data[alias] = None
+            errors.append({'type': 'INTERNAL', 'path': [alias],
+                           'message': 'Something went wrong while executing '
+                                      'your query'})
+            return True
+
+        def not_found(alias, kind, name):
+            data[alias] = None
+            errors.append({'type': 'NOT_FOUND', 'path': [alias],
+                           'message': "Could not resolve to a %s with the "
+                                      "name '%s'." % (kind, name)})
+
+        for alias, login_var in GRAPHQL_OWNER.findall(query):
+            login = variables[login_var]
+            if failed(alias, login):
+                continue
+            if login.startswith('missing'):
+                not_found(alias, 'RepositoryOwner', login)
+                continue
+            user = self.fake.user(login)
+            data[alias] = {
+                'login': login,
+                'createdAt': user['created_at'],
+                '__typename': user['type'],
+                'repositories': {'totalCount': user['public_repos']},
+            }
+            if user['type'] == 'User':
+                data[alias]['followers'] = {'totalCount': user['followers']}
+                data[alias]['following'] = {'totalCount': user['following']}
+        matches = list(GRAPHQL_REPO.finditer(query))
+        for i, match in enumerate(matches):
+            alias, owner_var, name_var = match.groups()
+            # fragment body is up to the next aliased fragment
+            body = query[match.end():
+                         matches[i + 1].start() if i + 1 < len(matches)
+                         else len(query)]
+            repo_name = "%s/%s" % (variables[owner_var], variables[name_var])
+            if failed(alias, repo_name):
+                continue
+            if not self.fake.exists(repo_name) or \
+                    repo_name.startswith('blocked/'):
+                not_found(alias, 'Repository', repo_name)
+            elif 'issues' in body:
+                connections += 1
+                after = GRAPHQL_AFTER.search(body)
+                data[alias] = {'issues': self._graphql_issues(
+                    repo_name, after and variables[after.group(1)])}
+            elif 'defaultBranchRef' in body:
+                commits = self.fake.repo_data(repo_name)['commits']
+                data[alias] = {'defaultBranchRef': {'target': {'history': {
+                    'totalCount': len(commits)}}} if commits else None}
+            else:
+                data[alias] = {
+                    'nameWithOwner': repo_name,
+                    'isFork': False,
+                    'isArchived': False,
+                }
+        if not data:
+            return {'data': None,
+                    'errors': [{'message': 'Query is not supported'}]}
+        if 'rateLimit' in query:
+            data['rateLimit'] = {'cost': max(1, (connections + 50) // 100)}
+        if errors:
+            return {'data': data, 'errors': errors}
+        return {'data': data}
+
+    def _graphql_issues(self, repo_name, cursor):
+        # type: (str, str) -> dict
+        """ A page of issues (not pull requests), oldest first """
+        issues = [i for i in reversed(self.fake.repo_data(repo_name)['issues'])
+                  if 'pull_request' not in i]
+        offset = int(cursor or 0)
+        page = issues[offset:offset + 100]
+        return {
+            'nodes': [{
+                'number': i['number'],
+                'title': i['title'],
+                'closed': i['state'] == 'closed',
+                'createdAt': i['created_at'],
+                'updatedAt': i['updated_at'],
+                'closedAt': i['closed_at'],
+                'author': i['user'],
+            } for i in page],
+            'pageInfo': {'endCursor': str(offset + len(page)),
+                         'hasNextPage': offset + len(page) < len(issues)}
+        }
+
+    def _graphql_history(self, query, variables):
+        # type: (str, dict) -> dict
+        """ Default branch history; cursors are just offsets """
+        repo_name = "%s/%s" % (variables['owner'], variables['repo'])
+        if not self.fake.exists(repo_name) or \
+                repo_name.startswith('blocked/'):
+            return {'data': {'repository': None}, 'errors': [{
+                'type': 'NOT_FOUND', 'message': 'Could not resolve to a '
+                                                'Repository'}]}
+        commits = self.fake.repo_data(repo_name)['commits']
+        if not commits:
+            return {'data': {'repository': {'defaultBranchRef': None}}}
+        since = variables.get('since')
+        if since:
+            commits = [c for c in commits
+                       if c['commit']['committer']['date'] >= since]
+        offset = int(variables.get('cursor') or 0)
+        page = commits[offset:offset + 100]
+        history = {'pageInfo': {
+            'endCursor': str(offset + len(page)),
+            'hasNextPage': offset + len(page) < len(commits)}}
+        if 'nodes' in query:
+            history['nodes'] = [{
+                'sha': c['sha'],
+                'authoredDate': c['commit']['author']['date'],
+                'committedDate': c['commit']['committer']['date'],
+                'message': c['commit']['message'],
+                'author': {
+                    'name': c['commit']['author']['name'],
+                    'email': c['commit']['author']['email'],
+                    'user': c['author']},
+                'parents': {'nodes': [{'oid': p['sha']}
+                                      for p in c['parents']]},
+            } for c in page]
+        return {'data': {'repository': {
+            'defaultBranchRef': {'target': {'history': history}}}}}
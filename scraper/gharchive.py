@@ -0,0 +1,175 @@
+""" Offline source of issues and push events: GH Archive (gharchive.org)
+
+GH Archive publishes all public GitHub events as hourly files, e.g.
+http://data.gharchive.org/2018-01-01-15.json.gz (one JSON event per line).
+Downloading them is up to the user; this module only reads local files, so
+any number of them can be processed without network access or API tokens.
+
+Only events of the given repositories are used:
+    - IssuesEvent and IssueCommentEvent carry the current state of the
+      issue, so the latest one gives the same record as the issues API
+    - PushEvent carries number of distinct commits pushed
+
+Files are processed in parallel, one file per process at a time.
+Only the current event format (2015+) is supported; older events are
+skipped.
+
+Typical use is `./manage.py ingest_gharchive`, which also can fill the
+issues cache (scraper.utils.issues) so that they are not scraped via API.
+"""
+
+from __future__ import print_function
+
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import zlib
+from typing import Iterable
+
+import pandas as pd
+
+from common import decorators
+
+logger = logging.getLogger('ghd.scraper')
+
+ISSUE_COLUMNS = ['number', 'author', 'closed', 'created_at', 'updated_at',
+                 'closed_at']
+# quick check before parsing JSON; GH Archive lines are compact
+EVENT_MARKERS = (b'"type":"IssuesEvent"', b'"type":"IssueCommentEvent"',
+                 b'"type":"PushEvent"')
+
+# set of repository names (<owner>/<repo>, lowercase) in worker processes
+_repos = None
+
+
+def _init_worker(repos):
+    global _repos
+    _repos = repos
+
+
+def parse_file(path, repos=None):
+    # type: (str, set) -> (dict, dict)
+    """ Extract issues and pushes of the given repositories from a GH Archive
+    file. Truncated or corrupted files are processed up to the first error.
+
+    :param path: path to a .json.gz file
+    :param repos: set of lowercase <owner>/<repo>; defaults to the set
+        passed to worker processes by ingest()
+    :return: (issues, pushes):
+        - issues: {(repo, number): tuple of ISSUE_COLUMNS values}
+        - pushes: {(repo, month): number of commits}
+    """
+    repos = _repos if repos is None else repos
+    issues = {}
+    pushes = {}
+    try:
+        with gzip.open(path, 'rb') as fh:
+            for line in fh:
+                if not any(marker in line for marker in EVENT_MARKERS):
+                    continue
+                try:
+                    event = json.loads(line.decode('utf8'))
+                except ValueError:
+                    continue
+                repo = (event.get('repo') or {}).get('name', '').lower()
+                if repo not in repos:
+                    continue
+                payload = event.get('payload') or {}
+
+                if event['type'] == 'PushEvent':
+                    key = (repo, event['created_at'][:7])
+                    pushes[key] = pushes.get(key, 0) + payload.get(
+                        'distinct_size', payload.get('size', 0))
+                    continue
+
+                issue = payload.get('issue')
+                # issue comments are also posted on pull requests
+                if not issue or 'pull_request' in issue:
+                    continue
+                record = (issue['number'], (issue.get('user') or {}).get(
+                    'login'), issue['state'] != 'open', issue['created_at'],
+                          issue['updated_at'], issue.get('closed_at'))
+                key = (repo, issue['number'])
+                # records are compared by updated_at
+                if key not in issues or issues[key][4] <= record[4]:
+                    issues[key] = record
+    except (IOError, EOFError, OSError, zlib.error) as e:
+        logger.warning("%s: failed to read the archive, %s", path, e)
+    return issues, pushes
+
+
+def ingest(paths, urls, processes=None):
+    # type: (Iterable[str], Iterable[str], int) -> (pd.DataFrame, pd.Series)
+    """ Process GH Archive files in parallel
+
+    :param paths: iterable of local .json.gz file paths
+    :param urls: repository URLs to collect events for, e.g.
+        common.utils.package_urls(ecosystem); only GitHub ones are used
+    :param processes: number of processes, number of CPUs by default
+    :return: (issues, pushes):
+        - issues: pd.DataFrame indexed by (url, number), same columns
+            as scraper.utils.issues()
+        - pushes: pd.Series of pushed commits indexed by (url, month)
+    """
+    repos = set()
+    for url in urls:
+        if url and url.lower().startswith('github.com/'):
+            repos.add(url[len('github.com/'):].lower())
+    paths = sorted(paths)
+
+    issues = {}
+    pushes = {}
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(repos,))
+    try:
+        for i, (file_issues, file_pushes) in enumerate(
+                pool.imap_unordered(parse_file, paths)):
+            for key, record in file_issues.items():
+                if key not in issues or issues[key][4] <= record[4]:
+                    issues[key] = record
+            for key, count in file_pushes.items():
+                pushes[key] = pushes.get(key, 0) + count
+            logger.info("GH Archive: %d of %d files processed",
+                        i + 1, len(paths))
+    finally:
+        pool.close()
+        pool.join()
+
+    issues_df = pd.DataFrame(
+        [("github.com/" + repo,) + record
+         for (repo, _), record in issues.items()],
+        columns=['url'] + ISSUE_COLUMNS).set_index(['url', 'number'])
+    keys = list(pushes)
+    pushes_s = pd.Series(
+        [pushes[key] for key in keys], name='commits',
+        index=pd.MultiIndex.from_arrays(
+            [["github.com/" + repo for repo, _ in keys],
+             [month for _, month in keys]], names=['url', 'month']))
+    return issues_df.sort_index(), pushes_s.sort_index()
+
+
+def cache_path(ecosystem, name):
+    # type: (str, str) -> str
+    """ Where ingested data of an ecosystem is stored,
+    name is either 'issues' or 'pushes' """
+    return os.path.join(
+        decorators.mkdir(decorators.DATASET_PATH, 'gharchive.cache'),
+        "%s.%s.csv" % (name, ecosystem))
+
+
+def load_pushes(ecosystem):
+    # type: (str) -> pd.Series
+    """ Pushed commits stored by `./manage.py ingest_gharchive`,
+    indexed by (url, month) """
+    return pd.read_csv(cache_path(ecosystem, 'pushes'), index_col=[0, 1],
+                       encoding='utf8', squeeze=True)
+
+
+def load_issues(ecosystem):
+    # type: (str) -> pd.DataFrame
+    """ Issues stored by `./manage.py ingest_gharchive`,
+    indexed by (url, number) """
+    return pd.read_csv(cache_path(ecosystem, 'issues'), index_col=[0, 1],
+                       encoding='utf8')
@@ -2,10 +2,21 @@
 import requests
 import time
 from datetime import datetime
+import collections
+import contextlib
+import itertools
 import json
 import logging
+import random
+import re
+import threading
 from typing import Iterable
 
+from common import threadpool
+from scraper import http_cache
+from scraper import ledger
+from scraper import metrics
+
 try:
     import settings
 except ImportError:
@@ -15,6 +26,56 @@ _tokens = getattr(settings, "SCRAPER_GITHUB_API_TOKENS", [])
 
 logger = logging.getLogger('ghd.scraper')
 
+# number of simultaneous page requests per ready token, see GitHubAPI.pages()
+PAGE_WORKERS_PER_TOKEN = 4
+LAST_PAGE_PATTERN = re.compile(r'[?&]page=(\d+)[^>]*>;\s*rel="last"')
+# maximum number of kept alive connections per token (and per host).
+# Should be no less than the scraper concurrency, which is up to 128
+# (see build_cache); extra connections are closed after use
+POOL_SIZE = getattr(settings, 'SCRAPER_HTTP_POOL_SIZE', 128)
+# a request failing with 5xx or a network error is tried this many times
+MAX_ATTEMPTS = 6
+# failing tokens cool down for a random time up to BACKOFF_BASE * 2^failures
+# seconds (but no more than BACKOFF_MAX), unless the server says how long
+BACKOFF_BASE = 1
+BACKOFF_MAX = 300
+SECONDARY_LIMIT_PATTERN = re.compile(
+    br"secondary rate limit|abuse detection", re.IGNORECASE)
+
+
+def make_session(pool_size=POOL_SIZE):
+    # type: (int) -> requests.Session
+    """ HTTP session keeping connections alive, so that consecutive requests
+    don't need a new TCP and TLS handshake """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+
+def pool_stats(session):
+    # type: (requests.Session) -> dict
+    """ Connection pool statistics of a session:
+        - requests: number of requests made
+        - connections: number of connections (i.e. handshakes) made
+        - idle: number of open connections waiting to be reused
+    """
+    stats = {'requests': 0, 'connections': 0, 'idle': 0}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:  # evicted meanwhile
+                continue
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+            stats['idle'] += sum(conn is not None
+                                 for conn in list(pool.pool.queue))
+    return stats
+
 
 class RepoDoesNotExist(requests.HTTPError):
     pass
@@ -24,30 +85,78 @@ class TokenNotReady(requests.HTTPError):
     pass
 
 
+class TokenThrottled(TokenNotReady):
+    """ Raised when a token hits secondary (abuse detection) rate limit.
+    The token cools down for a while, other tokens can be used meanwhile """
+    pass
+
+
+class StatsNotReady(requests.HTTPError):
+    """ GitHub is computing repository statistics (HTTP 202),
+    the request should be repeated later """
+    pass
+
+
 class GitHubAPIToken(object):
     api_url = "https://api.github.com/"
 
     token = None
+    id = None  # token hash, to be used in logs and shared ledger
     timeout = None
+    session = None  # requests.Session, see make_session()
     _user = None
     _headers = None
 
     limit = None  # see __init__ for more details
+    http_cache = None  # http_cache.HTTPCache instance, None to disable
+    ledger = None  # ledger.TokenLedger instance to share limits, or None
+    metrics = None  # metrics.Metrics instance
+    in_flight = 0  # number of requests being executed, to spread the load
+    cooldown_until = 0  # timestamp, token is not used before that
+    failures = 0  # number of consecutive failures, to compute backoff
 
     def __init__(self, token=None, timeout=None):
         if token is not None:
             self.token = token
             self._headers = {"Authorization": "token " + token}
+        self.id = ledger.token_id(token)
         self.limit = {}
-        for api_class in ('core', 'search'):
+        for api_class in ('core', 'search', 'graphql'):
             self.limit[api_class] = {
                 'limit': None,
                 'remaining': None,
                 'reset_time': None
             }
         self.timeout = timeout
+        self._lock = threading.Lock()
+        self.http_cache = http_cache.get_cache()
+        self.ledger = ledger.get_ledger()
+        self.session = self.make_session()
+        self.metrics = metrics.get_metrics()
         super(GitHubAPIToken, self).__init__()
 
+    def make_session(self):
+        return make_session()
+
+    @contextlib.contextmanager
+    def busy(self):
+        """ Count a request in flight; requests are made from many threads
+        """
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def pool_stats(self):
+        # type: () -> dict
+        """ See pool_stats(); `open` includes connections in use """
+        stats = pool_stats(self.session)
+        stats['open'] = stats['idle'] + self.in_flight
+        return stats
+
     @property
     def user(self):
         if self._user is None:
@@ -61,22 +170,63 @@ class GitHubAPIToken(object):
 
     def _check_limits(self):
         # regular limits will be updaated automatically upon request
-        # we only need to take care about search limit
+        # we only need to take care about search and GraphQL limits
         try:
-            s = self.request('rate_limit').json()['resources']['search']
+            resources = self.request('rate_limit').json()['resources']
         except TokenNotReady:
-            # self.request updated core limits already; search limits unknown
-            s = {'remaining': None, 'reset': None, 'limit': None}
+            # self.request updated core limits already; others are unknown
+            resources = {}
+
+        for api_class in ('search', 'graphql'):
+            s = resources.get(
+                api_class, {'remaining': None, 'reset': None, 'limit': None})
+            self._set_limit(api_class, s['limit'], s['remaining'], s['reset'])
 
-        self.limit['search'] = {
-            'remaining': s['remaining'],
-            'reset_time': s['reset'],
-            'limit': s['limit']
+    def _set_limit(self, api_class, limit, remaining, reset_time):
+        self.limit[api_class] = {
+            'remaining': remaining,
+            'reset_time': reset_time,
+            'limit': limit
         }
+        if self.ledger is not None and remaining is not None:
+            self.ledger.update(self.id, api_class, limit, remaining,
+                               reset_time)
+
+    def sync_limits(self, url):
+        """ Update limits from the shared ledger, if any """
+        if self.ledger is not None:
+            key = self.api_class(url)
+            self.limit[key] = self.ledger.get(self.id, key) or self.limit[key]
 
     @staticmethod
     def api_class(url):
-        return 'search' if url.startswith('search') else 'core'
+        """
+        >>> GitHubAPIToken.api_class("graphql")
+        'graphql'
+        >>> GitHubAPIToken.api_class("repos/pandas-dev/pandas/commits")
+        'core'
+        """
+        if url.startswith('search'):
+            return 'search'
+        return 'graphql' if url == 'graphql' else 'core'
+
+    @staticmethod
+    def endpoint(url):
+        """ Endpoint of a request for metrics, without owner or user names
+        >>> GitHubAPIToken.endpoint("repos/pandas-dev/pandas/commits")
+        'commits'
+        >>> GitHubAPIToken.endpoint("repos/pandas-dev/pandas/stats/contributors")
+        'contributors'
+        >>> GitHubAPIToken.endpoint("users/pandas-dev")
+        'users'
+        >>> GitHubAPIToken.endpoint("graphql")
+        'graphql'
+        """
+        parts = url.split("/")
+        if parts[0] == 'repos':
+            # repos/<owner>/<name>[/stats]/<endpoint>
+            parts = [part for part in parts[3:] if part != 'stats'] or parts
+        return parts[0]
 
     def ready(self, url):
         t = self.when(url)
@@ -89,9 +239,48 @@ class GitHubAPIToken(object):
 
     def when(self, url):
         key = self.api_class(url)
-        if self.limit[key]['remaining'] != 0:
-            return 0
-        return self.limit[key]['reset_time']
+        cooldown = self.cooldown_until if self.cooling_down() else 0
+        # reset time is unknown if limits came without it, e.g. from
+        # an older ledger; the next response will tell
+        if self.limit[key]['remaining'] != 0 or \
+                self.limit[key]['reset_time'] is None:
+            return cooldown
+        return max(self.limit[key]['reset_time'], cooldown)
+
+    def cooling_down(self):
+        return self.cooldown_until > time.time()
+
+    def cool_down(self, delay=None):
+        # type: (float) -> float
+        """ Stop using the token for `delay` seconds. By default, the delay
+        is exponential in number of consecutive failures, with full jitter,
+        so that tokens failed at once don't come back at once either.
+        :return: the delay
+        """
+        self.failures += 1
+        if delay is None:
+            delay = random.uniform(0, min(
+                BACKOFF_MAX, BACKOFF_BASE * 2 ** self.failures))
+        self.cooldown_until = max(self.cooldown_until, time.time() + delay)
+        return delay
+
+    def _check_throttling(self, status, headers, content):
+        # type: (int, dict, bytes) -> None
+        """ Cool down and raise TokenThrottled on secondary rate limits,
+        i.e. 429 or 403 with Retry-After header or an abuse message.
+        Shared with asynchronous tokens """
+        if status == 429 or (status == 403 and (
+                'Retry-After' in headers
+                or SECONDARY_LIMIT_PATTERN.search(content or b""))):
+            retry_after = headers.get('Retry-After', '')
+            delay = self.cool_down(
+                int(retry_after) + random.random()
+                if retry_after.isdigit() else None)
+            logger.info("Token %s hit secondary rate limit, cooling down "
+                        "for %d seconds", self.id, delay)
+            raise TokenThrottled
+        if status < 500:
+            self.failures = 0
 
     def request(self, url, method='get', data=None, **params):
         # TODO: use coroutines, perhaps Tornado (as PY2/3 compatible)
@@ -101,23 +290,70 @@ class GitHubAPIToken(object):
         # Exact API version can be specified by Accept header:
         # "Accept": "application/vnd.github.v3+json"}
 
+        # only GET requests can be conditional (i.e. answered with 304)
+        cache_key = None
+        headers = self._headers
+        if method == 'get' and self.http_cache is not None:
+            cache_key = self.http_cache.key(url, params)
+            headers = dict(self._headers or {},
+                           **self.http_cache.conditional_headers(cache_key))
+
+        r = self._send(url, method, data, params, headers)
+        if cache_key is None:
+            return r
+        if r.status_code == 304:
+            cached = self.http_cache.load(cache_key)
+            if cached is not None:
+                cached_headers, content = cached
+                # fresh rate limit headers should take precedence
+                r.headers = requests.structures.CaseInsensitiveDict(
+                    cached_headers, **r.headers)
+                r._content = content
+                r.status_code = 200
+                return r
+            # evicted or corrupted, ask again unconditionally
+            r = self._send(url, method, data, params, self._headers)
+        if r.status_code == 200:
+            self.http_cache.store(cache_key, r.headers, r.content)
+        return r
+
+    def _send(self, url, method, data, params, headers):
+        # type: (str, str, str, dict, dict) -> requests.Response
+        """ Make a single HTTP request and record it """
         # might throw a timeout
-        r = requests.request(
-            method, self.api_url + url, params=params, data=data,
-            headers=self._headers,  timeout=self.timeout)
-
-        if 'X-RateLimit-Remaining' in r.headers:
-            remaining = int(r.headers['X-RateLimit-Remaining'])
-            self.limit[self.api_class(url)] = {
-                'remaining': remaining,
-                'reset_time': int(r.headers['X-RateLimit-Reset']),
-                'limit': int(r.headers['X-RateLimit-Limit'])
-            }
+        start = time.time()
+        try:
+            with self.busy():
+                r = self.session.request(
+                    method, self.api_url + url, params=params, data=data,
+                    headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            self.metrics.request(self.id, self.api_class(url),
+                                 e.__class__.__name__, time.time() - start,
+                                 endpoint=self.endpoint(url))
+            raise
+        self.metrics.request(self.id, self.api_class(url), r.status_code,
+                             time.time() - start, len(r.content),
+                             r.headers.get('X-RateLimit-Remaining'),
+                             self.endpoint(url))
 
-            if r.status_code == 403 and remaining == 0:
-                raise TokenNotReady
+        self._update_limits(url, r.status_code, r.headers)
+        self._check_throttling(r.status_code, r.headers, r.content)
         return r
 
+    def _update_limits(self, url, status, headers):
+        # type: (str, int, dict) -> None
+        """ Update limits from response headers, raise TokenNotReady if
+        the token is exhausted. Shared with asynchronous tokens """
+        if 'X-RateLimit-Remaining' in headers:
+            remaining = int(headers['X-RateLimit-Remaining'])
+            self._set_limit(self.api_class(url),
+                            int(headers['X-RateLimit-Limit']), remaining,
+                            int(headers['X-RateLimit-Reset']))
+
+            if status in (403, 429) and remaining == 0:
+                raise TokenNotReady
+
 
 class GitHubAPI(object):
     """ This is a convenience class to pool GitHub API keys and update their
@@ -126,118 +362,355 @@ class GitHubAPI(object):
     """
     _instance = None  # instance of API() for Singleton pattern implementation
     tokens = None
+    token_class = GitHubAPIToken
+    # common.threadpool.AIMDController, to report throttling and latency to
+    controller = None
+    # used for unofficial methods, i.e. project_exists() and activity()
+    web_url = "https://github.com/"
 
     def __new__(cls, *args, **kwargs):  # Singleton
         if not isinstance(cls._instance, cls):
-            cls._instance = super(GitHubAPI, cls).__new__(cls, *args, **kwargs)
+            # object.__new__ does not accept arguments in Python 3
+            cls._instance = super(GitHubAPI, cls).__new__(cls)
         return cls._instance
 
     def __init__(self, tokens=_tokens, timeout=30):
         if not tokens:
             raise EnvironmentError(
                 "No GitHub API tokens found in settings.py. Please add some.")
-        self.tokens = [GitHubAPIToken(t, timeout=timeout) for t in tokens]
+        self.tokens = [self.token_class(t, timeout=timeout) for t in tokens]
+        # for unofficial methods, which don't use tokens
+        self.session = make_session()
+        self.metrics = metrics.get_metrics()
 
-    def request(self, url, method='get', paginate=False, data=None, **params):
-        # type: (str, str, bool, str) -> dict
-        """ Generic, API version agnostic request method """
-        timeout_counter = 0
-        if paginate:
-            paginated_res = []
-            params['page'] = 1
-            params['per_page'] = 100
+    def pool_stats(self):
+        # type: () -> dict
+        """ Connection pool statistics of all tokens, see pool_stats().
+        `reuse` is the share of requests made over an existing connection """
+        stats = {'requests': 0, 'connections': 0, 'idle': 0, 'open': 0}
+        for token in self.tokens:
+            for key, value in token.pool_stats().items():
+                stats[key] += value
+        stats['reuse'] = stats['requests'] and \
+            1 - float(stats['connections']) / stats['requests']
+        return stats
+
+    def _request(self, url, method='get', data=None, **params):
+        # type: (str, str, str) -> requests.Response
+        """ Make a request using the first available token.
+        Handles exhausted tokens and timeouts, waits if all keys are out.
+
+        Tokens hitting secondary rate limits cool down as long as the server
+        asks to (Retry-After), while other tokens keep working.
+        Server errors (5xx) and network errors are retried up to
+        MAX_ATTEMPTS times with another token, while the failed one cools
+        down with exponential backoff. After that, the last response is
+        returned, or the last exception is raised """
+        attempts = 0
 
         while True:
-            for token in sorted(self.tokens, key=lambda t: t.when(url)):
+            for token in self._candidates(url):
                 if not token.ready(url):
                     continue
 
+                start = time.time()
                 try:
                     r = token.request(url, method=method, data=data, **params)
+                except TokenThrottled:
+                    self._feedback()
+                    self.metrics.retry('secondary_limit')
+                    continue
                 except TokenNotReady:
+                    self.metrics.retry('token_exhausted')
                     continue
-                except requests.exceptions.Timeout:
-                    timeout_counter += 1
-                    if timeout_counter > len(self.tokens):
+                except (requests.exceptions.Timeout,
+                        requests.exceptions.ConnectionError) as e:
+                    self._feedback()
+                    attempts += 1
+                    if attempts >= MAX_ATTEMPTS:
                         raise
+                    self.metrics.retry(e.__class__.__name__)
+                    token.cool_down()
                     continue  # i.e. try again
 
+                self._feedback(r, time.time() - start)
+                if r.status_code >= 500 and attempts + 1 < MAX_ATTEMPTS:
+                    attempts += 1
+                    self.metrics.retry('server_error')
+                    token.cool_down()
+                    continue
                 if r.status_code in (404, 451):  # API v3 only
                     raise RepoDoesNotExist(
                         "GH API returned status %s" % r.status_code)
-                elif r.status_code == 409:
-                    # repository is empty https://developer.github.com/v3/git/
-                    return {}
-                r.raise_for_status()
-                res = r.json()
-                if paginate:
-                    paginated_res.extend(res)
-                    has_next = 'rel="next"' in r.headers.get("Link", "")
-                    if not res or not has_next:
-                        return paginated_res
-                    else:
-                        params["page"] += 1
-                        continue
-                else:
-                    return res
+                return r
 
-            next_res = min(token.when(url) for token in self.tokens)
-            sleep = int(next_res - time.time()) + 1
+            sleep = self._out_of_keys(url)
             if sleep > 0:
                 logger.info(
                     "%s: out of keys, resuming in %d minutes, %d seconds",
                     datetime.now().strftime("%H:%M"), *divmod(sleep, 60))
                 time.sleep(sleep)
+                self.metrics.slept('out_of_keys', sleep)
                 logger.info(".. resumed")
 
-    def repo_issues(self, repo_name, page=None):
-        # type: (str, int) -> Iterable[dict]
+    def _feedback(self, response=None, latency=None):
+        """ Let concurrency controller know how the request went.
+        No response means timeout or connection error """
+        if self.controller is None:
+            return
+        if response is None or response.status_code in (403, 429) \
+                or response.status_code >= 500 \
+                or 'Retry-After' in response.headers:
+            # 403 here are secondary limits: exhausted tokens raise
+            # TokenNotReady and never get here
+            self.controller.backoff()
+        else:
+            self.controller.success(latency)
+
+    def _candidates(self, url):
+        # type: (str) -> list
+        """ Tokens to try for the next request, in order of preference.
+        Least busy tokens go first. If limits are shared with other
+        processes, the token having the most quota globally is reserved and
+        goes first, others are only tried if it fails """
+        candidates = sorted(self.tokens,
+                            key=lambda t: (t.when(url), t.in_flight))
+        if not self.tokens or self.tokens[0].ledger is None:
+            return candidates
+        # tokens cooling down are not known to the ledger
+        tokens = {token.id: token for token in candidates
+                  if not token.cooling_down()}
+        if not tokens:
+            return []
+        token_id = self.tokens[0].ledger.reserve(
+            [token.id for token in candidates if token.id in tokens],
+            GitHubAPIToken.api_class(url))
+        if token_id is None:  # exhausted everywhere
+            return []
+        return [tokens[token_id]] + [
+            token for token in candidates if token.id != token_id]
+
+    def _out_of_keys(self, url):
+        # type: (str) -> int
+        """ Number of seconds until the first token is renewed """
+        for token in self.tokens:
+            token.sync_limits(url)
+        next_res = min(token.when(url) or 0 for token in self.tokens)
+        return int(next_res - time.time()) + 1
+
+    def request(self, url, method='get', paginate=False, data=None, **params):
+        # type: (str, str, bool, str) -> dict
+        """ Generic, API version agnostic request method """
+        if paginate:
+            paginated_res = []
+            for page in self.pages(url, method=method, data=data, **params):
+                paginated_res.extend(page)
+            return paginated_res
+
+        r = self._request(url, method=method, data=data, **params)
+        if r.status_code == 409:
+            # repository is empty https://developer.github.com/v3/git/
+            return {}
+        r.raise_for_status()
+        with self.metrics.timer('json'):
+            return r.json()
+
+    @staticmethod
+    def _last_page(headers):
+        # type: (dict) -> int
+        """ Get number of the last page from the Link header, if any
+
+        >>> GitHubAPI._last_page({"Link": '<https://api.github.com/repos/a/b/'
+        ...     'commits?per_page=100&page=2>; rel="next", <https://api.'
+        ...     'github.com/repos/a/b/commits?per_page=100&page=34>; '
+        ...     'rel="last"'})
+        34
+        >>> GitHubAPI._last_page({})
+        """
+        m = LAST_PAGE_PATTERN.search(headers.get("Link", ""))
+        return m and int(m.group(1))
+
+    def _fetch_pages(self, url, pages, method='get', data=None, **params):
+        # type: (str, Iterable[int], str, str) -> list
+        """ Fetch several pages at once, using a pool of
+        PAGE_WORKERS_PER_TOKEN threads per token shared by all callers.
+        Returns list of results, in the same order as pages """
+        executor = threadpool.shared_executor(
+            'github.pages', len(self.tokens) * PAGE_WORKERS_PER_TOKEN)
+        futures = [executor.submit(self.request, url, method=method,
+                                   data=data, **dict(params, page=page))
+                   for page in pages]
+        try:
+            return [future.result() for future in futures]
+        finally:  # don't waste quota on pages nobody will use
+            for future in futures:
+                future.cancel()
+
+    def pages(self, url, method='get', data=None, **params):
+        # type: (str, str, str) -> Iterable[list]
+        """ Iterate pages of a paginated listing, in order.
+        After the first page the number of the last page is known from the
+        Link header, so the rest is fetched concurrently across ready tokens
+        """
+        params['page'] = params.get('page', 1)
+        params['per_page'] = 100
+
+        r = self._request(url, method=method, data=data, **params)
+        if r.status_code == 409:
+            # repository is empty https://developer.github.com/v3/git/
+            return
+        r.raise_for_status()
+        with self.metrics.timer('json'):
+            res = r.json()
+        yield res
+        last_page = self._last_page(r.headers)
+        if not res or not last_page:
+            return
+
+        first_page = params['page']
+        while first_page < last_page:
+            ready = sum(token.ready(url) for token in self.tokens)
+            window = min(last_page - first_page,
+                         max(ready, 1) * PAGE_WORKERS_PER_TOKEN)
+            for res in self._fetch_pages(
+                    url, range(first_page + 1, first_page + window + 1),
+                    method=method, data=data, **params):
+                # empty repository / listing shrinked while scraping
+                if not res:
+                    return
+                yield res
+            first_page += window
+
+    def repo_issues(self, repo_name, page=None, since=None):
+        # type: (str, int, str) -> Iterable[dict]
+        """
+        :param repo_name: str, <owner>/<repo>
+        :param page: int, only return this page
+        :param since: str, ISO timestamp; only return issues updated after
+            this date (inclusive)
+        """
         url = "repos/%s/issues" % repo_name
+        params = {'since': since} if since else {}
 
         # might throw RepoDoesNotExist
-        if page is None:
-            data = self.request(url, paginate=True, state='all')
+        if page is None:  # issues are yielded as pages come
+            data = itertools.chain.from_iterable(
+                self.pages(url, state='all', **params))
         else:
-            data = self.request(url, page=page, per_page=100, state='all')
+            data = self.request(url, page=page, per_page=100, state='all',
+                                **params)
 
         for issue in data:
             if 'pull_request' not in issue:
-                yield {
-                    'author': issue['user']['login'],
-                    'closed': issue['state'] != "open",
-                    'created_at': issue['created_at'],
-                    'updated_at': issue['updated_at'],
-                    'closed_at': issue['closed_at'],
-                    'number': issue['number'],
-                    'title': issue['title']
-                }
-
-    def repo_commits(self, repo_name, page=None):
-        # type: (str, int) -> Iterable[dict]
+                yield self._parse_issue(issue)
 
+    def repo_issues_pages(self, repo_name, since=None, first_page=1):
+        # type: (str, str, int) -> Iterable[tuple]
+        """ Same as repo_issues(), but yields (page number, list of issues),
+        starting from first_page. It allows to save progress after every page
+        and to resume later. Pull requests are skipped, so some of the pages
+        might be empty.
+        """
+        url = "repos/%s/issues" % repo_name
+        params = {'since': since} if since else {}
+        pages = self.pages(url, state='all', page=first_page, **params)
+        for page, data in enumerate(pages, first_page):
+            yield page, [self._parse_issue(issue) for issue in data
+                         if 'pull_request' not in issue]
+
+    def repo_commits(self, repo_name, page=None, since=None):
+        # type: (str, int, str) -> Iterable[dict]
+        """
+        :param repo_name: str, <owner>/<repo>
+        :param page: int, only return this page
+        :param since: str, ISO timestamp; only return commits committed after
+            this date (inclusive)
+        """
         url = "repos/%s/commits" % repo_name
+        params = {'since': since} if since else {}
 
         # might throw RepoDoesNotExist
-        if page is None:
-            data = self.request(url, paginate=True)
+        if page is None:  # commits are yielded as pages come
+            data = itertools.chain.from_iterable(self.pages(url, **params))
         else:
-            data = self.request(url, page=page, per_page=100)
+            data = self.request(url, page=page, per_page=100, **params)
 
         for commit in data:
-            # might be None for commits authored outside of github
-            github_author = commit['author'] or {}
-            commit_author = commit['commit'].get('author') or {}
-            yield {
-                'sha': commit['sha'],
-                'author': github_author.get('login'),
-                'author_name': commit_author.get('name'),
-                'author_email': commit_author.get('email'),
-                'authored_date': commit_author.get('date'),
-                'message': commit['commit']['message'],
-                'committed_date': commit['commit']['committer']['date'],
-                'parents': "\n".join(p['sha'] for p in commit['parents']),
-                'verified': commit.get('verification', {}).get('verified')
-            }
+            yield self._parse_commit(commit)
+
+    def repo_commits_pages(self, repo_name, since=None, first_page=1):
+        # type: (str, str, int) -> Iterable[tuple]
+        """ Same as repo_commits(), but yields (page number, list of commits),
+        starting from first_page. See repo_issues_pages() for details
+        """
+        url = "repos/%s/commits" % repo_name
+        params = {'since': since} if since else {}
+        pages = self.pages(url, page=first_page, **params)
+        for page, data in enumerate(pages, first_page):
+            yield page, [self._parse_commit(commit) for commit in data]
+
+    @staticmethod
+    def _parse_issue(issue):
+        # type: (dict) -> dict
+        return {
+            'author': issue['user']['login'],
+            'closed': issue['state'] != "open",
+            'created_at': issue['created_at'],
+            'updated_at': issue['updated_at'],
+            'closed_at': issue['closed_at'],
+            'number': issue['number'],
+            'title': issue['title']
+        }
+
+    @staticmethod
+    def _parse_commit(commit):
+        # type: (dict) -> dict
+        # might be None for commits authored outside of github
+        github_author = commit['author'] or {}
+        commit_author = commit['commit'].get('author') or {}
+        return {
+            'sha': commit['sha'],
+            'author': github_author.get('login'),
+            'author_name': commit_author.get('name'),
+            'author_email': commit_author.get('email'),
+            'authored_date': commit_author.get('date'),
+            'message': commit['commit']['message'],
+            'committed_date': commit['commit']['committer']['date'],
+            'parents': "\n".join(p['sha'] for p in commit['parents']),
+            'verified': commit.get('verification', {}).get('verified')
+        }
+
+    def repo_contributor_stats(self, repo_name):
+        # type: (str) -> Iterable[dict]
+        """ Weekly number of commits by top 100 contributors, from
+        statistics endpoint, i.e. in one request for the whole history.
+        If statistics is not cached by GitHub, it will start computing it
+        and StatsNotReady is raised; repeat the request in a minute or so.
+
+        :param repo_name: str, <owner>/<repo>
+        :return: generator of dicts:
+            - author: str, GitHub login, None for deleted accounts
+            - week: str, YYYY-MM-DD of the week start (Sunday), UTC
+            - commits: int, > 0
+        """
+        # might throw RepoDoesNotExist
+        r = self._request("repos/%s/stats/contributors" % repo_name)
+        if r.status_code == 202:
+            raise StatsNotReady("GitHub is computing statistics for %s"
+                                % repo_name, response=r)
+        if r.status_code in (204, 409):  # empty repository
+            return
+        r.raise_for_status()
+        for contributor in r.json() or []:
+            author = (contributor.get('author') or {}).get('login')
+            for week in contributor['weeks']:
+                if week['c']:
+                    yield {
+                        'author': author,
+                        'week': datetime.utcfromtimestamp(
+                            week['w']).strftime("%Y-%m-%d"),
+                        'commits': week['c']
+                    }
 
     def user_info(self, user):
         # TODO: support pagination
@@ -253,9 +726,15 @@ class GitHubAPI(object):
         # TODO: support pagination
         return self.request("users/%s/orgs" % user)
 
-    @staticmethod
-    def project_exists(repo_name):
-        return bool(requests.head("https://github.com/" + repo_name))
+    def project_exists(self, repo_name):
+        start = time.time()
+        try:
+            r = self.session.head(self.web_url + repo_name)
+        except requests.exceptions.RequestException:
+            self._feedback()
+            raise
+        self._feedback(r, time.time() - start)
+        return bool(r)
 
     @staticmethod
     def canonical_url(project_url):
@@ -285,10 +764,11 @@ class GitHubAPI(object):
             url = url[:-4]
         return "github.com/" + url
 
-    @staticmethod
-    def activity(repo_name):
+    def activity(self, repo_name):
         # type: (str) -> dict
-        """Unofficial method to get top 100 contributors commits by week"""
+        """Unofficial method to get top 100 contributors commits by week.
+        Web pages don't need a token, but the least busy token's session
+        is used to reuse its connections """
         url = "https://github.com/%s/graphs/contributors" % repo_name
         headers = {
             'X-Requested-With': 'XMLHttpRequest',
@@ -303,89 +783,400 @@ class GitHubAPI(object):
             "Connection": "keep-alive",
             "Cache-Control": 'max-age=0',
         }
-        cookies = requests.get(url).cookies
-        r = requests.get(url + "-data", cookies=cookies, headers=headers)
+        token = min(self.tokens, key=lambda t: t.in_flight)
+        # the session keeps both cookies and the connection
+        with token.busy():
+            token.session.get(url, timeout=token.timeout)
+            r = token.session.get(url + "-data", headers=headers,
+                                  timeout=token.timeout)
         r.raise_for_status()
         return r.json()
 
 
 class GitHubAPIv4(GitHubAPI):
+    # fields of users_info() query, same as GitHubAPI.user_info() returns
+    # organizations don't have followers, so they will get zeroes
+    USER_FIELDS = """login, createdAt, __typename,
+        repositories(privacy: PUBLIC) {totalCount}
+        ... on User {followers {totalCount}, following {totalCount}}"""
+    # fields of repo_commits() query, same as scraper.utils.commits() stores
+    COMMIT_FIELDS = """sha: oid, authoredDate, committedDate, message,
+        author {name, email, user {login}},
+        parents (first: 100) {nodes {oid}}"""
+    # fields of repo_issues() query, same as GitHubAPI.repo_issues() returns
+    ISSUE_FIELDS = """number, title, closed, createdAt, updatedAt, closedAt,
+        author {login}"""
+    # GraphQL resource limits, https://developer.github.com/v4/guides/
+    # resource-limitations/ Each query can return up to MAX_NODES nodes,
+    # and every token has 5000 points per hour
+    MAX_NODES = 500000
+    # default hourly budget of this process, points; None for no limit
+    hourly_budget = getattr(settings, 'SCRAPER_GRAPHQL_HOURLY_BUDGET', None)
+
+    def __init__(self, *args, **kwargs):
+        super(GitHubAPIv4, self).__init__(*args, **kwargs)
+        # points spent by batched queries, see v4_batch()
+        self.cost = {'queries': 0, 'points': 0}
+        self._spent = collections.deque()  # (timestamp, points)
+        self._cost_lock = threading.Lock()
+
+    @staticmethod
+    def query_cost(connections):
+        # type: (int) -> int
+        """ Estimate query cost in points, same way as GitHub does it:
+        number of requested connections (of up to 100 nodes each) / 100
+
+        >>> GitHubAPIv4.query_cost(1), GitHubAPIv4.query_cost(260)
+        (1, 3)
+        """
+        return max(1, int(connections / 100.0 + 0.5))
+
+    def _reserve(self, points):
+        # type: (int) -> None
+        """ Wait until the hourly budget allows to spend given points """
+        if not self.hourly_budget:
+            return
+        while True:
+            with self._cost_lock:
+                now = time.time()
+                while self._spent and self._spent[0][0] < now - 3600:
+                    self._spent.popleft()
+                spent = sum(p for _, p in self._spent)
+                if not self._spent or spent + points <= self.hourly_budget:
+                    self._spent.append((now, points))
+                    return
+                sleep = self._spent[0][0] + 3600 - now
+            logger.info("GraphQL hourly budget (%d points) is spent, "
+                        "resuming in %d minutes, %d seconds",
+                        self.hourly_budget, *divmod(sleep, 60))
+            time.sleep(sleep)
+            self.metrics.slept('graphql_budget', sleep)
+
+    def _spend(self, estimated, actual):
+        # type: (int, int) -> None
+        """ Record actual cost of a query, reserved as `estimated` """
+        with self._cost_lock:
+            self.cost['queries'] += 1
+            self.cost['points'] += actual
+            if self.hourly_budget and actual != estimated:
+                self._spent.append((time.time(), actual - estimated))
+
+    def _batches(self, items, batch_size, nodes_per_item):
+        # type: (list, int, int) -> Iterable[list]
+        """ Split items into batches under the per-query node limit """
+        size = max(1, min(batch_size, self.MAX_NODES // nodes_per_item))
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
 
     def v4(self, query, **params):
         # type: (str) -> dict
         payload = json.dumps({"query": query, "variables": params})
         return self.request("graphql", 'post', data=payload)
 
-    def repo_issues(self, repo_name, cursor=None):
-        # type: (str, str) -> Iterable[dict]
-        owner, repo = repo_name.split("/")
-        query = """query ($owner: String!, $repo: String!, $cursor: String) {
-        repository(name: $repo, owner: $owner) {
-          hasIssuesEnabled
-            issues (first: 100, after: $cursor,
-              orderBy: {field:CREATED_AT, direction: ASC}) {
-                nodes {author {login}, closed, createdAt,
-                       updatedAt, number, title}
-                pageInfo {endCursor, hasNextPage}
-        }}}"""
+    def v4_batch(self, fragments, connections=0, **params):
+        # type: (Iterable[str], int, dict) -> list
+        """ Combine several aliased queries into one request
 
-        while True:
-            data = self.v4(query, owner=owner, repo=repo, cursor=cursor
-                           )['data']['repository']
-            if not data:  # repository is empty, deleted or moved
-                break
+        :param fragments: query bodies, each using variables $v<i>_<name>,
+            e.g. 'repositoryOwner(login: $v0_login) {login}'
+        :param connections: number of connections (lists of up to 100 nodes)
+            requested by each fragment, to estimate cost of the query
+        :param params: dict of variables, in form <name>=[values]
+            (one per fragment). All variables are assumed to be String!
+        :return: list of results, one per fragment; None if the object
+            does not exist (e.g. deleted account)
 
-            for issue in data["issues"]:
-                yield {
-                    'author': issue['author']['login'],
-                    'closed': issue['closed'],
-                    'created_at': issue['createdAt'],
-                    'updated_at': issue['updatedAt'],
-                    'closed_at': None,
-                    'number': issue['number'],
-                    'title': issue['title']
-                }
+        Objects that don't exist come with NOT_FOUND errors. Any other error,
+        even if it is about a single fragment (e.g. a timeout), raises
+        HTTPError, so that failed fragments are not mistaken for missing
+        objects.
+        """
+        fragments = list(fragments)
+        if not fragments:
+            return []
+        variables = {"v%d_%s" % (i, name): value
+                     for name, values in params.items()
+                     for i, value in enumerate(values)}
+        query = "query (%s) {\n%s\nrateLimit {cost}\n}" % (
+            ", ".join("$%s: String!" % v for v in sorted(variables)),
+            "\n".join("a%d: %s" % (i, fragment)
+                      for i, fragment in enumerate(fragments)))
+        estimated = self.query_cost(connections * len(fragments))
+        self._reserve(estimated)
+        res = self.v4(query, **variables)
+        data = res.get('data')
+        if data is None:  # the whole query failed
+            self._spend(estimated, 0)
+            raise requests.HTTPError(
+                "GraphQL query failed: %s" % res.get('errors'))
+        self._spend(estimated,
+                    (data.get('rateLimit') or {}).get('cost', estimated))
+        errors = [error for error in res.get('errors') or ()
+                  if error.get('type') != 'NOT_FOUND']
+        if errors:
+            raise requests.HTTPError("GraphQL query failed: %s" % errors)
+        return [data.get("a%d" % i) for i in range(len(fragments))]
+
+    def users_info(self, logins):
+        # type: (Iterable[str]) -> Iterable[dict]
+        """ Get profiles of several users or organizations in one request.
+        Output has the same fields as GitHubAPI.user_info(); login is the
+        same as requested (i.e. case is preserved). Up to 100 logins per call
+        is reasonable.
+
+        :return: generator of dicts, one per login in the same order;
+            None if the account does not exist
+        """
+        logins = list(logins)
+        fragment = "repositoryOwner(login: $v%d_login) {%s}"
+        users = self.v4_batch(
+            (fragment % (i, self.USER_FIELDS) for i in range(len(logins))),
+            login=logins)
+
+        for login, user in zip(logins, users):
+            if user is None:  # account does not exist
+                yield None
+                continue
+            yield {
+                'login': login,
+                'created_at': user['createdAt'],
+                'type': user['__typename'],
+                'public_repos': user['repositories']['totalCount'],
+                'followers': user.get('followers', {}).get('totalCount', 0),
+                'following': user.get('following', {}).get('totalCount', 0)
+            }
 
-            cursor = data["issues"]["pageInfo"]["endCursor"]
+    def repos_info(self, repo_names):
+        # type: (Iterable[str]) -> Iterable[dict]
+        """ Check existence of several repositories in one request.
+        Up to 100 repositories per call is reasonable.
 
-            if not data["issues"]["pageInfo"]["hasNextPage"]:
+        :param repo_names: iterable of <owner>/<repo>
+        :return: generator of dicts, one per repository, in the same order:
+            - repo: str, repository name as requested
+            - exists: bool
+            - name: str, actual <owner>/<repo>, i.e. after renames/transfers
+            - fork: bool
+            - archived: bool
+        """
+        repo_names = list(repo_names)
+        owners, names = zip(*(name.split("/", 1) for name in repo_names)) \
+            if repo_names else ((), ())
+        fragment = "repository(owner: $v%d_owner, name: $v%d_name) " \
+                   "{nameWithOwner, isFork, isArchived}"
+        repos = self.v4_batch((fragment % (i, i)
+                               for i in range(len(repo_names))),
+                              owner=owners, name=names)
+
+        for repo_name, repo in zip(repo_names, repos):
+            repo = repo or {}
+            yield {
+                'repo': repo_name,
+                'exists': bool(repo),
+                'name': repo.get('nameWithOwner'),
+                'fork': repo.get('isFork'),
+                'archived': repo.get('isArchived')
+            }
+
+    def repo_issues(self, repo_name, page=None, since=None, cursor=None):
+        # type: (str, int, str, str) -> Iterable[dict]
+        """ Same as GitHubAPI.repo_issues(), but `page` and `since` are not
+        supported: GraphQL pages are cursor based and ordered differently.
+        Might throw RepoDoesNotExist
+
+        :param cursor: str, GraphQL cursor to continue from, i.e.
+            endCursor of the last page received before
+        """
+        if page is not None or since is not None:
+            raise NotImplementedError(
+                "GraphQL issues backend does not support page and since")
+        for _, issues in self.repos_issues(
+                [repo_name], cursors={repo_name: cursor}):
+            if issues is None:
+                raise RepoDoesNotExist(
+                    "GH API returned no data for %s" % repo_name)
+            for issue in issues:
+                yield issue
+
+    def repos_issues(self, repo_names, batch_size=50, cursors=None):
+        # type: (Iterable[str], int, dict) -> Iterable[tuple]
+        """ Get issues of many repositories in batched queries.
+        Most repositories have less than 100 issues and so only need one page
+        of a batch; only the ones having more are paginated further, also in
+        batches. Batches are limited by the number of nodes per query; with
+        hourly_budget set, queries also wait for the budget.
+
+        :param repo_names: iterable of <owner>/<repo>
+        :param batch_size: max number of repositories in one query;
+            large queries tend to time out
+        :param cursors: {repo_name: cursor} to continue from, see
+            repo_issues()
+        :return: generator of (repo_name, list of issues), in order of
+            completion. Issues are in GitHubAPI.repo_issues() format;
+            None instead of the list if the repository does not exist
+        """
+        first = "repository(owner: $v%d_owner, name: $v%d_name) {" \
+                "issues (first: 100, orderBy: {field: CREATED_AT, " \
+                "direction: ASC}) {nodes {%s}, " \
+                "pageInfo {endCursor, hasNextPage}}}"
+        rest = "repository(owner: $v%d_owner, name: $v%d_name) {" \
+               "issues (first: 100, after: $v%d_cursor, orderBy: " \
+               "{field: CREATED_AT, direction: ASC}) {nodes {%s}, " \
+               "pageInfo {endCursor, hasNextPage}}}"
+
+        issues = {}
+        cursors = cursors or {}
+        # (repo_name, cursor); cursor is None for the first page
+        queue = [(repo_name, cursors.get(repo_name))
+                 for repo_name in repo_names]
+        while queue:
+            pending = []
+            # first pages and the rest are requested by different queries
+            batches = itertools.chain(*(
+                self._batches([item for item in queue
+                               if (item[1] is None) == first_page],
+                              batch_size, 100)
+                for first_page in (True, False)))
+            for batch in batches:
+                owners, names = zip(*(repo_name.split("/", 1)
+                                      for repo_name, _ in batch))
+                if batch[0][1] is None:
+                    results = self.v4_batch(
+                        (first % (i, i, self.ISSUE_FIELDS)
+                         for i in range(len(batch))),
+                        connections=1, owner=owners, name=names)
+                else:
+                    results = self.v4_batch(
+                        (rest % (i, i, i, self.ISSUE_FIELDS)
+                         for i in range(len(batch))), connections=1,
+                        owner=owners, name=names,
+                        cursor=[cursor for _, cursor in batch])
+
+                for (repo_name, _), repo in zip(batch, results):
+                    if repo is None:
+                        # might be gone after the first page
+                        issues.pop(repo_name, None)
+                        yield repo_name, None
+                        continue
+                    page = repo['issues']
+                    issues.setdefault(repo_name, []).extend(
+                        self._parse_issue(issue) for issue in page['nodes'])
+                    if page['pageInfo']['hasNextPage']:
+                        pending.append(
+                            (repo_name, page['pageInfo']['endCursor']))
+                    else:
+                        yield repo_name, issues.pop(repo_name)
+            queue = pending
+
+    @staticmethod
+    def _parse_issue(issue):
+        # type: (dict) -> dict
+        return {
+            # author is None for deleted accounts, REST API calls them ghosts
+            'author': (issue['author'] or {}).get('login', 'ghost'),
+            'closed': issue['closed'],
+            'created_at': issue['createdAt'],
+            'updated_at': issue['updatedAt'],
+            'closed_at': issue['closedAt'],
+            'number': issue['number'],
+            'title': issue['title']
+        }
+
+    def repos_commit_counts(self, repo_names, batch_size=100):
+        # type: (Iterable[str], int) -> Iterable[dict]
+        """ Number of commits in the default branch of many repositories,
+        e.g. to decide which commits backend to use or to estimate quota.
+
+        :param repo_names: iterable of <owner>/<repo>
+        :return: generator of dicts, in the same order:
+            - repo: str, repository name as requested
+            - commits: int, number of commits; 0 for empty repositories,
+                None if the repository does not exist
+        """
+        fragment = "repository(owner: $v%d_owner, name: $v%d_name) {" \
+                   "defaultBranchRef {target {... on Commit {" \
+                   "history {totalCount}}}}}"
+        for batch in self._batches(list(repo_names), batch_size, 1):
+            owners, names = zip(*(name.split("/", 1) for name in batch))
+            results = self.v4_batch(
+                (fragment % (i, i) for i in range(len(batch))),
+                owner=owners, name=names)
+            for repo_name, repo in zip(batch, results):
+                if repo is None:
+                    commits = None
+                elif repo['defaultBranchRef'] is None:
+                    commits = 0
+                else:
+                    commits = repo['defaultBranchRef']['target'][
+                        'history']['totalCount']
+                yield {'repo': repo_name, 'commits': commits}
+
+    def repo_commits(self, repo_name, page=None, since=None):
+        # type: (str, int, str) -> Iterable[dict]
+        """ Same as GitHubAPI.repo_commits(), but only fields stored by
+        scraper.utils.commits() and messages are requested, i.e. no
+        verification, files or URLs. Commits are from the default branch.
+        """
+        for _, commits in self.repo_commits_pages(
+                repo_name, since=since, first_page=page or 1):
+            for commit in commits:
+                yield commit
+            if page is not None:  # only this page was requested
                 break
 
-    def repo_commits(self, repo_name, cursor=None):
-        # type: (str, str) -> Iterable[dict]
-        """As of June 2017 GraphQL API does not allow to get commit parents
-        Until this issue is fixed this method is only left for a reference
-        Please use commits() instead"""
+    def repo_commits_pages(self, repo_name, since=None, first_page=1):
+        # type: (str, str, int) -> Iterable[tuple]
+        """ Same as GitHubAPI.repo_commits_pages().
+        GraphQL pagination is cursor based, so to start from first_page
+        previous pages are still requested, but only for their cursors.
+        """
         owner, repo = repo_name.split("/")
-        query = """query ($owner: String!, $repo: String!, $cursor: String) {
+        query = """query ($owner: String!, $repo: String!, $cursor: String,
+                          $since: GitTimestamp) {
         repository(name: $repo, owner: $owner) {
-          ref(qualifiedName: "master") {
-            target { ... on Commit {
-              history (first: 100, after: $cursor) {
-                nodes {sha:oid, author {name, email, user{login}}
-                       message, committedDate}
-                pageInfo {endCursor, hasNextPage}
+          defaultBranchRef { target { ... on Commit {
+            history (first: 100, after: $cursor, since: $since) {
+              %s
+              pageInfo {endCursor, hasNextPage}
         }}}}}}"""
+        fields = query % ("nodes {%s}" % self.COMMIT_FIELDS)
+        cursor_only = query % ""
 
+        cursor = None
+        page = 1
         while True:
-            data = self.v4(query, owner=owner, repo=repo, cursor=cursor
-                           )['data']['repository']
-            if not data:
-                break
+            res = self.v4(fields if page >= first_page else cursor_only,
+                          owner=owner, repo=repo, cursor=cursor, since=since)
+            data = (res.get('data') or {}).get('repository')
+            if data is None:
+                raise RepoDoesNotExist(
+                    "GH API returned errors: %s" % res.get('errors'))
+            if data['defaultBranchRef'] is None:  # empty repository
+                return
 
-            for commit in data["ref"]["target"]["history"]["nodes"]:
-                yield {
-                    'sha': commit['sha'],
-                    'author': commit['author']['user']['login'],
-                    'author_name': commit['author']['name'],
-                    'author_email': commit['author']['email'],
-                    'authored_date': None,
-                    'message': commit['message'],
-                    'committed_date': commit['committedDate'],
-                    'parents': None,
-                    'verified': None
-                }
-
-            cursor = data["ref"]["target"]["history"]["pageInfo"]["endCursor"]
-            if not data["ref"]["target"]["history"]["pageInfo"]["hasNextPage"]:
-                break
+            history = data['defaultBranchRef']['target']['history']
+            if page >= first_page:
+                yield page, [self._parse_commit(commit)
+                             for commit in history['nodes']]
+            if not history['pageInfo']['hasNextPage']:
+                return
+            cursor = history['pageInfo']['endCursor']
+            page += 1
+
+    @staticmethod
+    def _parse_commit(commit):
+        # type: (dict) -> dict
+        author = commit['author'] or {}
+        # user is None for commits authored outside of github
+        github_author = author.get('user') or {}
+        return {
+            'sha': commit['sha'],
+            'author': github_author.get('login'),
+            'author_name': author.get('name'),
+            'author_email': author.get('email'),
+            'authored_date': commit['authoredDate'],
+            'message': commit['message'],
+            'committed_date': commit['committedDate'],
+            'parents': "\n".join(
+                p['oid'] for p in commit['parents']['nodes'])
+        }
@@ -0,0 +1,453 @@
+""" asyncio counterpart of scraper.github
+
+Unlike GitHubAPI, which is limited by number of threads running it, this
+implementation keeps many requests in flight from a single thread.
+Python 3.6+ only, requires aiohttp (pip install aiohttp).
+
+Shared HTTP cache and token ledger do file IO, so they are called in
+the default executor not to block the event loop.
+
+Example:
+    api = AsyncGitHubAPI()
+
+    async def count(repo):
+        return len([c async for c in api.repo_commits(repo)])
+
+    asyncio.get_event_loop().run_until_complete(count("benjaminp/six"))
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Iterable
+
+import aiohttp
+import pandas as pd
+import requests
+from multidict import CIMultiDict  # aiohttp dependency
+
+from scraper import github
+
+logger = logging.getLogger('ghd.scraper')
+
+# maximum number of simultaneous connections per token
+CONNECTIONS_PER_TOKEN = 64
+# threads reading and writing caches for scrape()
+IO_WORKERS = 4
+
+
+async def _blocking(func, *args, **kwargs):
+    """ Run a blocking call in the default executor """
+    return await asyncio.get_event_loop().run_in_executor(
+        None, functools.partial(func, *args, **kwargs))
+
+
+class _Response(object):
+    """ Minimal requests.Response lookalike, returned by AsyncGitHubAPIToken
+    so that response processing can be shared with the synchronous API """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode('utf8'))
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            raise requests.HTTPError("GH API returned status %s"
+                                     % self.status_code, response=self)
+
+
+class AsyncGitHubAPIToken(github.GitHubAPIToken):
+
+    def make_session(self):
+        return None  # see request()
+
+    def pool_stats(self):
+        # aiohttp does not keep connection statistics
+        return {'requests': 0, 'connections': 0, 'idle': 0, 'open': 0}
+
+    async def request(self, url, method='get', data=None, **params):
+        if not self.ready(url):
+            raise github.TokenNotReady
+
+        if self.session is None:
+            # session has to be created inside of a running event loop
+            self.session = aiohttp.ClientSession(
+                headers=self._headers,
+                connector=aiohttp.TCPConnector(limit=CONNECTIONS_PER_TOKEN),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        # aiohttp only accepts str query parameters
+        params = {k: str(v) for k, v in params.items()}
+
+        cache_key = None
+        headers = None
+        if method == 'get' and self.http_cache is not None:
+            cache_key = self.http_cache.key(url, params)
+            headers = await _blocking(
+                self.http_cache.conditional_headers, cache_key)
+
+        r = await self._send(url, method, data, params, headers)
+        if cache_key is None:
+            return r
+        if r.status_code == 304:
+            cached = await _blocking(self.http_cache.load, cache_key)
+            if cached is not None:
+                cached_headers, content = cached
+                # fresh rate limit headers should take precedence
+                response_headers = CIMultiDict(cached_headers)
+                response_headers.update(r.headers)
+                return _Response(200, response_headers, content)
+            # evicted or corrupted, ask again unconditionally
+            r = await self._send(url, method, data, params, None)
+        if r.status_code == 200:
+            await _blocking(self.http_cache.store, cache_key, r.headers,
+                            r.content)
+        return r
+
+    async def _send(self, url, method, data, params, headers):
+        """ Make a single HTTP request and record it """
+        start = time.time()
+        try:
+            # might throw asyncio.TimeoutError
+            with self.busy():
+                async with self.session.request(
+                        method, self.api_url + url, params=params,
+                        data=data, headers=headers) as r:
+                    status = r.status
+                    response_headers = r.headers
+                    content = await r.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.metrics.request(self.id, self.api_class(url),
+                                 e.__class__.__name__, time.time() - start,
+                                 endpoint=self.endpoint(url))
+            raise
+        self.metrics.request(self.id, self.api_class(url), status,
+                             time.time() - start, len(content),
+                             response_headers.get('X-RateLimit-Remaining'),
+                             self.endpoint(url))
+        if self.ledger is None:
+            self._update_limits(url, status, response_headers)
+        else:
+            await _blocking(self._update_limits, url, status,
+                            response_headers)
+        self._check_throttling(status, response_headers, content)
+        return _Response(status, response_headers, content)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AsyncGitHubAPI(github.GitHubAPI):
+    """ Coroutine version of GitHubAPI.
+    All request methods have to be awaited, repo_commits and repo_issues are
+    asynchronous generators.
+    Token limits bookkeeping is the same as in GitHubAPI, but since requests
+    are concurrent, the least busy token is used first.
+    """
+    token_class = AsyncGitHubAPIToken
+
+    async def _request(self, url, method='get', data=None, **params):
+        # type: (str, str, str) -> _Response
+        """ See GitHubAPI._request() """
+        attempts = 0
+
+        while True:
+            if self.tokens and self.tokens[0].ledger is not None:
+                candidates = await _blocking(self._candidates, url)
+            else:
+                candidates = self._candidates(url)
+            for token in candidates:
+                if not token.ready(url):
+                    continue
+
+                try:
+                    r = await token.request(url, method=method, data=data,
+                                            **params)
+                except github.TokenThrottled:
+                    self.metrics.retry('secondary_limit')
+                    continue
+                except github.TokenNotReady:
+                    self.metrics.retry('token_exhausted')
+                    continue
+                except (aiohttp.ClientConnectionError,
+                        asyncio.TimeoutError) as e:
+                    attempts += 1
+                    if attempts >= github.MAX_ATTEMPTS:
+                        raise
+                    self.metrics.retry(e.__class__.__name__)
+                    token.cool_down()
+                    continue  # i.e. try again
+
+                if r.status_code >= 500 and \
+                        attempts + 1 < github.MAX_ATTEMPTS:
+                    attempts += 1
+                    self.metrics.retry('server_error')
+                    token.cool_down()
+                    continue
+                if r.status_code in (404, 451):  # API v3 only
+                    raise github.RepoDoesNotExist(
+                        "GH API returned status %s" % r.status_code)
+                return r
+
+            sleep = await _blocking(self._out_of_keys, url)
+            if sleep > 0:
+                logger.info(
+                    "%s: out of keys, resuming in %d minutes, %d seconds",
+                    datetime.now().strftime("%H:%M"), *divmod(sleep, 60))
+                await asyncio.sleep(sleep)
+                self.metrics.slept('out_of_keys', sleep)
+                logger.info(".. resumed")
+
+    async def request(self, url, method='get', paginate=False, data=None,
+                      **params):
+        # type: (str, str, bool, str) -> dict
+        """ Generic, API version agnostic request method """
+        if paginate:
+            paginated_res = []
+            async for page in self.pages(url, method=method, data=data,
+                                         **params):
+                paginated_res.extend(page)
+            return paginated_res
+
+        r = await self._request(url, method=method, data=data, **params)
+        if r.status_code == 409:
+            # repository is empty https://developer.github.com/v3/git/
+            return {}
+        r.raise_for_status()
+        with self.metrics.timer('json'):
+            return r.json()
+
+    async def pages(self, url, method='get', data=None, **params):
+        """ Same as GitHubAPI.pages(): after the first page, pages are
+        requested concurrently in windows of PAGE_WORKERS_PER_TOKEN pages
+        per ready token, and yielded in order as soon as they come """
+        params['page'] = params.get('page', 1)
+        params['per_page'] = 100
+
+        r = await self._request(url, method=method, data=data, **params)
+        if r.status_code == 409:
+            # repository is empty https://developer.github.com/v3/git/
+            return
+        r.raise_for_status()
+        with self.metrics.timer('json'):
+            res = r.json()
+        yield res
+        last_page = self._last_page(r.headers)
+        if not res or not last_page:
+            return
+
+        first_page = params['page']
+        while first_page < last_page:
+            ready = sum(token.ready(url) for token in self.tokens)
+            window = min(last_page - first_page,
+                         max(ready, 1) * github.PAGE_WORKERS_PER_TOKEN)
+            tasks = [asyncio.ensure_future(self.request(
+                url, method=method, data=data, **dict(params, page=page)))
+                for page in range(first_page + 1, first_page + window + 1)]
+            try:
+                for task in tasks:
+                    res = await task
+                    # empty repository / listing shrinked while scraping
+                    if not res:
+                        return
+                    yield res
+            finally:  # error, or the consumer stopped early
+                for task in tasks:
+                    task.cancel()
+            first_page += window
+
+    async def repo_issues(self, repo_name, page=None, since=None):
+        url = "repos/%s/issues" % repo_name
+        params = {'since': since} if since else {}
+
+        # might throw RepoDoesNotExist
+        if page is not None:
+            data = await self.request(url, page=page, per_page=100,
+                                      state='all', **params)
+            for issue in data:
+                if 'pull_request' not in issue:
+                    yield self._parse_issue(issue)
+            return
+        async for data in self.pages(url, state='all', **params):
+            for issue in data:  # issues are yielded as pages come
+                if 'pull_request' not in issue:
+                    yield self._parse_issue(issue)
+
+    async def repo_issues_pages(self, repo_name, since=None, first_page=1):
+        """ See GitHubAPI.repo_issues_pages() """
+        url = "repos/%s/issues" % repo_name
+        params = {'since': since} if since else {}
+        page = first_page
+        async for data in self.pages(url, state='all', page=first_page,
+                                     **params):
+            yield page, [self._parse_issue(issue) for issue in data
+                         if 'pull_request' not in issue]
+            page += 1
+
+    async def repo_commits(self, repo_name, page=None, since=None):
+        url = "repos/%s/commits" % repo_name
+        params = {'since': since} if since else {}
+
+        # might throw RepoDoesNotExist
+        if page is not None:
+            data = await self.request(url, page=page, per_page=100, **params)
+            for commit in data:
+                yield self._parse_commit(commit)
+            return
+        async for data in self.pages(url, **params):
+            for commit in data:  # commits are yielded as pages come
+                yield self._parse_commit(commit)
+
+    async def repo_commits_pages(self, repo_name, since=None, first_page=1):
+        """ See GitHubAPI.repo_commits_pages() """
+        url = "repos/%s/commits" % repo_name
+        params = {'since': since} if since else {}
+        page = first_page
+        async for data in self.pages(url, page=first_page, **params):
+            yield page, [self._parse_commit(commit) for commit in data]
+            page += 1
+
+    async def close(self):
+        for token in self.tokens:
+            await token.close()
+
+
+async def _run(executor, func, *args):
+    """ Run file IO (caches, partial scrapes) in the given executor """
+    return await asyncio.get_event_loop().run_in_executor(
+        executor, functools.partial(func, *args))
+
+
+async def _stream(api_pages, cached_func, repo_url, frame, executor):
+    """ Coroutine version of scraper.utils.stream() """
+    from scraper import utils as scraper
+
+    partial = scraper.PartialScrape(cached_func, repo_url, frame)
+    first_page = await _run(executor, partial.open)
+    try:
+        async for page, records in api_pages(partial.project_url,
+                                             first_page=first_page):
+            await _run(executor, partial.write, page, records)
+    except BaseException:
+        await _run(executor, partial.close, True)
+        raise
+    await _run(executor, partial.close)
+    return await _run(executor, partial.result)
+
+
+async def _store(cached_func, repo_url, res, cached, executor):
+    if res is cached:  # nothing changed
+        await _run(executor, cached_func.unchanged, repo_url)
+    else:
+        await _run(executor, cached_func.store, res, repo_url)
+
+
+async def collect_commits(api, repo_url, executor=None):
+    # type: (AsyncGitHubAPI, str, concurrent.futures.Executor) -> None
+    """ Coroutine version of scraper.utils.commits(), filling its cache.
+    With commits backends other than 'api', scraper.utils.commits() is
+    called in the executor, since they don't use the REST API """
+    from scraper import utils as scraper
+
+    if scraper.commits_backend() != 'api':
+        await _run(executor, scraper.commits, repo_url)
+        return
+
+    _, project_url = scraper.parse_url(repo_url)
+    cached = await _run(executor, scraper.commits.previous, repo_url)
+    since = None if cached is None else cached['committed_date'].max()
+    res = None
+    if not pd.isnull(since):
+        # `since` is inclusive, so the last cached commit(s) will come again
+        res = scraper.merge_commits(cached, scraper.commits_frame(
+            [c async for c in api.repo_commits(project_url, since=since)]))
+        if res is None:
+            logger.info("%s: some of new commits are merged from older "
+                        "branches, scraping full history", repo_url)
+    if res is None:
+        res = await _stream(api.repo_commits_pages, scraper.commits,
+                            repo_url, scraper.commits_frame, executor)
+    await _store(scraper.commits, repo_url, res, cached, executor)
+
+
+async def collect_issues(api, repo_url, executor=None):
+    # type: (AsyncGitHubAPI, str, concurrent.futures.Executor) -> None
+    """ Coroutine version of scraper.utils.issues(), filling its cache """
+    from scraper import utils as scraper
+
+    _, project_url = scraper.parse_url(repo_url)
+    cached = await _run(executor, scraper.issues.previous, repo_url)
+    since = None if cached is None else cached['updated_at'].max()
+    if pd.isnull(since):
+        res = await _stream(api.repo_issues_pages, scraper.issues,
+                            repo_url, scraper.issues_frame, executor)
+    else:
+        res = scraper.merge_issues(cached, scraper.issues_frame(
+            [i async for i in api.repo_issues(project_url, since=since)]))
+    await _store(scraper.issues, repo_url, res, cached, executor)
+
+
+def scrape(urls, concurrency=256, api=None):
+    # type: (Iterable[str], int, AsyncGitHubAPI) -> None
+    """ Fill commits and issues caches for all given repository URLs
+    This is what build_cache does, but from a single thread: repositories
+    are processed by coroutines, at most `concurrency` at once.
+    Caches are refreshed incrementally, the same way scraper.utils.commits()
+    and issues() do it. Unlike them, it does not wait for other processes
+    scraping the same repository; whatever finishes last is stored.
+
+    Cache reads and writes are done by a small thread pool, not to block
+    the event loop.
+
+    :param urls: iterable of URLs, e.g. common.utils.package_urls(ecosystem)
+    :param concurrency: max number of repositories processed at once
+    :param api: AsyncGitHubAPI to use, a new one with default tokens by
+        default. It is closed at the end
+    """
+    # this module is imported by scraper.utils users only, no circular import
+    from scraper import utils as scraper
+
+    api = api or AsyncGitHubAPI()
+    executor = concurrent.futures.ThreadPoolExecutor(IO_WORKERS)
+
+    async def collect(url, semaphore):
+        provider_name, project_url = scraper.parse_url(url)
+        if provider_name != "github.com":
+            return
+        async with semaphore:
+            logger.info(project_url)
+            try:
+                if await _run(executor, scraper.commits.expired, url):
+                    await collect_commits(api, url, executor)
+                if await _run(executor, scraper.issues.expired, url):
+                    await collect_issues(api, url, executor)
+            except github.RepoDoesNotExist:
+                logger.info("    %s: repo doesn't exist", project_url)
+            except Exception as e:
+                # ThreadPool also logs and swallows worker exceptions
+                logger.exception(e)
+
+    async def main():
+        # semaphore has to be created inside of the running loop
+        semaphore = asyncio.Semaphore(concurrency)
+        try:
+            await asyncio.gather(*(collect(url, semaphore) for url in urls))
+        finally:
+            await api.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        executor.shutdown()
+        loop.close()
@@ -0,0 +1,310 @@
+""" Commits from local clones, an alternative to GitHub commits API
+
+Commits API returns 100 commits per request, so scraping large histories
+takes a lot of quota and time. This backend keeps a bare clone of every
+repository (only commits of branches are downloaded, no trees, blobs or
+pull request refs) and parses `git log` output instead.
+No tokens are required.
+
+Clones (mirrors) are kept in DATASET_PATH/scraper.cache/git, in folders
+named after canonical repository URL (e.g. github.com/user/repo.git).
+Next time they are updated with `git fetch`, so only new objects are
+transferred, and only commits not reachable from the already known ones are
+parsed (see `exclude` parameter of GitLog.repo_commits). Clones updated less
+than FETCH_INTERVAL seconds ago are used as is.
+To use a different location, set SCRAPER_GIT_PATH in settings.py.
+To check size of the store and remove repositories not used anymore,
+use `./manage.py git_mirrors`.
+
+Git does not know GitHub usernames, so `author` is only set for commits made
+with GitHub noreply emails (<id>+<login>@users.noreply.github.com).
+
+To use it instead of the API, set SCRAPER_COMMITS_BACKEND = 'git'
+in settings.py (see scraper.utils.commits).
+Requires git 2.20+ for --filter=tree:0; older versions will clone all
+trees and blobs.
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import re
+import shutil
+import subprocess
+import time
+from datetime import datetime
+from typing import Iterable
+
+from common import decorators
+from scraper import github
+
+try:
+    import settings
+except ImportError:
+    settings = object()
+
+logger = logging.getLogger('ghd.scraper')
+
+# number of commits in repo_commits_pages() chunks
+PAGE_SIZE = 1000
+# clones updated more recently than this are not fetched again, seconds
+FETCH_INTERVAL = 60
+# only branches are fetched, not pull requests or other refs
+REFSPEC = "+refs/heads/*:refs/heads/*"
+# fields separated by NUL, one commit per line
+LOG_FORMAT = "%H%x00%an%x00%ae%x00%at%x00%ct%x00%P"
+NOREPLY_PATTERN = re.compile(
+    r"^(?:\d+\+)?([^@+]+)@users\.noreply\.github\.com$")
+
+
+def _isoformat(timestamp):
+    # type: (str) -> str
+    """ Convert unix timestamp into the same format as GitHub API uses
+
+    >>> _isoformat("1514764800")
+    '2018-01-01T00:00:00Z'
+    """
+    return datetime.utcfromtimestamp(int(timestamp)).strftime(
+        "%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_log_line(line):
+    # type: (str) -> dict
+    """ Parse a line of `git log --format=LOG_FORMAT` output into the same
+    format as GitHubAPI.repo_commits() returns
+
+    >>> c = parse_log_line("a" * 40 + "\\x00John\\x0042+john@users.noreply."
+    ...     "github.com\\x001514764800\\x001514768400\\x00" + "b" * 40)
+    >>> c['author'], c['authored_date'], c['committed_date'], len(c['parents'])
+    ('john', '2018-01-01T00:00:00Z', '2018-01-01T01:00:00Z', 40)
+    """
+    sha, name, email, authored, committed, parents = \
+        line.rstrip("\n").split("\x00")
+    m = NOREPLY_PATTERN.match(email)
+    return {
+        'sha': sha,
+        'author': m and m.group(1),
+        'author_name': name,
+        'author_email': email,
+        'authored_date': _isoformat(authored),
+        'committed_date': _isoformat(committed),
+        'parents': "\n".join(parents.split())
+    }
+
+
+class GitLog(object):
+    """ Provider of repository commits, compatible with GitHubAPI
+    repo_commits() and repo_commits_pages()
+
+    clone_url is a template of repository URL; to work with local
+    repositories (e.g. in tests), set it to something like "/path/%s"
+    """
+    provider_name = None
+    clone_url = None
+    path = None  # root of the mirror store
+    fetch_interval = None
+
+    def __init__(self, provider_name='github.com', path=None, clone_url=None,
+                 fetch_interval=FETCH_INTERVAL):
+        self.provider_name = provider_name
+        self.fetch_interval = fetch_interval
+        self.path = path or default_path()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.clone_url = clone_url or "https://%s/%%s.git" % provider_name
+
+    def canonical_url(self, repo_name):
+        # type: (str) -> str
+        """ Mirror key, same as GitHubAPI.canonical_url for GitHub
+
+        >>> GitLog('gitlab.com', path='/tmp').canonical_url("A/B.git")
+        'gitlab.com/a/b'
+        """
+        if self.provider_name == 'github.com':
+            return github.GitHubAPI.canonical_url(repo_name)
+        url = repo_name.lower().rstrip("/")
+        while url.endswith(".git"):
+            url = url[:-4]
+        return "%s/%s" % (self.provider_name, url)
+
+    def _git(self, *args, **kwargs):
+        # type: (*str, **str) -> str
+        """ Run a git command, return its output.
+        Raises subprocess.CalledProcessError on failure """
+        cmd = ('git',) + args
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=kwargs.get('cwd'))
+        stdout, stderr = process.communicate()
+        if process.returncode:
+            raise subprocess.CalledProcessError(
+                process.returncode, " ".join(cmd),
+                stderr.decode('utf8', 'replace'))
+        return stdout.decode('utf8', 'replace')
+
+    def repo_path(self, repo_name):
+        # type: (str) -> str
+        return os.path.join(self.path, self.canonical_url(repo_name) + ".git")
+
+    def update(self, repo_name):
+        # type: (str) -> str
+        """ Clone the repository, or fetch new commits if already cloned.
+        Other threads and processes updating the same repository are waited
+        for, and their result is used if it is fresh enough
+        :return: path to the bare clone
+        """
+        path = self.repo_path(repo_name)
+        url = self.clone_url % repo_name
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:  # exists already
+            pass
+        with decorators._thread_lock(path), \
+                decorators._FileLock(path + ".lock"):
+            if not os.path.isdir(path):
+                # clone into a temporary folder so that an interrupted
+                # clone is not mistaken for a complete one
+                tmp_path = path + ".tmp"
+                if os.path.isdir(tmp_path):
+                    shutil.rmtree(tmp_path)
+                try:
+                    self._git('clone', '--bare', '--filter=tree:0',
+                              '--quiet', url, tmp_path)
+                except subprocess.CalledProcessError as e:
+                    logger.info("%s: git clone failed: %s",
+                                repo_name, e.output)
+                    raise github.RepoDoesNotExist(
+                        "Failed to clone %s: %s" % (url, e.output))
+                # bare clones don't fetch anything by default
+                self._git('config', 'remote.origin.fetch', REFSPEC,
+                          cwd=tmp_path)
+                os.rename(tmp_path, path)
+            elif time.time() - os.path.getmtime(path) >= self.fetch_interval:
+                try:
+                    # refspec is explicit for clones made with --mirror
+                    self._git('fetch', '--prune', '--quiet', 'origin',
+                              REFSPEC, cwd=path)
+                except subprocess.CalledProcessError as e:
+                    # the repository might be gone or just unreachable;
+                    # stale commits are better than none. The mirror is
+                    # not marked as fetched, so the next call tries again
+                    logger.warning("%s: git fetch failed, using the stale "
+                                   "mirror: %s", repo_name, e.output)
+                else:
+                    os.utime(path, None)
+        return path
+
+    def log(self, repo_name, since=None, exclude=()):
+        # type: (str, str, Iterable[str]) -> Iterable[dict]
+        """ Iterate commits of the default branch, newest first,
+        as they are parsed from git output
+
+        :param since: str, ISO timestamp; only return commits committed after
+        :param exclude: shas of commits to exclude, with their ancestors.
+            Unknown shas (e.g. after force push) are ignored
+        """
+        path = self.update(repo_name)
+        try:
+            self._git('rev-parse', '--verify', '--quiet', 'HEAD', cwd=path)
+        except subprocess.CalledProcessError:  # empty repository
+            return
+
+        # revisions to exclude are passed via stdin, there might be many
+        cmd = ['git', 'log', '--format=' + LOG_FORMAT, '--ignore-missing',
+               '--stdin', 'HEAD']
+        if since:
+            cmd.append('--since=' + since)
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, cwd=path)
+        # git reads all the input before producing any output,
+        # so it is safe to write it all at once
+        process.stdin.write("".join(
+            "^%s\n" % sha for sha in exclude).encode('ascii'))
+        process.stdin.close()
+        try:
+            for line in process.stdout:
+                yield parse_log_line(line.decode('utf8', 'replace'))
+        finally:
+            process.stdout.close()
+            if process.poll() is None:  # generator was not exhausted
+                process.kill()
+            process.wait()
+
+    def repo_commits(self, repo_name, page=None, since=None, exclude=()):
+        # type: (str, int, str, Iterable[str]) -> Iterable[dict]
+        """ Same as GitHubAPI.repo_commits(), but pages are PAGE_SIZE
+        commits long. See log() for `exclude` """
+        if page is None:
+            return self.log(repo_name, since=since, exclude=exclude)
+        for _, records in self.repo_commits_pages(
+                repo_name, since=since, first_page=page):
+            return iter(records)
+        return iter([])
+
+    def repo_commits_pages(self, repo_name, since=None, first_page=1):
+        # type: (str, str, int) -> Iterable[tuple]
+        """ Same as GitHubAPI.repo_commits_pages(), but pages are PAGE_SIZE
+        commits long """
+        page, records = 1, []
+        for commit in self.log(repo_name, since=since):
+            records.append(commit)
+            if len(records) == PAGE_SIZE:
+                if page >= first_page:
+                    yield page, records
+                page, records = page + 1, []
+        if records and page >= first_page:
+            yield page, records
+
+
+def default_path():
+    # type: () -> str
+    return getattr(settings, 'SCRAPER_GIT_PATH', None) or \
+        os.path.join(decorators.DATASET_PATH, 'scraper.cache', 'git')
+
+
+def mirrors(path=None):
+    # type: (str) -> dict
+    """ Get all mirrors in the store
+    :return: dict {canonical URL: path to the mirror}
+    """
+    path = path or default_path()
+    res = {}
+    for root, dirs, _ in os.walk(path):
+        for dirname in list(dirs):
+            if dirname.endswith(".git"):
+                dirs.remove(dirname)  # don't walk into mirrors
+                mirror_path = os.path.join(root, dirname)
+                res[os.path.relpath(mirror_path, path)[:-4]] = mirror_path
+    return res
+
+
+def disk_usage(path):
+    # type: (str) -> int
+    """ Size of all files in a folder, bytes """
+    return sum(os.path.getsize(os.path.join(root, fname))
+               for root, _, fnames in os.walk(path) for fname in fnames)
+
+
+def evict(keep, path=None):
+    # type: (Iterable[str], str) -> dict
+    """ Remove mirrors of repositories which are not used anymore
+
+    :param keep: canonical URLs of repositories to keep,
+        e.g. common.utils.package_urls(ecosystem)
+    :return: dict {canonical URL: freed bytes} of removed mirrors
+    """
+    path = path or default_path()
+    keep = set(keep)
+    removed = {}
+    for url, mirror_path in mirrors(path).items():
+        if url in keep:
+            continue
+        removed[url] = disk_usage(mirror_path)
+        shutil.rmtree(mirror_path)
+        # remove empty owner folders
+        parent = os.path.dirname(mirror_path)
+        while parent != path and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+    return removed
@@ -0,0 +1,274 @@
+""" On-disk cache of GitHub API responses for conditional requests
+
+GitHub does not count 304 (Not Modified) responses against the rate limit.
+So, every cached response is stored with its ETag and Last-Modified headers
+and next time the same URL is requested with If-None-Match/If-Modified-Since.
+If the server answers 304, the response is restored from the cache.
+
+Every record is two files: <key>.headers, a small JSON of the cached headers
+read before every request, and <key>.body.gz, only read on 304.
+Records not used for SCRAPER_HTTP_CACHE_MAX_AGE seconds (180 days by
+default) are ignored and removed; if the cache grows over
+SCRAPER_HTTP_CACHE_MAX_SIZE bytes (10GB by default), the least recently
+used records are removed.
+
+Cache is enabled by default and stored in DATASET_PATH/scraper.cache/http.
+To change location, set SCRAPER_HTTP_CACHE_PATH in settings.py;
+to disable, set SCRAPER_HTTP_CACHE = False.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from common import decorators
+
+try:
+    import settings
+except ImportError:
+    settings = object()
+
+logger = logging.getLogger('ghd.scraper')
+
+# response headers to be restored from cache on 304.
+# Link is required for pagination
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Link')
+MAX_AGE = getattr(settings, 'SCRAPER_HTTP_CACHE_MAX_AGE', 3600 * 24 * 180)
+MAX_SIZE = getattr(settings, 'SCRAPER_HTTP_CACHE_MAX_SIZE', 10 * 2 ** 30)
+# eviction runs every time this share of MAX_SIZE is written
+EVICT_FRACTION = 0.1
+
+# os.rename() does not replace existing files on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+
+class HTTPCache(object):
+    """ Thread safe storage of conditional request responses.
+
+    Only raw response parts are stored (headers and body), so it can be used
+    by both requests and aiohttp based tokens. Counters:
+        - requests: number of cacheable requests
+        - hits: number of requests answered from cache (HTTP 304)
+        - misses: number of requests which had to be downloaded again
+    Since 304 responses are free, hits is also the number of saved API calls
+    """
+    path = None
+
+    def __init__(self, path, max_size=MAX_SIZE, max_age=MAX_AGE):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.max_size = max_size  # None for no limit
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'hits': 0, 'misses': 0}
+        # bytes written since the last eviction; None if it never ran,
+        # so that the first store() checks what previous runs left
+        self._written = None
+        self._evicting = threading.Lock()
+
+    @staticmethod
+    def key(url, params):
+        # type: (str, dict) -> str
+        """ Cache key for a request, independent from params order.
+        Public data has the same ETags for all tokens, so records are shared
+        by tokens; with token rotation, a record is rarely reused by the
+        token which stored it
+
+        >>> HTTPCache.key("repos/a/b/commits", {"page": 2, "per_page": 100})
+        'a1429e2299c6fbef591c6a9491b31fd7'
+        """
+        query = "&".join("%s=%s" % (k, params[k]) for k in sorted(params))
+        return hashlib.md5((url + "?" + query).encode('utf8')).hexdigest()
+
+    def _fname(self, key, suffix):
+        return os.path.join(self.path, key[:2], key + suffix)
+
+    def _read_headers(self, key):
+        # type: (str) -> dict
+        fname = self._fname(key, ".headers")
+        try:
+            if self.max_age and \
+                    time.time() - os.path.getmtime(fname) > self.max_age:
+                self.remove(key)
+                return None
+            with open(fname, 'rb') as fh:
+                return json.loads(fh.read().decode('utf8'))
+        except (IOError, OSError, ValueError):  # missing or corrupted
+            return None
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def conditional_headers(self, key):
+        # type: (str) -> dict
+        """ Headers to add to the request to make it conditional """
+        self._count('requests')
+        cached = self._read_headers(key)
+        if cached is None:
+            return {}
+        headers = {}
+        if cached.get('ETag'):
+            headers['If-None-Match'] = cached['ETag']
+        if cached.get('Last-Modified'):
+            headers['If-Modified-Since'] = cached['Last-Modified']
+        return headers
+
+    def load(self, key):
+        # type: (str) -> (dict, bytes)
+        """ Get cached headers and body for a 304 response.
+        Returns None if the record was removed or is corrupted; in this case
+        the request should be repeated unconditionally """
+        headers = self._read_headers(key)
+        try:
+            with gzip.open(self._fname(key, ".body.gz"), 'rb') as fh:
+                content = fh.read()
+        except (IOError, OSError, EOFError, ValueError):
+            content = None
+        if headers is None or content is None:
+            logger.warning("HTTP cache record %s is missing or corrupted", key)
+            self.remove(key)
+            return None
+        self._count('hits')
+        # mark as recently used, see evict()
+        try:
+            os.utime(self._fname(key, ".headers"), None)
+        except OSError:  # evicted meanwhile
+            pass
+        return headers, content
+
+    def _write(self, fname, content, compress=False):
+        # write + rename to avoid partially written files
+        tmp_fname = "%s.%d.%d.tmp" % (
+            fname, os.getpid(), threading.current_thread().ident)
+        with (gzip.open if compress else open)(tmp_fname, 'wb') as fh:
+            fh.write(content)
+        _replace(tmp_fname, fname)
+
+    def store(self, key, headers, content):
+        # type: (str, dict, bytes) -> None
+        """ Store 200 response, if it can be requested conditionally """
+        self._count('misses')
+        if 'ETag' not in headers and 'Last-Modified' not in headers:
+            return
+        cached = {h: headers[h] for h in CACHED_HEADERS if h in headers}
+        decorators.mkdir(self.path, key[:2])
+        # headers go last: a record is complete once they are written
+        self._write(self._fname(key, ".body.gz"), content, compress=True)
+        self._write(self._fname(key, ".headers"),
+                    json.dumps(cached).encode('utf8'))
+        self._maybe_evict(len(content))
+
+    def remove(self, key):
+        # type: (str) -> None
+        for suffix in (".headers", ".body.gz"):
+            try:
+                os.remove(self._fname(key, suffix))
+            except OSError:  # removed already
+                pass
+
+    def _maybe_evict(self, size):
+        """ Start eviction in background after every EVICT_FRACTION of
+        max_size written """
+        if not self.max_size and not self.max_age:
+            return
+        with self.lock:
+            if self._written is not None:
+                self._written += size
+                if self._written < (self.max_size or 0) * EVICT_FRACTION:
+                    return
+            self._written = 0
+        if self._evicting.acquire(False):  # not running already
+            def run():
+                try:
+                    self.evict()
+                except Exception as e:  # e.g. concurrent removal
+                    logger.warning("HTTP cache eviction failed: %s", e)
+                finally:
+                    self._evicting.release()
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+
+    def evict(self):
+        # type: () -> (int, int)
+        """ Remove records not used for max_age seconds, then the least
+        recently used ones until the cache fits into max_size bytes
+        :return: (number of removed records, freed bytes)
+        """
+        records = {}  # key: [last used, size]
+        for root, _, fnames in os.walk(self.path):
+            for fname in fnames:
+                try:
+                    stat = os.stat(os.path.join(root, fname))
+                except OSError:  # removed meanwhile
+                    continue
+                # temporary files of interrupted writes are also evicted
+                record = records.setdefault(fname.split(".", 1)[0], [0, 0])
+                # headers are touched on every hit, see load()
+                if fname.endswith(".headers"):
+                    record[0] = stat.st_mtime
+                elif not record[0]:
+                    record[0] = -stat.st_mtime  # until headers are found
+                record[1] += stat.st_size
+
+        for record in records.values():
+            record[0] = abs(record[0])
+        now = time.time()
+        total = sum(size for _, size in records.values())
+        removed, freed = 0, 0
+        for key, (used, size) in sorted(records.items(),
+                                        key=lambda item: item[1][0]):
+            if not (self.max_age and now - used > self.max_age) and \
+                    not (self.max_size and total - freed > self.max_size):
+                break
+            dirname = os.path.join(self.path, key[:2])
+            for fname in os.listdir(dirname):
+                if fname.startswith(key + "."):
+                    try:
+                        os.remove(os.path.join(dirname, fname))
+                    except OSError:
+                        pass
+            removed += 1
+            freed += size
+        if removed:
+            logger.info("HTTP cache: %d records (%.1f MB) evicted",
+                        removed, freed / 1e6)
+        return removed, freed
+
+    def stats(self):
+        # type: () -> dict
+        """ Counters, plus hit ratio (which is also fraction of saved quota)
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        stats['hit_ratio'] = \
+            stats['requests'] and float(stats['hits']) / stats['requests']
+        return stats
+
+    def report(self):
+        # type: () -> str
+        stats = self.stats()
+        return ("HTTP cache: %(requests)d conditional requests, %(hits)d "
+                "answered from cache (API calls saved), %(misses)d downloaded,"
+                " hit ratio %(hit_ratio).1f%%"
+                % dict(stats, hit_ratio=stats['hit_ratio'] * 100))
+
+
+_cache = None
+
+
+def get_cache():
+    # type: () -> HTTPCache
+    """ Shared HTTPCache instance, None if disabled in settings """
+    global _cache
+    if _cache is None and getattr(settings, 'SCRAPER_HTTP_CACHE', True):
+        path = getattr(settings, 'SCRAPER_HTTP_CACHE_PATH', None) or \
+            os.path.join(decorators.DATASET_PATH, 'scraper.cache', 'http')
+        _cache = HTTPCache(path)
+    return _cache
@@ -0,0 +1,234 @@
+""" Rate limits of GitHub API tokens shared between processes
+
+Every process creating GitHubAPI() has its own view of token limits, so
+several scrapers running at the same time (e.g. build_cache for npm and pypi)
+exhaust the same tokens and race each other into 403s.
+TokenLedger keeps limits in an SQLite database, so that all processes
+reserve quota before making a request and report the actual limits after.
+To keep the database off the hot path, every process works with a local
+snapshot of the table: reservations and reports are applied to the snapshot
+and written in a single transaction at most every FLUSH_INTERVAL seconds,
+which also refreshes the snapshot with changes made by other processes.
+
+By default the ledger is stored in DATASET_PATH/scraper.cache/tokens.sqlite.
+To use a different location, set SCRAPER_TOKEN_LEDGER in settings.py; to
+disable, set it to False. Several hosts can share a ledger only if it is
+located on a filesystem with working locks (i.e. not NFS); otherwise, it is
+better to give them disjoint sets of tokens.
+"""
+
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from common import decorators
+from common import manifest
+
+try:
+    import settings
+except ImportError:
+    settings = object()
+
+# GitHub quota is counted over an hour since the first request,
+# search quota is counted per minute
+RESET_INTERVALS = {'core': 3600, 'search': 60, 'graphql': 3600}
+# used for tokens which were never seen by any process.
+# GraphQL limit is in points rather than requests
+DEFAULT_LIMITS = {'core': 5000, 'search': 30, 'graphql': 5000}
+# quota reserved per request. GraphQL queries cost at least one point, but
+# batched queries used by GitHubAPIv4 typically cost more
+REQUEST_COSTS = {'core': 1, 'search': 1, 'graphql': 10}
+# seconds between writes to the database
+FLUSH_INTERVAL = 1
+
+
+def token_id(token):
+    # type: (str) -> str
+    """ Tokens are not stored in the ledger, only their hashes
+
+    >>> token_id("0123456789abcdef")
+    'fe5567e8d769'
+    """
+    return hashlib.sha1((token or "").encode('utf8')).hexdigest()[:12]
+
+
+class TokenLedger(object):
+    """ Lock protected (SQLite) storage of token limits.
+
+    Records are keyed by (token id, API class), API class is core, search or
+    graphql. reserve() optimistically decrements remaining quota of the token
+    having the most of it globally; update() overwrites it with actual values
+    from response headers. Both only change the local snapshot, see flush().
+    """
+    path = None
+    flush_interval = None
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # (token, api_class): [limit, remaining, reset_time]
+        self._snapshot = {}
+        # (token, api_class): [reported values or None, reserved since]
+        self._pending = {}
+        self._flushed = 0
+        with self._connection() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS limits (
+                token TEXT, api_class TEXT, lim INTEGER, remaining INTEGER,
+                reset_time INTEGER, updated REAL,
+                PRIMARY KEY (token, api_class))""")
+        self.flush()
+        atexit.register(self.flush)
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return manifest.Transaction(db)
+
+    def flush(self):
+        # type: () -> None
+        """ Write local changes and read changes of other processes.
+
+        Reported limits replace stored ones, minus requests reserved after
+        the report; reservations without a report are subtracted from
+        whatever other processes have stored meanwhile """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = time.time()
+        now = time.time()
+        try:
+            with self._connection() as db:
+                for (token, api_class), (reported, reserved) in \
+                        pending.items():
+                    if reported is not None:
+                        limit, remaining, reset_time = reported
+                        db.execute(
+                            "INSERT OR REPLACE INTO limits "
+                            "VALUES (?,?,?,?,?,?)",
+                            (token, api_class, limit,
+                             max(remaining - reserved, 0), reset_time, now))
+                    elif reserved:
+                        cursor = db.execute(
+                            "UPDATE limits SET remaining = MAX(remaining - ?,"
+                            " 0), updated = ? WHERE token=? AND api_class=?",
+                            (reserved, now, token, api_class))
+                        if not cursor.rowcount:
+                            db.execute(
+                                "INSERT INTO limits VALUES (?,?,?,?,?,?)",
+                                (token, api_class, None,
+                                 DEFAULT_LIMITS[api_class] - reserved,
+                                 None, now))
+                rows = db.execute("SELECT token, api_class, lim, remaining, "
+                                  "reset_time FROM limits").fetchall()
+        except sqlite3.Error:
+            # e.g. the database is locked for too long; try again later
+            with self._lock:
+                for key, (reported, reserved) in pending.items():
+                    record = self._pending.setdefault(key, [None, 0])
+                    if record[0] is None:
+                        record[0] = reported
+                    record[1] += reserved
+            raise
+        with self._lock:
+            for token, api_class, limit, remaining, reset_time in rows:
+                key = (token, api_class)
+                if key in self._pending:  # changed locally meanwhile
+                    continue
+                self._snapshot[key] = [limit, remaining, reset_time]
+
+    def _maybe_flush(self):
+        with self._lock:
+            if time.time() - self._flushed < self.flush_interval:
+                return
+            self._flushed = time.time()  # don't let other threads in
+        try:
+            self.flush()
+        except sqlite3.Error:  # changes are kept for the next attempt
+            pass
+
+    def update(self, token, api_class, limit, remaining, reset_time):
+        # type: (str, str, int, int, int) -> None
+        """ Report actual limits, e.g. from X-RateLimit-* headers """
+        key = (token, api_class)
+        with self._lock:
+            self._snapshot[key] = [limit, remaining, reset_time]
+            self._pending[key] = [(limit, remaining, reset_time), 0]
+        self._maybe_flush()
+
+    def get(self, token, api_class):
+        # type: (str, str) -> dict
+        """ Return limit record in GitHubAPIToken.limit format or None """
+        self._maybe_flush()
+        with self._lock:
+            record = self._snapshot.get((token, api_class))
+        if record is None:
+            return None
+        return {'limit': record[0], 'remaining': record[1],
+                'reset_time': record[2]}
+
+    def reserve(self, tokens, api_class):
+        # type: (list, str) -> str
+        """ Reserve one request from a token having the most quota left
+        across all processes.
+
+        :param tokens: list of token ids available to the caller, in order
+            of preference to break ties
+        :param api_class: {core|search|graphql}
+        :return: token id or None if all tokens are exhausted
+        """
+        self._maybe_flush()
+        now = int(time.time())
+        cost = REQUEST_COSTS[api_class]
+        with self._lock:
+            best, best_record, restored = None, None, False
+            for token in tokens:
+                limit, remaining, reset_time = self._snapshot.get(
+                    (token, api_class), (None, None, None))
+                reset = remaining is not None and reset_time is not None \
+                    and reset_time <= now
+                if remaining is None or reset:
+                    # never used, or quota was restored but nobody
+                    # reported it yet
+                    remaining = limit or DEFAULT_LIMITS[api_class]
+                if reset or reset_time is None:
+                    # the quota window starts with the first request
+                    reset_time = now + RESET_INTERVALS[api_class]
+                if remaining > 0 and (
+                        best is None or remaining > best_record[1]):
+                    best, best_record, restored = \
+                        token, [limit, remaining, reset_time], reset
+
+            if best is not None:
+                key = (best, api_class)
+                pending = self._pending.setdefault(key, [None, 0])
+                if restored:  # stored value is stale, replace it
+                    pending[:] = [tuple(best_record), 0]
+                pending[1] += cost
+                best_record[1] = max(best_record[1] - cost, 0)
+                self._snapshot[key] = best_record
+        return best
+
+
+_ledger = None
+
+
+def get_ledger():
+    # type: () -> TokenLedger
+    """ Shared TokenLedger instance, None if disabled in settings """
+    global _ledger
+    path = getattr(settings, 'SCRAPER_TOKEN_LEDGER', None)
+    if _ledger is None and path is not False:
+        if not path:
+            path = os.path.join(
+                decorators.mkdir(decorators.DATASET_PATH, 'scraper.cache'),
+                'tokens.sqlite')
+        _ledger = TokenLedger(path)
+    return _ledger
@@ -0,0 +1,324 @@
+""" Request level metrics of the scraper
+
+Every API request is recorded by the token making it (latency, status code,
+size, quota use), and GitHubAPI records retries and time spent waiting for
+tokens to renew. Time spent on JSON decoding and building DataFrames is
+measured as well, so it is possible to tell where scraping time goes.
+
+Metrics of every process are periodically written to
+DATASET_PATH/scraper.cache/metrics/<pid>.json and <pid>.prom; the latter
+is in Prometheus text format, so the folder can be used by node_exporter
+textfile collector. `./manage.py check_limits --metrics` shows the latest
+snapshots. To use a different location, set SCRAPER_METRICS_PATH in
+settings.py; to disable the export, set it to False. Snapshot interval is
+set by SCRAPER_METRICS_INTERVAL, seconds.
+Processes write the final snapshot on exit, so finished scrapes can still
+be inspected for a while; load_snapshots() removes snapshots once they are
+not updated for several intervals (STALE_AFTER), whether the process
+finished or died.
+"""
+
+import atexit
+import contextlib
+import glob
+import json
+import os
+import threading
+import time
+
+from common import decorators
+
+try:
+    import settings
+except ImportError:
+    settings = object()
+
+# upper bounds of latency histogram buckets, seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+INTERVAL = getattr(settings, 'SCRAPER_METRICS_INTERVAL', 60)
+# snapshots not updated for this long are removed, seconds
+STALE_AFTER = 3 * INTERVAL
+PREFIX = 'ghd_scraper_'
+
+
+def _le(bound):
+    # type: (float) -> str
+    """ Prometheus representation of a bucket bound
+
+    >>> _le(0.5), _le(float('inf'))
+    ('0.5', '+Inf')
+    """
+    return '+Inf' if bound == float('inf') else '%g' % bound
+
+
+def quantile(buckets, q):
+    # type: (dict, float) -> float
+    """ Estimate a quantile from cumulative histogram buckets, as exported
+    by Metrics.snapshot(). Returns the upper bound of the bucket containing
+    the quantile, None if there are no observations
+
+    >>> quantile({'0.1': 1, '0.5': 9, '+Inf': 10}, 0.5)
+    0.5
+    >>> quantile({'0.1': 0, '+Inf': 0}, 0.5)
+    """
+    bounds = sorted((float(le), count) for le, count in buckets.items())
+    total = bounds[-1][1] if bounds else 0
+    if not total:
+        return None
+    for bound, count in bounds:
+        if count >= q * total:
+            return bound
+
+
+class Metrics(object):
+    """ Thread safe collection of counters, see module docstring """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        # (api_class, endpoint): {buckets, count, sum, bytes}
+        self.requests = {}
+        self.status = {}  # status code or exception name: count
+        self.retries = {}  # reason: count
+        self.sleep = {}  # reason: seconds
+        self.timers = {}  # stage: {count, seconds}
+        self.quota = {}  # token id: {api_class: {used, remaining}}
+
+    def request(self, token_id, api_class, status, latency, size=0,
+                remaining=None, endpoint='other'):
+        # type: (str, str, object, float, int, int, str) -> None
+        """ Record a request made by a token.
+        status is either HTTP status or exception class name,
+        endpoint is e.g. commits or issues, see GitHubAPIToken.endpoint() """
+        with self._lock:
+            r = self.requests.setdefault((api_class, endpoint), {
+                'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0,
+                'bytes': 0})
+            for i, bound in enumerate(BUCKETS):
+                if latency <= bound:
+                    r['buckets'][i] += 1
+                    break
+            r['count'] += 1
+            r['sum'] += latency
+            r['bytes'] += size
+            status = str(status)
+            self.status[status] = self.status.get(status, 0) + 1
+
+            q = self.quota.setdefault(token_id, {}).setdefault(
+                api_class, {'used': 0, 'remaining': None})
+            # conditional requests answered with 304 are free
+            if status != '304' and status.isdigit():
+                q['used'] += 1
+            if remaining is not None:
+                q['remaining'] = int(remaining)
+
+    def retry(self, reason):
+        # type: (str) -> None
+        with self._lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+
+    def slept(self, reason, seconds):
+        # type: (str, float) -> None
+        with self._lock:
+            self.sleep[reason] = self.sleep.get(reason, 0) + seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """ Measure time spent in a block of code:
+
+        >>> m = Metrics()
+        >>> with m.timer('json'):
+        ...     pass
+        >>> m.timers['json']['count']
+        1
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                t = self.timers.setdefault(stage, {'count': 0, 'seconds': 0})
+                t['count'] += 1
+                t['seconds'] += time.time() - start
+
+    def snapshot(self):
+        # type: () -> dict
+        """ All metrics as a JSON serializable dict.
+        Requests are keyed by api_class, then by endpoint.
+        Histogram buckets are cumulative, keyed by their upper bound """
+        with self._lock:
+            requests = {}
+            for (api_class, endpoint), r in self.requests.items():
+                cumulative, buckets = 0, {}
+                for bound, count in zip(BUCKETS, r['buckets']):
+                    cumulative += count
+                    buckets[_le(bound)] = cumulative
+                requests.setdefault(api_class, {})[endpoint] = dict(
+                    r, buckets=buckets)
+            return {
+                'pid': os.getpid(),
+                'started': self.started,
+                'updated': time.time(),
+                'requests': requests,
+                'status': dict(self.status),
+                'retries': dict(self.retries),
+                'sleep': dict(self.sleep),
+                'timers': {k: dict(v) for k, v in self.timers.items()},
+                'quota': {token: {k: dict(v) for k, v in classes.items()}
+                          for token, classes in self.quota.items()},
+            }
+
+    @staticmethod
+    def prometheus(snapshot):
+        # type: (dict) -> str
+        """ Convert a snapshot into Prometheus text exposition format
+
+        >>> m = Metrics()
+        >>> m.request('abc', 'core', 200, 0.3, 100, 4999, 'commits')
+        >>> text = Metrics.prometheus(m.snapshot())
+        >>> 'ghd_scraper_request_duration_seconds_bucket{api_class="core",endpoint="commits",le="0.5",pid=' in text
+        True
+        """
+        lines = []
+
+        def metric(name, kind, helpstr, samples):
+            lines.append("# HELP %s%s %s" % (PREFIX, name, helpstr))
+            lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+            for suffix, labels, value in samples:
+                labels = dict(labels, pid=str(snapshot['pid']))
+                lines.append("%s%s%s{%s} %s" % (
+                    PREFIX, name, suffix, ",".join(
+                        '%s="%s"' % item for item in sorted(labels.items())),
+                    value))
+
+        requests = [({'api_class': api_class, 'endpoint': endpoint}, r)
+                    for api_class, endpoints in sorted(
+                        snapshot['requests'].items())
+                    for endpoint, r in sorted(endpoints.items())]
+        duration = []
+        for labels, r in requests:
+            duration.extend(
+                ('_bucket', dict(labels, le=le), count) for le, count in
+                sorted(r['buckets'].items(), key=lambda x: float(x[0])))
+            duration.append(('_sum', labels, r['sum']))
+            duration.append(('_count', labels, r['count']))
+        metric('request_duration_seconds', 'histogram',
+               'API request latency', duration)
+        metric('response_bytes_total', 'counter', 'Response body size',
+               [('', labels, r['bytes']) for labels, r in requests])
+        metric('responses_total', 'counter',
+               'Responses by HTTP status or exception',
+               [('', {'status': k}, v)
+                for k, v in sorted(snapshot['status'].items())])
+        metric('retries_total', 'counter', 'Requests repeated',
+               [('', {'reason': k}, v)
+                for k, v in sorted(snapshot['retries'].items())])
+        metric('sleep_seconds_total', 'counter',
+               'Time spent waiting for quota',
+               [('', {'reason': k}, v)
+                for k, v in sorted(snapshot['sleep'].items())])
+        metric('stage_seconds_total', 'counter', 'Time spent processing',
+               [('', {'stage': k}, v['seconds'])
+                for k, v in sorted(snapshot['timers'].items())])
+        quota = [(token, api_class, q)
+                 for token, classes in sorted(snapshot['quota'].items())
+                 for api_class, q in sorted(classes.items())]
+        metric('quota_used_total', 'counter', 'Requests counted against quota',
+               [('', {'token': t, 'api_class': c}, q['used'])
+                for t, c, q in quota])
+        metric('quota_remaining', 'gauge', 'Remaining quota of a token',
+               [('', {'token': t, 'api_class': c}, q['remaining'])
+                for t, c, q in quota if q['remaining'] is not None])
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        # type: (str) -> None
+        """ Write <pid>.json and <pid>.prom snapshots into a folder.
+        Files are replaced atomically, so readers never see partial ones """
+        snapshot = self.snapshot()
+        fname = os.path.join(path, str(snapshot['pid']))
+        for ext, content in (('.json', json.dumps(snapshot)),
+                             ('.prom', self.prometheus(snapshot))):
+            with open(fname + ext + '.tmp', 'w') as fh:
+                fh.write(content)
+            os.rename(fname + ext + '.tmp', fname + ext)
+
+
+def default_path():
+    # type: () -> str
+    """ Folder of metrics snapshots, None if disabled in settings """
+    path = getattr(settings, 'SCRAPER_METRICS_PATH', None)
+    if path is False:
+        return None
+    return path or os.path.join(
+        decorators.DATASET_PATH, 'scraper.cache', 'metrics')
+
+
+def load_snapshots(path=None):
+    # type: (str) -> list
+    """ Snapshots written by running and recently finished processes,
+    most recent first. Stale snapshots (see STALE_AFTER) are removed """
+    path = path or default_path()
+    snapshots = []
+    for fname in glob.glob(os.path.join(path or '', '*.json')):
+        try:
+            with open(fname) as fh:
+                snapshot = json.load(fh)
+        except (IOError, ValueError):  # removed or being written
+            continue
+        if snapshot['updated'] < time.time() - STALE_AFTER:
+            _remove(path, snapshot['pid'])
+        else:
+            snapshots.append(snapshot)
+    return sorted(snapshots, key=lambda s: -s['updated'])
+
+
+def _remove(path, pid):
+    # type: (str, int) -> None
+    """ Remove snapshots of a process """
+    for ext in ('.json', '.prom'):
+        try:
+            os.remove(os.path.join(path, str(pid) + ext))
+        except OSError:  # never written or removed already
+            pass
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def _export(metrics, path):
+    # only processes which actually made requests leave snapshots
+    if metrics.requests:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        metrics.dump(path)
+
+
+def get_metrics():
+    # type: () -> Metrics
+    """ Shared Metrics instance. Unless disabled in settings, it is also
+    written to default_path() every INTERVAL seconds and on exit """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+            path = default_path()
+            if path:
+                stopped = threading.Event()
+
+                def export():
+                    while not stopped.wait(INTERVAL):
+                        _export(_metrics, path)
+
+                def stop():
+                    # the final snapshot is left until it goes stale
+                    stopped.set()
+                    thread.join()
+                    _export(_metrics, path)
+
+                thread = threading.Thread(target=export)
+                thread.daemon = True
+                thread.start()
+                atexit.register(stop)
+    return _metrics
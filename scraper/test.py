@@ -0,0 +1,869 @@
+
+from __future__ import unicode_literals, print_function
+
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+import pandas as pd
+import requests
+
+from common import decorators
+from scraper import fake_github
+from scraper import gharchive
+from scraper import github
+from scraper import gitlog
+from scraper import http_cache
+from scraper import ledger
+from scraper import metrics
+from scraper import utils as scraper
+
+try:
+    import asyncio
+    from scraper import github_aio
+except (ImportError, SyntaxError):  # no aiohttp or Python 2
+    github_aio = None
+
+
+def git(path, *args, **env):
+    environ = dict(os.environ, GIT_AUTHOR_NAME="John",
+                   GIT_AUTHOR_EMAIL="42+john@users.noreply.github.com",
+                   GIT_COMMITTER_NAME="John",
+                   GIT_COMMITTER_EMAIL="john@example.com", **env)
+    return subprocess.check_output(('git',) + args, cwd=path, env=environ)
+
+
+class FakeGitHubTestCase(unittest.TestCase):
+    """ Runs scraper.utils against FakeGitHub, with caches in a temporary
+    folder """
+    server_options = {}
+
+    def setUp(self):
+        self.server = fake_github.FakeGitHub(**self.server_options).start()
+        self.api_url = github.GitHubAPIToken.api_url
+        github.GitHubAPIToken.api_url = self.server.api_url
+        self.api = github.GitHubAPI(tokens=["fake0", "fake1"])
+        for token in self.api.tokens:
+            token.http_cache = None
+            token.ledger = None
+        self.path = tempfile.mkdtemp()
+        self.cache_paths = {}
+        self.caches = {}  # function name: fs_cache instance
+        for (path, func_name), cache in decorators.fs_cache.registry.items():
+            if path.startswith(os.path.join(decorators.DATASET_PATH,
+                                            'scraper.cache')):
+                self.cache_paths[cache] = cache.cache_path
+                self.caches[func_name] = cache
+                cache.cache_path = self.path
+
+    def tearDown(self):
+        self.server.stop()
+        github.GitHubAPIToken.api_url = self.api_url
+        for cache, path in self.cache_paths.items():
+            cache.cache_path = path
+        shutil.rmtree(self.path)
+
+    def requests(self):
+        return sum(self.server.stats()['status'].values())
+
+    def expire(self, func, *args):
+        """ Make cached result of a scraper.utils function outdated """
+        cache = self.caches[func.__name__]
+        os.utime(func.cache_fname(*args), (0, 0))
+        cache.manifest.touch(cache.key(func.__name__, *args), 0)
+
+
+class TestGitLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp, 'origin')
+        os.makedirs(os.path.join(self.origin, 'user', 'repo'))
+        os.makedirs(os.path.join(self.origin, 'user', 'empty'))
+        self.repo = os.path.join(self.origin, 'user', 'repo')
+        git(self.repo, 'init', '--quiet')
+        git(os.path.join(self.origin, 'user', 'empty'), 'init', '--quiet')
+        for i in range(5):
+            self.commit(i)
+        self.api = gitlog.GitLog(path=os.path.join(self.tmp, 'clones'),
+                                 clone_url=self.origin + "/%s")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def commit(self, i):
+        date = "%d +0200" % (1514764800 + i * 86400)
+        git(self.repo, 'commit', '--allow-empty', '--quiet',
+            '-m', 'commit %d' % i,
+            GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+
+    def test_commits(self):
+        commits = list(self.api.repo_commits('user/repo'))
+        self.assertEqual(len(commits), 5)
+        self.assertEqual(commits[0]['committed_date'], '2018-01-05T00:00:00Z')
+        self.assertEqual(commits[0]['author'], 'john')
+        self.assertEqual(commits[0]['parents'], commits[1]['sha'])
+        self.assertEqual(commits[-1]['parents'], '')
+
+        # the clone was just made, so it is not fetched again
+        self.commit(5)
+        commits = list(self.api.repo_commits(
+            'user/repo', since='2018-01-05T00:00:00Z'))
+        self.assertEqual(len(commits), 1)
+        # later new commits are fetched into the existing clone
+        self.api.fetch_interval = 0
+        commits = list(self.api.repo_commits(
+            'user/repo', since='2018-01-05T00:00:00Z'))
+        self.assertEqual(len(commits), 2)
+        # only branches are cloned
+        refs = git(self.api.repo_path('user/repo'), 'for-each-ref')
+        self.assertEqual(len(refs.splitlines()), 1)
+
+    def test_exclude(self):
+        tips = [c['sha'] for c in self.api.repo_commits('user/repo')][:1]
+        # a branch started before the last known commit and merged after
+        git(self.repo, 'checkout', '--quiet', '-b', 'old', 'HEAD~2')
+        self.commit(1)
+        git(self.repo, 'checkout', '--quiet', '-')
+        self.commit(6)
+        git(self.repo, 'merge', '--quiet', '--no-edit', 'old')
+
+        self.api.fetch_interval = 0
+        commits = list(self.api.repo_commits('user/repo', exclude=tips))
+        self.assertEqual(len(commits), 3)
+        self.assertIn('2018-01-02T00:00:00Z',
+                      [c['committed_date'] for c in commits])
+
+    def test_mirrors(self):
+        list(self.api.repo_commits('user/repo'))
+        list(self.api.repo_commits('user/empty'))
+        mirrors = gitlog.mirrors(self.api.path)
+        self.assertEqual(sorted(mirrors),
+                         ['github.com/user/empty', 'github.com/user/repo'])
+        self.assertGreater(gitlog.disk_usage(mirrors['github.com/user/repo']),
+                           0)
+
+        removed = gitlog.evict(['github.com/user/repo'], self.api.path)
+        self.assertEqual(list(removed), ['github.com/user/empty'])
+        self.assertEqual(list(gitlog.mirrors(self.api.path)),
+                         ['github.com/user/repo'])
+
+    def test_pages(self):
+        page_size, gitlog.PAGE_SIZE = gitlog.PAGE_SIZE, 2
+        try:
+            pages = list(self.api.repo_commits_pages('user/repo',
+                                                     first_page=2))
+            self.assertEqual([(page, len(records)) for page, records in pages],
+                             [(2, 2), (3, 1)])
+        finally:
+            gitlog.PAGE_SIZE = page_size
+
+    def test_missing(self):
+        self.assertEqual(list(self.api.repo_commits('user/empty')), [])
+        with self.assertRaises(github.RepoDoesNotExist):
+            list(self.api.repo_commits('user/missing'))
+
+    def test_stale_mirror(self):
+        commits = list(self.api.repo_commits('user/repo'))
+        # failed fetch into an existing mirror keeps the old commits
+        shutil.rmtree(self.repo)
+        self.api.fetch_interval = 0
+        self.assertEqual(list(self.api.repo_commits('user/repo')), commits)
+
+
+class TestGHArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def archive(self, name, events):
+        path = os.path.join(self.tmp, name)
+        with gzip.open(path, 'wb') as fh:
+            for event in events:
+                fh.write(json.dumps(event, separators=(',', ':')).encode(
+                    'utf8') + b"\n")
+        return path
+
+    @staticmethod
+    def issue_event(repo, number, updated_at, state='open', event_type=
+                    'IssuesEvent', **issue):
+        issue.update({
+            'number': number, 'user': {'login': 'john'}, 'state': state,
+            'created_at': '2018-01-01T00:00:00Z', 'updated_at': updated_at,
+            'closed_at': updated_at if state == 'closed' else None})
+        return {'type': event_type, 'repo': {'name': repo},
+                'created_at': updated_at, 'payload': {'issue': issue}}
+
+    @staticmethod
+    def push_event(repo, created_at, size):
+        return {'type': 'PushEvent', 'repo': {'name': repo},
+                'created_at': created_at,
+                'payload': {'size': size + 1, 'distinct_size': size}}
+
+    def test_corrupted(self):
+        events = [self.push_event('user/repo', '2018-01-01T00:00:00Z', i)
+                  for i in range(1, 3001)]
+        path = self.archive('2018-01-01-0.json.gz', events)
+        with open(path, 'rb') as fh:
+            content = fh.read()
+        # truncated: events before the cut are counted
+        with open(path, 'wb') as fh:
+            fh.write(content[:len(content) // 2])
+        _, pushes = gharchive.parse_file(path, {'user/repo'})
+        self.assertGreater(pushes[('user/repo', '2018-01')], 0)
+        # invalid deflate block right after the header (which ends with
+        # zero terminated file name), i.e. zlib.error
+        start = content.index(b"\x00", 10) + 1
+        with open(path, 'wb') as fh:
+            fh.write(content[:start] + b"\xff" * 16 + content[start + 16:])
+        self.assertEqual(gharchive.parse_file(path, {'user/repo'}), ({}, {}))
+
+    def test_ingest(self):
+        paths = [
+            self.archive('2018-01-01-0.json.gz', [
+                self.issue_event('User/Repo', 1, '2018-01-01T00:00:00Z'),
+                self.issue_event('user/repo', 2, '2018-01-01T00:00:00Z'),
+                self.issue_event('user/other', 1, '2018-01-01T00:00:00Z'),
+                self.push_event('user/repo', '2018-01-01T00:00:00Z', 3),
+                {'type': 'WatchEvent', 'repo': {'name': 'user/repo'}},
+            ]),
+            self.archive('2018-02-01-0.json.gz', [
+                self.issue_event('user/repo', 1, '2018-02-01T00:00:00Z',
+                                 'closed', 'IssueCommentEvent'),
+                # pull request comments are not issues
+                self.issue_event('user/repo', 3, '2018-02-01T00:00:00Z',
+                                 event_type='IssueCommentEvent',
+                                 pull_request={}),
+                self.push_event('user/repo', '2018-01-31T23:00:00Z', 2),
+                self.push_event('user/repo', '2018-02-01T00:00:00Z', 1),
+            ]),
+        ]
+        with open(os.path.join(self.tmp, 'broken.json.gz'), 'wb') as fh:
+            fh.write(b"not an archive")
+        paths.append(fh.name)
+
+        issues, pushes = gharchive.ingest(
+            paths, ['github.com/user/repo', 'bitbucket.org/user/other'], 2)
+        issues = issues.loc['github.com/user/repo']
+        self.assertEqual(list(issues.index), [1, 2])
+        self.assertEqual(list(issues['closed']), [True, False])
+        self.assertEqual(issues.loc[1, 'closed_at'], '2018-02-01T00:00:00Z')
+        self.assertEqual(pushes.to_dict(),
+                         {('github.com/user/repo', '2018-01'): 5,
+                          ('github.com/user/repo', '2018-02'): 1})
+
+
+class TestThrottling(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_github.FakeGitHub(
+            repos=20, commits=(0, 300), issues=(0, 10), errors=0.3,
+            retry_after=1).start()
+        self.api_url = github.GitHubAPIToken.api_url
+        self.backoff = github.BACKOFF_BASE
+        github.GitHubAPIToken.api_url = self.server.api_url
+        github.BACKOFF_BASE = 0.05
+        self.api = github.GitHubAPI(tokens=["fake0", "fake1", "fake2"])
+        for token in self.api.tokens:
+            token.http_cache = None
+            token.ledger = None
+
+    def tearDown(self):
+        self.server.stop()
+        github.GitHubAPIToken.api_url = self.api_url
+        github.BACKOFF_BASE = self.backoff
+
+    def test_retries(self):
+        for repo_name in self.server.repo_names():
+            commits = list(self.api.repo_commits(repo_name))
+            self.assertEqual(
+                len(commits), len(self.server.repo_data(repo_name)['commits']))
+        status = self.server.stats()['status']
+        self.assertGreater(status.get(403, 0), 0)
+        self.assertGreater(status.get(502, 0), 0)
+
+    def test_page_order(self):
+        # pages come out of order and some of them fail, but are yielded
+        # in order anyway
+        for repo_name in self.server.repo_names():
+            commits = self.server.repo_data(repo_name)['commits']
+            self.assertEqual(
+                [c['sha'] for c in self.api.repo_commits(repo_name)],
+                [c['sha'] for c in commits])
+        # counted from many threads
+        self.assertEqual([token.in_flight for token in self.api.tokens],
+                         [0, 0, 0])
+
+    def test_cool_down(self):
+        token = self.api.tokens[0]
+        self.assertTrue(token.ready('user'))
+        token.cool_down(1)
+        self.assertFalse(token.ready('user'))
+        self.assertEqual(self.api._candidates('user')[-1], token)
+        token.cooldown_until = 0
+        self.assertTrue(token.ready('user'))
+
+
+class TestHTTPCache(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_github.FakeGitHub(repos=1, commits=(10, 10)).start()
+        self.api_url = github.GitHubAPIToken.api_url
+        github.GitHubAPIToken.api_url = self.server.api_url
+        self.path = tempfile.mkdtemp()
+        self.cache = http_cache.HTTPCache(self.path, max_size=None)
+        self.token = github.GitHubAPIToken("fake0")
+        self.token.http_cache = self.cache
+        self.token.ledger = None
+        self.url = "repos/%s/commits" % self.server.repo_names()[0]
+
+    def tearDown(self):
+        self.server.stop()
+        github.GitHubAPIToken.api_url = self.api_url
+        shutil.rmtree(self.path)
+
+    def test_not_modified(self):
+        content = self.token.request(self.url, per_page=5).content
+        r = self.token.request(self.url, per_page=5)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, content)
+        self.assertIn('Link', r.headers)
+        self.assertEqual(self.server.stats()['status'].get(304), 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        # records are shared by tokens, as ETags of public data are
+        other = github.GitHubAPIToken("fake1")
+        other.http_cache = self.cache
+        other.ledger = None
+        self.assertEqual(other.request(self.url, per_page=5).content,
+                         content)
+        self.assertEqual(self.server.stats()['status'].get(304), 2)
+        self.assertEqual(self.cache.stats()['hits'], 2)
+
+    @unittest.skipIf(github_aio is None, "aiohttp is not installed")
+    def test_async(self):
+        content = self.token.request(self.url).content
+        token = github_aio.AsyncGitHubAPIToken("fake1")
+        token.http_cache = self.cache
+        token.ledger = None
+        loop = asyncio.new_event_loop()
+        try:
+            r = loop.run_until_complete(token.request(self.url))
+        finally:
+            loop.run_until_complete(token.close())
+            loop.close()
+        self.assertEqual((r.status_code, r.content), (200, content))
+        self.assertEqual(self.server.stats()['status'].get(304), 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_corrupted(self):
+        content = self.token.request(self.url).content
+        key = self.cache.key(self.url, {})
+        with open(self.cache._fname(key, ".body.gz"), 'wb') as fh:
+            fh.write(b"garbage")
+        # 304 can't be restored, so the request is repeated unconditionally
+        requests = self.cache.stats()['requests']
+        self.assertEqual(self.token.request(self.url).content, content)
+        self.assertEqual(self.server.stats()['status'].get(304), 1)
+        # it is still one request for the cache
+        self.assertEqual(self.cache.stats()['requests'], requests + 1)
+        self.assertEqual(self.cache.stats()['hits'], 0)
+        with open(self.cache._fname(key, ".headers"), 'wb') as fh:
+            fh.write(b"{")
+        self.assertEqual(self.cache.conditional_headers(key), {})
+        self.assertEqual(self.token.request(self.url).content, content)
+
+    def test_evict(self):
+        now = time.time()
+        # no limits, so that eviction does not start in background
+        self.cache.max_age = None
+        for i in range(4):  # ~1KB records, used 40, 30, 20 and 10s ago
+            self.cache.store("%02d" % i, {'ETag': str(i)}, os.urandom(1000))
+            used = now - 40 + i * 10
+            os.utime(self.cache._fname("%02d" % i, ".headers"), (used, used))
+        self.cache.max_size = 2500
+        self.assertEqual(self.cache.evict()[0], 2)
+        self.assertEqual(self.cache.conditional_headers("00"), {})
+        self.assertIsNotNone(self.cache.load("03"))
+        self.cache.max_age = 15
+        self.assertEqual(self.cache.evict()[0], 1)
+        self.assertIsNone(self.cache.load("02"))
+
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        fname = os.path.join(self.path, 'tokens.sqlite')
+        # two processes sharing the ledger; flushes are explicit
+        self.ledger = ledger.TokenLedger(fname, flush_interval=3600)
+        self.other = ledger.TokenLedger(fname, flush_interval=3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_reserve(self):
+        reset = int(time.time()) + 3600
+        self.ledger.update('a', 'core', 5000, 10, reset)
+        self.ledger.update('b', 'core', 5000, 12, reset)
+        # the token having the most quota, ties go to the first one
+        self.assertEqual([self.ledger.reserve(['a', 'b'], 'core')
+                          for _ in range(5)], ['b', 'b', 'a', 'b', 'a'])
+        # nothing is written until flush
+        self.assertIsNone(self.other.get('a', 'core'))
+        self.ledger.flush()
+        self.other.flush()
+        self.assertEqual(self.other.get('a', 'core')['remaining'], 8)
+        self.assertEqual(self.other.get('b', 'core')['remaining'], 9)
+        # reservations of other processes are added up
+        self.other.reserve(['a'], 'core')
+        self.ledger.reserve(['a'], 'core')
+        self.other.flush()
+        self.ledger.flush()
+        self.assertEqual(self.ledger.get('a', 'core')['remaining'], 6)
+
+    def test_exhausted(self):
+        self.ledger.update('a', 'core', 5000, 0, int(time.time()) + 3600)
+        self.ledger.update('b', 'core', 5000, 0, int(time.time()) - 1)
+        # quota of b was restored, even though nobody reported it
+        self.assertEqual(self.ledger.reserve(['a', 'b'], 'core'), 'b')
+        self.assertEqual(self.ledger.get('b', 'core')['remaining'], 4999)
+        self.ledger.update('b', 'core', 5000, 0, int(time.time()) + 3600)
+        self.assertIsNone(self.ledger.reserve(['a', 'b'], 'core'))
+
+    def test_never_synced(self):
+        token = github.GitHubAPIToken("fake0")
+        token.ledger = self.ledger
+        url = "search/repositories"
+        for _ in range(ledger.DEFAULT_LIMITS['search']):
+            self.assertEqual(self.ledger.reserve([token.id], 'search'),
+                             token.id)
+        self.assertIsNone(self.ledger.reserve([token.id], 'search'))
+        # nobody reported limits of this token, so the quota window
+        # started with the first reservation
+        token.sync_limits(url)
+        self.assertEqual(token.limit['search']['remaining'], 0)
+        self.assertGreater(token.when(url), time.time())
+        self.assertFalse(token.ready(url))
+        # without reset time, the token is tried again
+        token.limit['search']['reset_time'] = None
+        self.assertTrue(token.ready(url))
+
+    def test_graphql(self):
+        # GraphQL quota is in points, unknown queries cost more than one
+        self.assertEqual(self.ledger.reserve(['a'], 'graphql'), 'a')
+        self.ledger.flush()
+        self.assertEqual(
+            self.ledger.get('a', 'graphql')['remaining'],
+            ledger.DEFAULT_LIMITS['graphql'] - ledger.REQUEST_COSTS['graphql'])
+
+    def test_candidates(self):
+        api = github.GitHubAPI(tokens=["fake0", "fake1", "fake2"])
+        for token in api.tokens:
+            token.ledger = self.ledger
+        reset = int(time.time()) + 3600
+        for token, remaining in zip(api.tokens, (100, 200, 50)):
+            self.ledger.update(token.id, 'core', 5000, remaining, reset)
+        api.tokens[0].in_flight = 1
+        # reserved token goes first, the rest are ordered by load
+        self.assertEqual(api._candidates('user'),
+                         [api.tokens[1], api.tokens[2], api.tokens[0]])
+        api.tokens[0].in_flight = 0
+
+
+@unittest.skipIf(github_aio is None, "aiohttp is not installed")
+class TestAsync(FakeGitHubTestCase):
+    server_options = {'repos': 4, 'commits': (150, 450), 'issues': (0, 50)}
+
+    def test_pages(self):
+        api = github_aio.AsyncGitHubAPI(tokens=["fake0"])
+        for token in api.tokens:
+            token.http_cache = None
+            token.ledger = None
+        loop = asyncio.new_event_loop()
+        try:
+            for repo_name in self.server.repo_names():
+                shas = [c['sha'] for c in
+                        self.server.repo_data(repo_name)['commits']]
+                # no async syntax, so that the module compiles in Python 2
+                pages, agen = [], api.repo_commits_pages(repo_name)
+                try:
+                    while True:
+                        pages.append(loop.run_until_complete(
+                            agen.__anext__()))
+                except StopAsyncIteration:
+                    pass
+                self.assertEqual([page for page, _ in pages],
+                                 list(range(1, (len(shas) + 99) // 100 + 1)))
+                self.assertEqual([c['sha'] for _, cs in pages for c in cs],
+                                 shas)
+        finally:
+            loop.run_until_complete(api.close())
+            loop.close()
+
+    def test_scrape(self):
+        urls = ["github.com/" + name for name in self.server.repo_names()]
+        github_aio.scrape(urls + ["github.com/missing/repo"], concurrency=4)
+        self.assertIs(scraper.PROVIDERS['github.com'], self.api)
+        for cached_func in (scraper.commits, scraper.issues):
+            self.assertFalse(os.path.exists(cached_func.cache_fname(
+                "github.com/missing/repo") + ".partial"))
+        requests = self.requests()
+        for url in urls:
+            data = self.server.repo_data(scraper.parse_url(url)[1])
+            # results are taken from cache
+            self.assertEqual(list(scraper.commits(url).index),
+                             [c['sha'] for c in data['commits']])
+            self.assertEqual(len(scraper.issues(url)), len(
+                [i for i in data['issues'] if 'pull_request' not in i]))
+        self.assertEqual(self.requests(), requests)
+
+        # expired caches are refreshed incrementally, one request each
+        for url in urls:
+            self.expire(scraper.commits, url)
+        github_aio.scrape(urls, concurrency=4)
+        self.assertEqual(self.requests() - requests, len(urls))
+        for url in urls:
+            self.assertFalse(scraper.commits.expired(url))
+
+
+class Interrupted(Exception):
+    pass
+
+
+class TestUtils(FakeGitHubTestCase):
+    server_options = {'repos': 2, 'commits': (450, 550), 'issues': (0, 50)}
+
+    def test_stream_resume(self):
+        repo_name = self.server.repo_names()[0]
+        url = "github.com/" + repo_name
+        shas = [c['sha'] for c in self.server.repo_data(repo_name)['commits']]
+
+        def interrupted(project_url, first_page=1):
+            for page, records in self.api.repo_commits_pages(
+                    project_url, first_page=first_page):
+                yield page, records
+                if page == 2:
+                    raise Interrupted
+
+        with self.assertRaises(Interrupted):
+            scraper.stream(scraper.commits, url, interrupted,
+                           scraper.commits_frame)
+        requests = self.requests()
+        # the next call picks up from page 3
+        self.assertEqual(list(scraper.commits(url).index), shas)
+        self.assertEqual(self.requests() - requests,
+                         (len(shas) + 99) // 100 - 2)
+        self.assertFalse(os.path.exists(
+            scraper.commits.cache_fname(url) + ".partial"))
+
+    def test_stream_missing(self):
+        url = "github.com/missing/repo"
+        with self.assertRaises(github.RepoDoesNotExist):
+            scraper.commits(url)
+        # nothing to resume, so no partial file is left behind
+        self.assertFalse(os.path.exists(
+            scraper.commits.cache_fname(url) + ".partial"))
+
+    def test_commits_since(self):
+        repo_name = self.server.repo_names()[0]
+        url = "github.com/" + repo_name
+        full = scraper.commits_frame(self.api.repo_commits(repo_name))
+        scraper.commits.store(full.iloc[5:], url)
+        self.expire(scraper.commits, url)
+        requests = self.requests()
+        # only commits since the last cached one are requested
+        self.assertEqual(list(scraper.commits(url).index), list(full.index))
+        self.assertEqual(self.requests() - requests, 1)
+
+    def test_commits_unknown_parents(self):
+        repo_name = self.server.repo_names()[0]
+        url = "github.com/" + repo_name
+        full = scraper.commits_frame(self.api.repo_commits(repo_name))
+        # parent of the oldest new commit is neither cached nor new,
+        # as if it was merged from an old branch
+        scraper.commits.store(full.drop(full.index[:5].append(
+            full.index[6:7])), url)
+        self.expire(scraper.commits, url)
+        requests = self.requests()
+        self.assertEqual(list(scraper.commits(url).index), list(full.index))
+        # since request, and then full history again
+        self.assertEqual(self.requests() - requests,
+                         1 + (len(full) + 99) // 100)
+
+
+class TestIssues(FakeGitHubTestCase):
+    # several pages of issues, so that a full scrape takes several requests
+    server_options = {'repos': 1, 'commits': (0, 10), 'issues': (250, 300)}
+
+    def test_issues_since(self):
+        repo_name = self.server.repo_names()[0]
+        url = "github.com/" + repo_name
+        full = scraper.issues_frame(self.api.repo_issues(repo_name))
+        last = full['updated_at'].sort_values().index[-1]
+        # the last updated issue is cached as it was before the update
+        cached = full.copy()
+        cached.loc[last, 'updated_at'] = full['updated_at'].min()
+        cached.loc[last, 'closed'] = not full.loc[last, 'closed']
+        cached.loc[last, 'closed_at'] = None if full.loc[last, 'closed'] \
+            else full.loc[last, 'created_at']
+        scraper.issues.store(cached, url)
+        stale = scraper.closed_issues(url).sum()
+        self.expire(scraper.issues, url)
+
+        requests = self.requests()
+        res = scraper.issues(url)
+        # only issues updated since the last cached update are requested
+        self.assertEqual(self.requests() - requests, 1)
+        self.assertFalse(res.index.duplicated().any())
+        self.assertEqual(sorted(res.index), sorted(full.index))
+        self.assertEqual(res.loc[last, 'updated_at'],
+                         full.loc[last, 'updated_at'])
+        self.assertEqual(res.loc[last, 'closed'], full.loc[last, 'closed'])
+        # derived caches are recomputed
+        closed = full.loc[full['closed'], 'closed_at'].count()
+        self.assertNotEqual(stale, closed)
+        self.assertTrue(scraper.closed_issues.expired(url))
+        self.assertEqual(scraper.closed_issues(url).sum(), closed)
+
+    def test_issues_unchanged(self):
+        repo_name = self.server.repo_names()[0]
+        url = "github.com/" + repo_name
+        full = scraper.issues(url)
+        closed = scraper.closed_issues(url)
+        closed_mtime = scraper.closed_issues.mtime(url)
+        self.expire(scraper.issues, url)
+        self.assertTrue(scraper.issues.expired(url))
+
+        requests = self.requests()
+        res = scraper.issues(url)
+        self.assertEqual(self.requests() - requests, 1)
+        self.assertEqual(list(res.index), list(full.index))
+        self.assertIs(scraper.merge_issues(full, full.iloc[:1]), full)
+        self.assertFalse(scraper.issues.expired(url))
+        # derived caches are touched, not recomputed
+        self.assertFalse(scraper.closed_issues.expired(url))
+        self.assertGreaterEqual(scraper.closed_issues.mtime(url),
+                                closed_mtime)
+        self.assertEqual(scraper.closed_issues(url).to_dict(),
+                         closed.to_dict())
+
+
+class TestGraphQL(FakeGitHubTestCase):
+    server_options = {'repos': 3, 'commits': (150, 250),
+                      'issues': (250, 300)}
+
+    def setUp(self):
+        super(TestGraphQL, self).setUp()
+        self.v4 = github.GitHubAPIv4(tokens=["fake0"])
+        for token in self.v4.tokens:
+            token.http_cache = None
+            token.ledger = None
+
+    def issues(self, repo_name):
+        """ Issue numbers as GraphQL returns them, oldest first """
+        return [i['number'] for i in reversed(
+            self.server.repo_data(repo_name)['issues'])
+            if 'pull_request' not in i]
+
+    def test_repos_issues(self):
+        repo_names = self.server.repo_names() + ['missing/repo']
+        # batches of two repositories, several pages each
+        res = dict(self.v4.repos_issues(repo_names, batch_size=2))
+        self.assertEqual(sorted(res), sorted(repo_names))
+        self.assertIsNone(res['missing/repo'])
+        for repo_name in self.server.repo_names():
+            self.assertEqual([i['number'] for i in res[repo_name]],
+                             self.issues(repo_name))
+
+    def test_repos_issues_removed(self):
+        repo_names = self.server.repo_names()
+        repos = self.server.repos
+        v4_batch = self.v4.v4_batch
+
+        def batch(*args, **kwargs):
+            res = v4_batch(*args, **kwargs)
+            # all but the first repository are gone after the first page
+            self.server.repos = 1
+            return res
+
+        self.v4.v4_batch = batch
+        try:
+            res = list(self.v4.repos_issues(repo_names, batch_size=3))
+        finally:
+            del self.v4.v4_batch
+            self.server.repos = repos
+        self.assertEqual(res[-1][0], repo_names[0])
+        self.assertEqual([i['number'] for i in res[-1][1]],
+                         self.issues(repo_names[0]))
+        self.assertEqual(res[:-1], [(repo_name, None)
+                                    for repo_name in repo_names[1:]])
+
+    def test_partial_errors(self):
+        repo_names = self.server.repo_names() + ['missing/repo']
+        # missing repositories come with NOT_FOUND errors
+        self.assertEqual([r['exists'] for r in self.v4.repos_info(
+            repo_names)], [True, True, True, False])
+        # other errors might be transient, so the whole batch fails
+        # instead of reporting the repository as missing
+        self.server.graphql_errors[repo_names[1]] = 1
+        with self.assertRaises(requests.HTTPError):
+            list(self.v4.repos_info(repo_names))
+        self.assertEqual([r['exists'] for r in self.v4.repos_info(
+            repo_names)], [True, True, True, False])
+
+    def test_users_info(self):
+        logins = ['org0', 'john', 'missing-user']
+        users = list(self.v4.users_info(logins))
+        for login, user in zip(logins[:2], users):
+            # same fields as REST API returns
+            rest = self.api.user_info(login)
+            self.assertEqual(user, {field: rest[field] for field in user})
+        self.assertEqual(users[0]['type'], 'Organization')
+        self.assertEqual(users[1]['type'], 'User')
+        self.assertIsNone(users[2])
+
+        # one failing account fails the batch, it is not taken for missing
+        self.server.graphql_errors['john'] = 1
+        with self.assertRaises(requests.HTTPError):
+            list(self.v4.users_info(logins))
+        self.assertEqual(list(self.v4.users_info(logins)), users)
+
+    def test_repo_issues_cursor(self):
+        repo_name = self.server.repo_names()[0]
+        # fake_github cursors are offsets
+        self.assertEqual(
+            [i['number'] for i in self.v4.repo_issues(repo_name, cursor="100")],
+            self.issues(repo_name)[100:])
+        with self.assertRaises(github.RepoDoesNotExist):
+            list(self.v4.repo_issues('missing/repo'))
+        # same signature as GitHubAPI.repo_issues, but no pages or since
+        with self.assertRaises(NotImplementedError):
+            list(self.v4.repo_issues(repo_name, since="2015-01-01"))
+
+    def test_commit_counts(self):
+        repo_names = self.server.repo_names() + ['missing/repo', 'empty/repo']
+        expected = [len(self.server.repo_data(repo_name)['commits'])
+                    for repo_name in self.server.repo_names()] + [None, 0]
+        self.assertEqual(
+            [(r['repo'], r['commits']) for r in self.v4.repos_commit_counts(
+                repo_names, batch_size=2)],
+            list(zip(repo_names, expected)))
+
+    def test_repo_commits(self):
+        repo_name = self.server.repo_names()[0]
+        commits = self.server.repo_data(repo_name)['commits']
+        shas = [c['sha'] for c in commits]
+        self.assertEqual(
+            [c['sha'] for c in self.v4.repo_commits(repo_name)], shas)
+        # same records as REST API returns, except for verification
+        rest = next(self.api.repo_commits(repo_name))
+        rest.pop('verified')
+        self.assertEqual(next(self.v4.repo_commits(repo_name)), rest)
+        self.assertEqual(
+            [c['sha'] for c in self.v4.repo_commits(repo_name, page=2)],
+            shas[100:200])
+        since = commits[10]['commit']['committer']['date']
+        self.assertEqual(
+            [c['sha'] for c in self.v4.repo_commits(repo_name, since=since)],
+            [c['sha'] for c in commits
+             if c['commit']['committer']['date'] >= since])
+        self.assertEqual(list(self.v4.repo_commits('empty/repo')), [])
+        with self.assertRaises(github.RepoDoesNotExist):
+            list(self.v4.repo_commits('missing/repo'))
+
+    def test_prefetch_contributor_stats(self):
+        urls = ["github.com/" + repo_name
+                for repo_name in self.server.repo_names()]
+        provider = scraper.PROVIDERS['github.com']
+        scraper.PROVIDERS['github.com'] = self.api
+        try:
+            self.assertEqual(scraper.prefetch_contributor_stats(
+                urls + ["github.com/empty/repo", "github.com/missing/repo"],
+                attempts=2, delay=0, num_workers=1), [])
+            # the first request for every repository got 202
+            self.assertEqual(self.server.stats()['status'].get(202),
+                             len(urls))
+            requests = self.requests()
+            for url in urls:
+                self.assertFalse(scraper.contributor_stats.expired(url))
+                commits = self.server.repo_data(url.split("/", 1)[1])[
+                    'commits']
+                # GitHub only counts commits of known users
+                self.assertEqual(scraper.contributor_stats(url).sum(),
+                                 sum(bool(c['author']) for c in commits))
+            self.assertEqual(self.requests(), requests)
+        finally:
+            scraper.PROVIDERS['github.com'] = provider
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_stale_snapshots(self):
+        m = metrics.Metrics()
+        m.request('token', 'core', 200, 0.1)
+        m.dump(self.path)
+        # a process killed before it could remove its snapshots
+        snapshot = dict(m.snapshot(), pid=1 << 22,
+                        updated=time.time() - metrics.STALE_AFTER - 1)
+        for ext, content in (('.json', json.dumps(snapshot)),
+                             ('.prom', m.prometheus(snapshot))):
+            with open(os.path.join(self.path, '%d%s' % (1 << 22, ext)),
+                      'w') as fh:
+                fh.write(content)
+
+        self.assertEqual([s['pid'] for s in metrics.load_snapshots(
+            self.path)], [os.getpid()])
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ['%d.json' % os.getpid(), '%d.prom' % os.getpid()])
+
+    def test_endpoints(self):
+        m = metrics.Metrics()
+        for url in ("repos/org0/repo0/commits", "repos/org1/repo1/commits",
+                    "repos/org0/repo0/stats/contributors", "graphql"):
+            m.request('token', github.GitHubAPIToken.api_class(url), 200,
+                      0.1, endpoint=github.GitHubAPIToken.endpoint(url))
+        requests = m.snapshot()['requests']
+        self.assertEqual({api_class: {k: r['count'] for k, r in
+                                      endpoints.items()}
+                          for api_class, endpoints in requests.items()},
+                         {'core': {'commits': 2, 'contributors': 1},
+                          'graphql': {'graphql': 1}})
+        self.assertIn('request_duration_seconds_count{api_class="core",'
+                      'endpoint="commits",pid="%d"} 2' % os.getpid(),
+                      m.prometheus(m.snapshot()))
+
+    def test_finished_snapshots(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        m = metrics.Metrics()
+        m.request('token', 'core', 200, 0.1)
+
+        def write(updated):
+            snapshot = dict(m.snapshot(), pid=proc.pid, updated=updated)
+            for ext, content in (('.json', json.dumps(snapshot)),
+                                 ('.prom', m.prometheus(snapshot))):
+                with open(os.path.join(self.path, '%d%s' % (proc.pid, ext)),
+                          'w') as fh:
+                    fh.write(content)
+
+        # the final snapshot of an exited process is listed...
+        write(time.time())
+        self.assertEqual([s['pid'] for s in metrics.load_snapshots(
+            self.path)], [proc.pid])
+        self.assertEqual(len(os.listdir(self.path)), 2)
+        # ... until it goes stale
+        write(time.time() - metrics.STALE_AFTER - 1)
+        self.assertEqual(metrics.load_snapshots(self.path), [])
+        self.assertEqual(os.listdir(self.path), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,11 +5,23 @@ import numpy as np
 import pandas as pd
 
 import logging
+import os
 import re
+import time
+from typing import Iterable
 
 from common import decorators
 from common import email
+from common import mapreduce
+from common import threadpool
 from scraper import github
+from scraper import gitlog
+from scraper import metrics
+
+try:
+    import settings
+except ImportError:
+    settings = object()
 
 """ First contrib date without MIN_DATE restriction:
 > fcd = utils.first_contrib_dates("pypi").dropna()
@@ -39,6 +51,8 @@ MIN_DATE = "1997"
 DEFAULT_USERNAME = "-"
 
 fs_cache = decorators.typed_fs_cache('scraper')
+# interrupted scrapes older than this are started over, seconds
+PARTIAL_EXPIRY = 3600 * 24
 
 logger = logging.getLogger("ghd.scraper")
 
@@ -51,6 +65,13 @@ PROVIDERS = {
     "sourceforge.net": None,
 }
 
+# clone URL templates for 'git' commits backend
+COMMITS_PROVIDERS = {
+    "github.com": "https://github.com/%s.git",
+    "bitbucket.org": "https://bitbucket.org/%s.git",
+    "gitlab.com": "https://gitlab.com/%s.git",
+}
+
 """
 >>> URL_PATTERN.search("github.com/jaraco/jaraco.xkcd").group(0)
 'github.com/jaraco/jaraco.xkcd'
@@ -91,6 +112,22 @@ def parse_url(url):
     return None, None
 
 
+def adaptive_controller(initial, maximum):
+    # type: (int, int) -> threadpool.AIMDController
+    """ Get concurrency controller fed by all supported providers
+    Only one controller can be active at a time. Use with mapreduce.map:
+
+    >>> controller = adaptive_controller(4, 32)
+    >>> isinstance(controller, threadpool.AIMDController)
+    True
+    """
+    controller = threadpool.AIMDController(initial=initial, maximum=maximum)
+    for provider in PROVIDERS.values():
+        if provider is not None:
+            provider.controller = controller
+    return controller
+
+
 def get_provider(url):
     # type: (str) -> (str, str)
     """ Separate provided URL into parovider and provider-specific project ID
@@ -111,6 +148,55 @@ def get_provider(url):
     return provider, project_url
 
 
+def commits_backend():
+    # type: () -> str
+    """ SCRAPER_COMMITS_BACKEND setting, see get_commits_provider() """
+    return getattr(settings, 'SCRAPER_COMMITS_BACKEND', 'api')
+
+
+def get_commits_provider(url):
+    # type: (str) -> (object, str)
+    """ Same as get_provider(), but respects SCRAPER_COMMITS_BACKEND setting:
+        - 'api' (default): provider API, e.g. GitHubAPI
+        - 'graphql': GitHub GraphQL API, requests only stored fields and so
+            downloads a lot less than 'api'. GitHub only
+        - 'git': local clones, see scraper.gitlog. Works with any provider
+            having git repositories, and needs no tokens
+    """
+    backend = commits_backend()
+    if backend == 'api':
+        return get_provider(url)
+    if backend == 'graphql':
+        provider, project_url = get_provider(url)
+        if parse_url(url)[0] != 'github.com':
+            raise NotImplementedError(
+                "GraphQL commits backend only supports GitHub")
+        v4 = _graphql_provider()
+        v4.controller = provider.controller
+        return v4, project_url
+    if backend != 'git':
+        raise ValueError("Unknown SCRAPER_COMMITS_BACKEND: %s" % backend)
+
+    provider_name, project_url = parse_url(url)
+    if provider_name not in COMMITS_PROVIDERS:
+        raise NotImplementedError(
+            "Provider %s is not supported (yet?)" % provider_name)
+    return _git_provider(provider_name), project_url
+
+
+@decorators.memoize
+def _graphql_provider():
+    # type: () -> github.GitHubAPIv4
+    return github.GitHubAPIv4()
+
+
+@decorators.memoize
+def _git_provider(provider_name):
+    # type: (str) -> gitlog.GitLog
+    return gitlog.GitLog(provider_name,
+                         clone_url=COMMITS_PROVIDERS[provider_name])
+
+
 def gini(x):
     """ Gini index of a given iterable
     simplified version from https://github.com/oliviaguest/gini
@@ -184,13 +270,21 @@ def zeropad(df, fill_value=0):
     return df.reindex(idx, fill_value=fill_value)
 
 
-@fs_cache('raw')
-def commits(repo_url):
-    # type: (str) -> pd.DataFrame
+@fs_cache('raw', incremental=True)
+def commits(repo_url, cached=None):
+    # type: (str, pd.DataFrame) -> pd.DataFrame
     """
     convert old cache files:
     find -type f -name '*.csv' -exec rename 's/(?<=\/)commits\./_commits./' {} +
 
+    If there is an expired cache (passed by fs_cache as `cached`), only
+    commits since the last cached commit date are requested.
+    However, commits merged from branches keep their original commit date and
+    so can be older than that. In this case some parents of new commits are
+    missing and full history is scraped again.
+    Rewritten history (i.e. force push) is not detected; to start over,
+    use fs_cache.invalidate.
+
     >>> cs = commits("github.com/benjaminp/six")
     >>> isinstance(cs, pd.DataFrame)
     True
@@ -201,19 +295,246 @@ def commits(repo_url):
         ...
     RepoDoesNotExist: GH API returned status 404
     """
+    provider, project_url = get_commits_provider(repo_url)
+    since = None if cached is None else cached['committed_date'].max()
+    if pd.isnull(since):  # no cache or no commits cached
+        return stream(commits, repo_url, provider.repo_commits_pages,
+                      commits_frame)
+
+    if isinstance(provider, gitlog.GitLog):
+        # git knows the commit graph, so new commits are exactly the ones
+        # not reachable from the cached ones, no matter how old they are
+        parents = set(p for ps in cached['parents'].dropna()
+                      for p in ps.split("\n") if p)
+        new = commits_frame(provider.repo_commits(
+            project_url, exclude=cached.index.difference(parents)))
+        if new.empty:
+            return cached  # nothing changed, let fs_cache know
+        return pd.concat([new, cached[~cached.index.isin(new.index)]])
+
+    # `since` is inclusive, so the last cached commit(s) will come again
+    new = commits_frame(provider.repo_commits(project_url, since=since))
+    res = merge_commits(cached, new)
+    if res is None:
+        logger.info("%s: some of new commits are merged from older branches, "
+                    "scraping full history", repo_url)
+        return stream(commits, repo_url, provider.repo_commits_pages,
+                      commits_frame)
+    return res
+
+
+def merge_commits(cached, new):
+    # type: (pd.DataFrame, pd.DataFrame) -> pd.DataFrame
+    """ Merge commits requested with `since` into the cached ones
+    :return: merged commits; `cached` itself if there is nothing new;
+        None if parents of some new commits are unknown, i.e. full history
+        has to be scraped again
+    """
+    known = set(new.index).union(cached.index)
+    parents = set(p for ps in new['parents'].dropna()
+                  for p in ps.split("\n") if p)
+    if not parents.issubset(known):
+        return None
+    if new.index.isin(cached.index).all():
+        return cached  # nothing changed, let fs_cache know
+    return pd.concat([new, cached[~cached.index.isin(new.index)]])
+
+
+def stream(cached_func, repo_url, fetch_pages, frame):
+    # type: (callable, str, callable, callable) -> pd.DataFrame
+    """ Full scrape writing every page straight into a partial cache file,
+    so that an interrupted scrape can be resumed and pages are not kept
+    in memory while the rest is downloaded. The complete file is read into
+    memory at the end, to return the result. See PartialScrape for details.
+
+    :param cached_func: @fs_cache'd function the result is for,
+        e.g. commits
+    :param repo_url: str, argument of cached_func
+    :param fetch_pages: callable(project_url, first_page=...) returning
+        (page number, list of records) pairs, e.g. GitHubAPI.repo_issues_pages
+    :param frame: callable converting a list of records into a DataFrame
+    :return: pd.DataFrame, same as frame() of all records
+    """
+    partial = PartialScrape(cached_func, repo_url, frame)
+    first_page = partial.open()
+    try:
+        for page, records in fetch_pages(partial.project_url,
+                                         first_page=first_page):
+            partial.write(page, records)
+    except BaseException:
+        partial.close(failed=True)
+        raise
+    partial.close()
+    return partial.result()
+
+
+class PartialScrape(object):
+    """ Partial cache file of a full scrape, written page by page.
+    Used by stream(); methods doing file IO are separate so that
+    scraper.github_aio can run them outside of the event loop.
+
+    Progress (the last page written and the file size after it) is recorded
+    after every page. If the scrape is interrupted, the next one resumes
+    from the next page, discarding anything written after the last
+    completed page. Items added while the scrape was interrupted shift the
+    pages, so duplicates are possible on resume; they are dropped.
+    """
+
+    def __init__(self, cached_func, repo_url, frame):
+        # type: (callable, str, callable) -> None
+        self.fpath = cached_func.cache_fname(repo_url) + ".partial"
+        self.progress_fpath = self.fpath + ".progress"
+        self.repo_url = repo_url
+        _, self.project_url = parse_url(repo_url)
+        self.frame = frame
+        self.fh = None
+
+    def open(self):
+        # type: () -> int
+        """ Open the partial file, :return: the first page to request """
+        last_page, size = 0, 0
+        if os.path.isfile(self.fpath) and \
+                os.path.isfile(self.progress_fpath) and \
+                time.time() - os.path.getmtime(self.progress_fpath) \
+                < PARTIAL_EXPIRY:
+            with open(self.progress_fpath) as fh:
+                last_page, size = (int(chunk) for chunk in fh.read().split())
+            logger.info("%s: resuming from page %d", self.repo_url,
+                        last_page + 1)
+
+        self.fh = open(self.fpath, 'a' if last_page else 'w')
+        if last_page:
+            self.fh.truncate(size)  # remove incomplete page, if any
+        else:
+            self.frame([]).to_csv(self.fh)  # header
+            self.fh.flush()
+        return last_page + 1
+
+    def write(self, page, records):
+        # type: (int, list) -> None
+        self.frame(records).to_csv(self.fh, header=False)
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        # write + rename, so that progress is never partially written
+        with open(self.progress_fpath + ".tmp", 'w') as progress:
+            progress.write("%d %d" % (page, self.fh.tell()))
+        os.rename(self.progress_fpath + ".tmp", self.progress_fpath)
+
+    def close(self, failed=False):
+        # type: (bool) -> None
+        """ Close the partial file. If the scrape failed before any page
+        was written (e.g. the repository does not exist), there is nothing
+        to resume, so the file is removed """
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        if failed and not os.path.isfile(self.progress_fpath) \
+                and os.path.isfile(self.fpath):
+            os.remove(self.fpath)
+
+    def result(self):
+        # type: () -> pd.DataFrame
+        """ Read the complete file and remove it """
+        res = pd.read_csv(self.fpath, index_col=0, encoding="utf8")
+        res = res[~res.index.duplicated()]
+        os.remove(self.fpath)
+        if os.path.isfile(self.progress_fpath):
+            os.remove(self.progress_fpath)
+        return res
+
+
+def commits_frame(records):
+    # type: (Iterable[dict]) -> pd.DataFrame
+    """ Convert provider.repo_commits() output into commits() format """
+    records = list(records)  # not to time requests, if it is a generator
+    with metrics.get_metrics().timer('frame'):
+        return pd.DataFrame(
+            records,
+            columns=['sha', 'author', 'author_name', 'author_email',
+                     'authored_date', 'committed_date', 'parents']
+        ).set_index('sha', drop=True)
+
+
+@fs_cache('raw', 2)
+def contributor_stats(repo_url):
+    # type: (str) -> pd.Series
+    """ Weekly commits of top 100 contributors, from GitHub statistics.
+    Might throw github.StatsNotReady; see prefetch_contributor_stats()
+    to get it for many repositories at once.
+
+    :return: pd.Series indexed on (week, author), week is YYYY-MM-DD
+    """
     provider, project_url = get_provider(repo_url)
-    return pd.DataFrame(
-        provider.repo_commits(project_url),
-        columns=['sha', 'author', 'author_name', 'author_email',
-                 'authored_date', 'committed_date', 'parents']
-    ).set_index('sha', drop=True)
+    stats = pd.DataFrame(provider.repo_contributor_stats(project_url),
+                         columns=['week', 'author', 'commits'])
+    stats['author'] = stats['author'].fillna(DEFAULT_USERNAME)
+    return stats.set_index(['week', 'author'])['commits']
 
 
-# @fs_cache('aggregate', 2)
-def commit_user_stats(repo_name):
+def prefetch_contributor_stats(urls, attempts=5, delay=60, num_workers=None,
+                               controller=None):
+    # type: (Iterable[str], int, int, int, object) -> list
+    """ Fill contributor_stats() cache for many repositories.
+
+    The first request for statistics of a repository often makes GitHub
+    start computing it (HTTP 202), so these repositories are queued and
+    requested again in a later pass, at least `delay` seconds after.
+
+    :param attempts: max number of passes
+    :param num_workers, controller: same as for mapreduce.map
+    :return: list of URLs still not ready after all attempts
+    """
+    queue = [url for url in urls
+             if parse_url(url)[0] == 'github.com'
+             and contributor_stats.expired(url)]
+    for attempt in range(attempts):
+        if not queue:
+            break
+        start = time.time()
+        not_ready = []
+
+        def fetch(_, url):
+            try:
+                contributor_stats(url)
+            except github.StatsNotReady:
+                not_ready.append(url)
+            except github.RepoDoesNotExist:
+                pass
+
+        mapreduce.map(pd.Series(queue, index=queue), fetch,
+                      num_workers=num_workers, controller=controller)
+        logger.info("Contributor stats, pass %d: %d of %d repositories are "
+                    "not ready", attempt + 1, len(not_ready), len(queue))
+        queue = not_ready
+        if queue and attempt + 1 < attempts:
+            time.sleep(max(0, delay - (time.time() - start)))
+    return queue
+
+
+def contributor_user_stats(repo_name):
     # type: (str) -> pd.Series
+    """ Approximate version of commit_user_stats(), from contributor_stats()
+
+    It takes one request per repository instead of one per 100 commits,
+    but only top 100 contributors are counted and weeks are attributed
+    to the month they start in.
+    """
+    stats = contributor_stats(repo_name)
+    if stats.empty:
+        return user_stats(pd.DataFrame(columns=['author', 'authored_date']),
+                          "authored_date", "commits")
+    stats = stats.reset_index()
+    return stats['commits'].groupby(
+        [stats['week'].str[:7].rename('authored_date'), stats['author']]
+    ).sum().rename('commits').astype(np.int64)
+
+
+# @fs_cache('aggregate', 2)
+def commit_user_stats(repo_name, approx=False):
+    # type: (str, bool) -> pd.Series
     """
     :param repo_name: str, repo name (e.g. github.com/pandas-dev/pandas
+    :param approx: bool, use contributor_user_stats() instead of commits
     :return a dataframe indexed on (month, username) with a commits column
 
     # This repo contains one commit out of order 2005 while repo started in 2016
@@ -233,6 +554,8 @@ def commit_user_stats(repo_name):
     >>> 1 <= len(commit_user_stats("github.com/user2589/schooligan")) < 10  # 1
     True
     """
+    if approx:
+        return contributor_user_stats(repo_name)
     stats = commits(repo_name)
     # check for null and empty string is required because of file caching.
     # commits scraped immediately will have empty string, but after save/load
@@ -246,8 +569,8 @@ def commit_user_stats(repo_name):
 
 
 # @fs_cache('aggregate')
-def commit_stats(repo_name):
-    # type: (str) -> pd.Series
+def commit_stats(repo_name, approx=False):
+    # type: (str, bool) -> pd.Series
     """Commits aggregated by month
     >>> cs = commit_stats("github.com/django/django")
     >>> isinstance(cs, pd.Series)
@@ -257,12 +580,13 @@ def commit_stats(repo_name):
     >>> 100 < cs["2017-12"] < 200
     True
     """
-    return zeropad(commit_user_stats(repo_name).groupby('authored_date').sum())
+    return zeropad(commit_user_stats(repo_name, approx).groupby(
+        'authored_date').sum())
 
 
 # @fs_cache('aggregate')
-def commit_users(repo_name):
-    # type: (str) -> pd.Series
+def commit_users(repo_name, approx=False):
+    # type: (str, bool) -> pd.Series
     """Number of contributors by month
     >>> cu = commit_users("github.com/django/django")
     >>> isinstance(cu, pd.Series)
@@ -272,13 +596,13 @@ def commit_users(repo_name):
     >>> 30 < cu["2017-12"] < 100  # 32
     True
     """
-    return commit_user_stats(repo_name).groupby(
+    return commit_user_stats(repo_name, approx).groupby(
         'authored_date').count().rename("users")
 
 
 # @fs_cache('aggregate')
-def commit_gini(repo_name):
-    # type: (str) -> pd.Series
+def commit_gini(repo_name, approx=False):
+    # type: (str, bool) -> pd.Series
     """
     >>> g = commit_gini("github.com/django/django")
     >>> isinstance(g, pd.Series)
@@ -288,12 +612,12 @@ def commit_gini(repo_name):
     >>> all(0 <= i <= 1 for i in g)
     True
     """
-    return commit_user_stats(repo_name).groupby(
+    return commit_user_stats(repo_name, approx).groupby(
         "authored_date").aggregate(gini).rename("gini")
 
 
-def contributions_quantile(repo_name, q):
-    # type: (str, float) -> pd.Series
+def contributions_quantile(repo_name, q, approx=False):
+    # type: (str, float, bool) -> pd.Series
     """
     >>> q50 = contributions_quantile("github.com/django/django", 0.5)
     >>> isinstance(q50, pd.Series)
@@ -305,15 +629,19 @@ def contributions_quantile(repo_name, q):
     >>> 0 < q50["2017-12"] < 10  # 2
     True
     """
-    return quantile(commit_user_stats(repo_name).reset_index(),
+    return quantile(commit_user_stats(repo_name, approx).reset_index(),
                     "authored_date", q)["commits"].rename("q%g" % (q*100))
 
 
-@fs_cache('raw')
-def issues(repo_url):
-    # type: (str) -> pd.DataFrame
+@fs_cache('raw', incremental=True)
+def issues(repo_url, cached=None):
+    # type: (str, pd.DataFrame) -> pd.DataFrame
     """ Get a dataframe with issues
 
+    If there is an expired cache (passed by fs_cache as `cached`), only
+    issues updated since the last cached update are requested and merged into
+    the cached ones by number.
+
     >>> iss = issues("github.com/benjaminp/six")
     >>> isinstance(iss, pd.DataFrame)
     True
@@ -323,13 +651,65 @@ def issues(repo_url):
     0
     """
     provider, project_url = get_provider(repo_url)
-    return pd.DataFrame(
-        provider.repo_issues(project_url),
-        columns=['number', 'author', 'closed', 'created_at', 'updated_at',
-                 'closed_at']).set_index('number', drop=True)
+    since = None if cached is None else cached['updated_at'].max()
+    if pd.isnull(since):  # no cache or no issues cached
+        return stream(issues, repo_url, provider.repo_issues_pages,
+                      issues_frame)
+
+    # `since` is inclusive, so the last updated issue(s) will come again
+    return merge_issues(cached, issues_frame(
+        provider.repo_issues(project_url, since=since)))
+
+
+def merge_issues(cached, new):
+    # type: (pd.DataFrame, pd.DataFrame) -> pd.DataFrame
+    """ Merge issues requested with `since` into the cached ones by number
+    :return: merged issues, or `cached` itself if nothing was updated
+    """
+    updated = new['updated_at'] != cached['updated_at'].reindex(new.index)
+    if not updated.any():
+        return cached  # nothing changed, let fs_cache know
+    return pd.concat([new, cached[~cached.index.isin(new.index)]])
+
+
+def prefetch_issues(urls, batch_size=50):
+    # type: (Iterable[str], int) -> int
+    """ Fill issues cache of GitHub repositories that were never scraped,
+    using batched GraphQL queries (see GitHubAPIv4.repos_issues).
+    Most repositories have less than 100 issues, so it takes a fraction of
+    a request per repository instead of one or more.
+    Missing repositories are skipped, REST API will report them later.
+
+    :return: number of repositories cached
+    """
+    repos = {}
+    for url in urls:
+        provider_name, project_url = parse_url(url)
+        if provider_name == 'github.com' and issues.mtime(url) is None:
+            repos[project_url] = url
+
+    v4 = _graphql_provider()
+    v4.controller = PROVIDERS['github.com'].controller
+    count = 0
+    for project_url, records in v4.repos_issues(repos, batch_size):
+        if records is not None:
+            issues.store(issues_frame(records), repos[project_url])
+            count += 1
+    return count
+
+
+def issues_frame(records):
+    # type: (Iterable[dict]) -> pd.DataFrame
+    """ Convert provider.repo_issues() output into issues() format """
+    records = list(records)  # not to time requests, if it is a generator
+    with metrics.get_metrics().timer('frame'):
+        return pd.DataFrame(
+            records,
+            columns=['number', 'author', 'closed', 'created_at', 'updated_at',
+                     'closed_at']).set_index('number', drop=True)
 
 
-@fs_cache('aggregate')
+@fs_cache('aggregate', depends_on=(commits, issues))
 def non_dev_issues(repo_name):
     # type: (str) -> pd.DataFrame
     """Same as new_issues with subtracted issues authored by contributors
@@ -441,7 +821,7 @@ def non_dev_submitters(repo_name):
         'created_at').count().rename("non_dev_submitters")
 
 
-@fs_cache('aggregate')
+@fs_cache('aggregate', depends_on=(issues,))
 def closed_issues(repo_name):
     # type: (str) -> pd.Series
     """New issues aggregated by month
@@ -461,7 +841,7 @@ def closed_issues(repo_name):
     return closed.groupby(closed.str[:7]).count()
 
 
-@fs_cache('aggregate')
+@fs_cache('aggregate', depends_on=(issues,))
 def open_issues(repo_name):
     # type: (str) -> pd.Series
     """Open issues aggregated by month
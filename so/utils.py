@@ -320,7 +320,7 @@ def adjacency_matrix():
     # type: () -> pd.DataFrame
     # the resulting matrix is huge and makes pd.read_csv to freeze
     # thus, manual cache
-    fname = so_cache.get_cache_fname("adjacency")
+    fname = os.path.join(so_cache.cache_path, "adjacency.csv")
     if so_cache.expired(fname):
         df = parse(AdjacencyHandler).matrix
         df.to_csv(fname)